@@ -0,0 +1,125 @@
+"""durian.applier"""
+from Queue import Queue
+import threading
+import sys
+import os
+
+
+class LocalResult(object):
+    """The pending result of a function applied in a :class:`ThreadPool`.
+
+    For tasks this will be the :class:`celery.result.EagerResult` of
+    :meth:`celery.task.base.Task.apply`.
+
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def ready(self):
+        """Returns ``True`` if the function has returned."""
+        return self.event.isSet()
+
+    def wait(self, timeout=None):
+        """Wait for the function to return, and return its return value.
+
+        If the function raised an exception, it's re-raised here.
+
+        """
+        self.event.wait(timeout)
+        if not self.ready():
+            raise RuntimeError("Timed out waiting for result.")
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+    get = wait
+
+    def set(self, value=None, exc_info=None):
+        self.value = value
+        self.exc_info = exc_info
+        self.event.set()
+
+
+class ThreadPool(object):
+    """Bounded pool of worker threads.
+
+    The threads are started as needed, up to ``limit`` threads.
+
+    :param limit: The maximum number of threads.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.queue = Queue()
+        self.threads = []
+        self.mutex = threading.Lock()
+        self.pid = os.getpid()
+
+    def apply_async(self, fun, args=(), kwargs={}):
+        """Apply ``fun`` in one of the threads.
+
+        :returns: :class:`LocalResult`.
+
+        """
+        result = LocalResult()
+        self._maybe_start_thread()
+        self.queue.put((fun, args, kwargs, result))
+        return result
+
+    def _maybe_start_thread(self):
+        self.mutex.acquire()
+        try:
+            # Threads doesn't survive a fork.
+            if self.pid != os.getpid():
+                self.queue, self.threads = Queue(), []
+                self.pid = os.getpid()
+            if len(self.threads) < self.limit:
+                thread = threading.Thread(target=self._work,
+                                          args=(self.queue, ))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.mutex.release()
+
+    def _work(self, queue):
+        while True:
+            fun, args, kwargs, result = queue.get()
+            try:
+                result.set(fun(*args, **kwargs))
+            except:
+                result.set(exc_info=sys.exc_info())
+
+
+class LocalApplier(object):
+    """Apply tasks locally using a :class:`ThreadPool`, so the tasks
+    run in parallel instead of one after another.
+
+    Has the same signature as :meth:`celery.task.base.Task.apply`, but
+    returns a :class:`LocalResult`.
+
+    :param task_cls: The task to apply.
+    :param pool: The :class:`ThreadPool` to use.
+
+    """
+
+    def __init__(self, task_cls, pool):
+        self.task_cls = task_cls
+        self.pool = pool
+
+    def __call__(self, args=None, kwargs=None, **options):
+        return self.pool.apply_async(self.task_cls.apply,
+                                     args=(args, kwargs), kwargs=options)
+
+
+_pools = {}
+
+
+def get_pool(limit):
+    """Get the shared thread pool with a limit of ``limit`` threads."""
+    if limit not in _pools:
+        _pools.setdefault(limit, ThreadPool(limit))
+    return _pools[limit]
@@ -0,0 +1,347 @@
+"""durian.breaker"""
+from django.core.cache import cache
+from django.dispatch import Signal
+from django.utils.encoding import smart_str
+from durian import conf
+from durian.utils import get_cls_by_name
+from urlparse import urlsplit
+import threading
+import hashlib
+import time
+import math
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+"""
+.. data:: state_changed
+
+    Sent when the circuit for a host changes state, with the arguments
+    ``host`` and ``state`` (one of ``STATE_CLOSED``, ``STATE_OPEN`` or
+    ``STATE_HALF_OPEN``). The sender is the :class:`CircuitBreaker`.
+
+"""
+state_changed = Signal(providing_args=["host", "state"])
+
+
+class CircuitOpen(Exception):
+    """Deliveries to the host are suspended, as too many of the recent
+    deliveries to it has failed.
+
+    .. attribute:: host
+
+        The host of the listener URL.
+
+    .. attribute:: retry_after
+
+        Number of seconds until a new delivery to the host is allowed.
+
+    """
+
+    def __init__(self, host, retry_after):
+        self.host = host
+        self.retry_after = retry_after
+        super(CircuitOpen, self).__init__(
+                "Circuit for %s is open, retry in %d seconds." % (
+                    host, retry_after))
+
+
+def host_for(url):
+    """Get the host (and port) of a listener URL."""
+    return urlsplit(url)[1].lower()
+
+
+def is_host_failure(exc):
+    """Returns ``True`` if the delivery error means the host is down, i.e.
+    any error except a HTTP error response below 500."""
+    code = getattr(exc, "code", None)
+    return not (isinstance(code, int) and code < 500)
+
+
+class LocalBackend(object):
+    """Process local breaker state, with the subset of the Django cache
+    API used by :class:`CircuitBreaker` (and
+    :class:`durian.ratelimit.HostLimiter`).
+
+    Use this if the web processes and workers don't share a cache, the
+    state is then only shared by the threads of a process.
+
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.mutex = threading.Lock()
+
+    def get(self, key, default=None):
+        self.mutex.acquire()
+        try:
+            return self._get(key, default)
+        finally:
+            self.mutex.release()
+
+    def set(self, key, value, timeout=None):
+        self.mutex.acquire()
+        try:
+            self._set(key, value, timeout)
+        finally:
+            self.mutex.release()
+
+    def add(self, key, value, timeout=None):
+        self.mutex.acquire()
+        try:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+        finally:
+            self.mutex.release()
+
+    def incr(self, key, delta=1):
+        self.mutex.acquire()
+        try:
+            value = self._get(key)
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            self.data[key] = (value + delta, self.data[key][1])
+            return value + delta
+        finally:
+            self.mutex.release()
+
+    def decr(self, key, delta=1):
+        return self.incr(key, -delta)
+
+    def delete(self, key):
+        self.mutex.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self.mutex.release()
+
+    def _get(self, key, default=None):
+        value, expires = self.data.get(key, (default, None))
+        if expires is not None and expires < time.time():
+            del(self.data[key])
+            return default
+        return value
+
+    def _set(self, key, value, timeout=None):
+        expires = timeout and time.time() + timeout or None
+        self.data[key] = (value, expires)
+
+
+class CircuitBreaker(object):
+    """Circuit breaker keyed by listener host.
+
+    Deliveries are counted per host in windows of :attr:`window`
+    seconds. When at least :attr:`min_requests` deliveries has been made
+    in the current and the previous window, and the ratio of failed
+    deliveries reaches :attr:`failure_rate`, the circuit opens and no
+    deliveries are made to the host for :attr:`reset_timeout` seconds.
+    After that the circuit is half open: a single delivery is let
+    through as a probe. If it succeeds the circuit closes, if it fails the
+    circuit opens again.
+
+    The state is kept in :attr:`backend`, by default the Django cache,
+    so it's shared by all the processes using the same cache.
+
+    :keyword backend: See :attr:`backend`.
+    :keyword failure_rate: See :attr:`failure_rate`.
+    :keyword min_requests: See :attr:`min_requests`.
+    :keyword window: See :attr:`window`.
+    :keyword reset_timeout: See :attr:`reset_timeout`.
+
+    .. attribute:: backend
+
+        Object with the Django cache API (``get``, ``set``, ``add``,
+        ``incr`` and ``delete``) to keep the state in, e.g.
+        :class:`LocalBackend`. Defaults to the ``DURIAN_CIRCUIT_BACKEND``
+        setting, or :data:`django.core.cache.cache`.
+
+    .. attribute:: failure_rate
+
+        The ratio of failed deliveries that opens the circuit.
+
+    .. attribute:: min_requests
+
+        The circuit is never opened unless there has been at least this
+        many deliveries to the host.
+
+    .. attribute:: window
+
+        Length of the counting windows in seconds.
+
+    .. attribute:: reset_timeout
+
+        Number of seconds the circuit stays open before a probe is
+        let through.
+
+    .. attribute:: stats
+
+        Number of state changes made by this process (``"opened"``,
+        ``"half_opened"`` and ``"closed"``), and number of deliveries
+        ``"rejected"`` because the circuit was open.
+
+    """
+    key_format = "durian.breaker.%s.%s"
+
+    def __init__(self, backend=None, failure_rate=None, min_requests=None,
+            window=None, reset_timeout=None):
+        if backend is None:
+            backend = conf.CIRCUIT_BACKEND and \
+                        get_cls_by_name(conf.CIRCUIT_BACKEND)() or cache
+        self.backend = backend
+        self.failure_rate = failure_rate or conf.CIRCUIT_FAILURE_RATE
+        self.min_requests = min_requests or conf.CIRCUIT_MIN_REQUESTS
+        self.window = window or conf.CIRCUIT_WINDOW
+        self.reset_timeout = reset_timeout or conf.CIRCUIT_RESET_TIMEOUT
+        self.stats = {"opened": 0, "half_opened": 0, "closed": 0,
+                      "rejected": 0}
+
+    def allow(self, host):
+        """Returns ``True`` if a delivery to the host can be made now.
+
+        If the circuit is half open, this is ``True`` only for the
+        process getting to make the probe.
+
+        """
+        opened_at = self.backend.get(self._key(host, "opened"))
+        if opened_at is None:
+            return True
+        if time.time() >= opened_at + self.reset_timeout:
+            if self.backend.add(self._key(host, "probe"), time.time(),
+                                self.reset_timeout):
+                self._changed(host, STATE_HALF_OPEN)
+                return True
+        self.stats["rejected"] += 1
+        return False
+
+    def check(self, host):
+        """Like :meth:`allow`, but raises :exc:`CircuitOpen` if the
+        delivery can't be made."""
+        if not self.allow(host):
+            raise CircuitOpen(host, self.retry_after(host))
+
+    def retry_after(self, host):
+        """Number of seconds until the circuit for a host is half open
+        (at least one second, if the circuit is not closed)."""
+        opened_at = self.backend.get(self._key(host, "opened"))
+        if opened_at is None:
+            return 0
+        remaining = opened_at + self.reset_timeout - time.time()
+        return max(int(math.ceil(remaining)), 1)
+
+    def state(self, host):
+        """Get the current state of the circuit for a host."""
+        opened_at = self.backend.get(self._key(host, "opened"))
+        if opened_at is None:
+            return STATE_CLOSED
+        if self.backend.get(self._key(host, "probe")) is not None or \
+                time.time() >= opened_at + self.reset_timeout:
+            return STATE_HALF_OPEN
+        return STATE_OPEN
+
+    def record(self, host, exc=None):
+        """Record the outcome of a delivery to the host.
+
+        :keyword exc: The delivery error, or ``None`` if the delivery
+            succeeded. Errors not caused by the host being down
+            (see :func:`is_host_failure`) are counted as successes.
+
+        """
+        if exc is not None and is_host_failure(exc):
+            self.failure(host)
+        else:
+            self.success(host)
+
+    def success(self, host):
+        """Record a successful delivery to the host.
+
+        Only the total is incremented, the counters are read by
+        :meth:`failure`.
+
+        """
+        self._incr(self._key(host, "total.%d" % self._current_window()))
+        if self.backend.get(self._key(host, "probe")) is not None:
+            self.reset(host)
+            self._changed(host, STATE_CLOSED)
+
+    def failure(self, host):
+        """Record a failed delivery to the host."""
+        total, failures = self._count_failure(host)
+        if self.backend.get(self._key(host, "opened")) is not None:
+            if self.backend.get(self._key(host, "probe")) is not None:
+                # The probe failed.
+                self._open(host)
+            return
+        if total >= self.min_requests and \
+                failures >= total * self.failure_rate:
+            self._open(host)
+
+    def reset(self, host):
+        """Close the circuit for a host, and reset its counters."""
+        self.backend.delete(self._key(host, "opened"))
+        self.backend.delete(self._key(host, "probe"))
+        current = self._current_window()
+        for window in (current - 1, current):
+            for counter in ("total", "failures"):
+                self.backend.delete(self._key(host,
+                                              "%s.%d" % (counter, window)))
+
+    def _open(self, host):
+        self.backend.set(self._key(host, "opened"), time.time(),
+                         self.reset_timeout * 4)
+        self.backend.delete(self._key(host, "probe"))
+        self._changed(host, STATE_OPEN)
+
+    def _changed(self, host, state):
+        counter = {STATE_OPEN: "opened",
+                   STATE_HALF_OPEN: "half_opened",
+                   STATE_CLOSED: "closed"}[state]
+        self.stats[counter] += 1
+        state_changed.send(sender=self, host=host, state=state)
+
+    def _count_failure(self, host):
+        current = self._current_window()
+        total = self._incr(self._key(host, "total.%d" % current))
+        failures = self._incr(self._key(host, "failures.%d" % current))
+        previous = current - 1
+        total += self.backend.get(self._key(host,
+                                            "total.%d" % previous)) or 0
+        failures += self.backend.get(self._key(host,
+                                               "failures.%d" % previous)) or 0
+        return total, failures
+
+    def _incr(self, key):
+        # The counter usually exists, so try to increment it first.
+        try:
+            return self.backend.incr(key)
+        except ValueError:
+            if self.backend.add(key, 1, self.window * 2):
+                return 1
+        try:
+            return self.backend.incr(key)
+        except ValueError:
+            # Expired between add and incr.
+            self.backend.add(key, 1, self.window * 2)
+            return 1
+
+    def _current_window(self):
+        return int(time.time() // self.window)
+
+    def _key(self, host, name):
+        # Hosts can contain characters not allowed in memcached keys.
+        digest = hashlib.md5(smart_str(host)).hexdigest()
+        return self.key_format % (digest, name)
+
+
+_breaker = None
+
+
+def get_breaker():
+    """Get the shared :class:`CircuitBreaker` configured by the
+    ``DURIAN_CIRCUIT_*`` settings."""
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker()
+    return _breaker
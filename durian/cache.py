@@ -0,0 +1,236 @@
+"""durian.cache"""
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from celery.utils import gen_unique_id
+from durian import conf
+from durian.match.index import MatchIndex
+import hashlib
+import warnings
+
+"""
+.. data:: PROCESS_LOCAL_BACKENDS
+
+    Modules of the Django cache backends not shared between processes.
+
+"""
+PROCESS_LOCAL_BACKENDS = ("django.core.cache.backends.locmem",
+                          "django.core.cache.backends.dummy")
+
+
+def is_shared_backend(backend):
+    """Returns ``True`` if a cache backend is shared between processes."""
+    return backend.__class__.__module__ not in PROCESS_LOCAL_BACKENDS
+
+
+class LoadedListeners(object):
+    """The listeners of a hook loaded for a single event, with the
+    interface of :class:`durian.match.index.MatchIndex`.
+
+    Building the index would take longer than testing every listener
+    once, so every listener is a candidate.
+
+    """
+
+    def __init__(self, listeners):
+        self.listeners = sorted(listeners, key=lambda listener: listener.pk)
+
+    def all(self):
+        return list(self.listeners)
+
+    def candidates(self, payload):
+        return list(self.listeners)
+
+    def __len__(self):
+        return len(self.listeners)
+
+
+class ListenerCache(object):
+    """Process local cache of decoded listeners.
+
+    Listeners are cached per hook in a
+    :class:`durian.match.index.MatchIndex`, together with a version stamp
+    kept in the shared Django cache. Saving or deleting a
+    :class:`durian.models.Listener` replaces the stamp, so every process
+    sharing the cache (web processes and celery workers alike) reloads the
+    listeners for that hook the next time it's asked for them.
+
+    If the cache isn't shared by the processes (see :attr:`shared`), a
+    listener saved in one process would never be seen by the others, so
+    the listeners are loaded from the database every time instead. They
+    are not indexed then (see :class:`LoadedListeners`), and
+    :meth:`has_listeners` doesn't query the database, as the listeners
+    are loaded right after anyway.
+
+    :keyword backend: The shared cache used to store the version stamps.
+        Defaults to :data:`django.core.cache.cache`.
+    :keyword shared: See :attr:`shared`.
+
+    .. attribute:: shared
+
+        ``True`` if :attr:`backend` is shared by all processes. Defaults
+        to the ``DURIAN_LISTENER_CACHE_SHARED`` setting, or ``False`` if
+        the backend is process local (see :data:`PROCESS_LOCAL_BACKENDS`).
+
+    .. attribute:: hits
+
+        Number of lookups served from the process local cache.
+
+    .. attribute:: misses
+
+        Number of lookups that had to (re)load the listeners from
+        the database.
+
+    """
+    key_format = "durian.listeners.version.%s"
+
+    def __init__(self, backend=None, timeout=None, shared=None):
+        self.backend = backend or cache
+        self.timeout = timeout or conf.LISTENER_CACHE_TIMEOUT
+        if shared is None:
+            shared = conf.LISTENER_CACHE_SHARED
+        if shared is None:
+            shared = is_shared_backend(self.backend)
+        self.shared = shared
+        self._warned = False
+        self.entries = {}
+        self.counts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hook_name):
+        """Get the listeners for a hook by name."""
+        return self.get_index(hook_name).all()
+
+    def get_index(self, hook_name):
+        """Get the :class:`durian.match.index.MatchIndex` of the listeners
+        for a hook by name.
+
+        When the listeners have changed the index is updated in place,
+        so only the changed listeners are re-indexed.
+
+        """
+        if not self.is_shared():
+            self.misses += 1
+            return LoadedListeners(self.load(hook_name))
+        version = self.get_version(hook_name)
+        entry = self.entries.get(hook_name)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        # The version must be read before loading, if a listener is
+        # changed meanwhile we store the old version and reload next time.
+        listeners = self.load(hook_name)
+        if entry is not None:
+            index = entry[1]
+            index.update(listeners)
+        else:
+            index = MatchIndex(listeners)
+        self.entries[hook_name] = (version, index)
+        return index
+
+    def count(self, hook_name):
+        """Get the number of listeners for a hook by name.
+
+        The count is cached in the process under the same version stamp
+        as the listeners, so it's only counted in the database again
+        when the listeners have changed. The listeners themselves are
+        not loaded, unless they're already cached.
+
+        """
+        from durian.models import Listener
+        if not self.is_shared():
+            self.misses += 1
+            return Listener.objects.filter(hook=hook_name).count()
+        version = self.get_version(hook_name)
+        entry = self.entries.get(hook_name)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return len(entry[1])
+        counted = self.counts.get(hook_name)
+        if counted is not None and counted[0] == version:
+            self.hits += 1
+            return counted[1]
+        self.misses += 1
+        count = Listener.objects.filter(hook=hook_name).count()
+        self.counts[hook_name] = (version, count)
+        return count
+
+    def has_listeners(self, hook_name):
+        """Returns ``True`` if the hook has any listeners.
+
+        Always ``True`` if the cache isn't shared, so sending an event
+        only takes the query loading the listeners.
+
+        """
+        if not self.is_shared():
+            return True
+        return self.count(hook_name) > 0
+
+    def is_shared(self):
+        """Returns :attr:`shared`, warning the first time if it's
+        ``False``."""
+        if not self.shared and not self._warned:
+            self._warned = True
+            warnings.warn("The cache backend %r is not shared between "
+                "processes, so listeners are not cached. Use a shared "
+                "cache, or set DURIAN_LISTENER_CACHE_SHARED." % (
+                    self.backend, ), RuntimeWarning)
+        return self.shared
+
+    def load(self, hook_name):
+        """Load all listeners for a hook from the database."""
+        from durian.models import Listener
+        return list(Listener.objects.filter(hook=hook_name))
+
+    def get_version(self, hook_name):
+        """Get the current shared version stamp for a hook.
+
+        A new stamp is created if there is none.
+
+        """
+        key = self.version_key(hook_name)
+        version = self.backend.get(key)
+        if version is None:
+            self.backend.add(key, gen_unique_id(), self.timeout)
+            version = self.backend.get(key)
+        return version
+
+    def invalidate(self, hook_name):
+        """Invalidate the listeners for a hook in all processes.
+
+        This is done automatically when a listener is saved or deleted,
+        but must be called manually after bulk updates
+        (e.g. ``Listener.objects.filter(...).update(...)``).
+
+        """
+        self.entries.pop(hook_name, None)
+        self.counts.pop(hook_name, None)
+        self.backend.set(self.version_key(hook_name), gen_unique_id(),
+                         self.timeout)
+
+    def clear(self):
+        """Clear the process local cache, and reset the counters."""
+        self.entries.clear()
+        self.counts.clear()
+        self.hits = self.misses = 0
+
+    def version_key(self, hook_name):
+        # Hook names can contain characters not allowed in memcached keys.
+        digest = hashlib.md5(smart_str(hook_name)).hexdigest()
+        return self.key_format % digest
+
+    @property
+    def stats(self):
+        """Cache statistics: hits, misses and the number of cached hooks."""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hooks": len(self.entries)}
+
+"""
+.. data:: listeners
+
+    The global listener cache.
+
+"""
+listeners = ListenerCache()
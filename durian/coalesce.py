@@ -0,0 +1,160 @@
+"""durian.coalesce
+
+Saving the same object several times in one request makes a
+:class:`durian.event.ModelHook` send several near identical events. With
+:attr:`durian.event.ModelHook.coalesce` enabled, and while events are
+being buffered in the current thread, only the last event for each
+``(hook, primary key)`` is kept, and the events of each hook are sent
+together when the buffering ends.
+
+Buffering is started by :func:`begin` and ended by :func:`end`, or by
+wrapping a function with :func:`coalesce_events`, or for every request by
+adding :class:`durian.middleware.CoalesceMiddleware` to the middleware.
+Buffering can be nested, the events are sent when the outermost block
+ends.
+
+"""
+import threading
+from functools import wraps
+
+_state = threading.local()
+
+
+def is_buffering():
+    """Returns ``True`` if events are being buffered in this thread."""
+    return getattr(_state, "depth", 0) > 0
+
+
+def begin():
+    """Start buffering events in this thread."""
+    if not is_buffering():
+        _state.depth = 0
+        _state.keys = []
+        _state.events = {}
+    _state.depth += 1
+
+
+def end(discard=False):
+    """End buffering, and send the buffered events if this was the
+    outermost block.
+
+    :keyword discard: Throw the buffered events away instead of sending
+        them, e.g. because the transaction was rolled back.
+
+    :returns: The results of the events sent.
+
+    """
+    if not is_buffering():
+        return []
+    _state.depth -= 1
+    if discard:
+        _state.keys = []
+        _state.events = {}
+    if _state.depth:
+        return []
+    return flush()
+
+
+def flush():
+    """Send the events buffered so far.
+
+    The events of each hook (and sender) are sent together with
+    :meth:`durian.event.Hook.send_many_prepared`, so the listeners are
+    matched once for all of them. The groups are sent in the order their
+    first event was buffered.
+
+    :returns: List of the results of the events sent, in the order they
+        were first buffered.
+
+    """
+    keys, events = getattr(_state, "keys", []), getattr(_state, "events", {})
+    _state.keys = []
+    _state.events = {}
+    groups = {}
+    order = []
+    for index, key in enumerate(keys):
+        hook, sender, payload = events[key]
+        group = groups.get((hook.name, sender))
+        if group is None:
+            group = groups[(hook.name, sender)] = (hook, sender, [], [])
+            order.append(group)
+        group[2].append(index)
+        group[3].append(payload)
+    results = [None] * len(keys)
+    for hook, sender, indices, payloads in order:
+        if len(payloads) == 1:
+            sent = [hook.send_prepared(sender, payloads[0])]
+        else:
+            sent = hook.send_many_prepared(sender, payloads)
+        for index, result in zip(indices, sent):
+            results[index] = result
+    return results
+
+
+def buffer_event(hook, key, sender, payload):
+    """Buffer a prepared event, replacing the event already buffered
+    with the same key.
+
+    If any of the coalesced events was for a newly created object, so
+    is the buffered event (the ``created`` key). Payloads with only the
+    changed fields (see :attr:`durian.event.ModelHook.changes_only`) are
+    merged with the buffered payload, keeping the oldest ``"old"`` value
+    of every change.
+
+    :returns: ``False`` if events are not being buffered in this thread,
+        in which case the event must be sent at once.
+
+    """
+    if not is_buffering():
+        return False
+    key = (hook.name, key)
+    previous = _state.events.get(key)
+    if previous is None:
+        _state.keys.append(key)
+    else:
+        payload = merge_payloads(previous[2], payload)
+    _state.events[key] = (hook, sender, payload)
+    return True
+
+
+def merge_payloads(previous, payload):
+    """Merge the payload of an event with the payload of the previous
+    event for the same object."""
+    if "changes" in payload:
+        merged = dict(previous)
+        merged.update(payload)
+        if "changes" in previous:
+            changes = dict(previous["changes"])
+            for name, change in payload["changes"].items():
+                if name in changes:
+                    change = {"old": changes[name]["old"],
+                              "new": change["new"]}
+                changes[name] = change
+            merged["changes"] = changes
+        else:
+            # The previous event had the full payload.
+            del merged["changes"]
+        payload = merged
+    if previous.get("created") and "created" in payload:
+        payload["created"] = True
+    return payload
+
+
+def coalesce_events(fun):
+    """Decorator buffering the events sent while the function runs.
+
+    The events are discarded if the function raises an exception.
+
+    """
+
+    @wraps(fun)
+    def _coalesced(*args, **kwargs):
+        begin()
+        try:
+            result = fun(*args, **kwargs)
+        except:
+            end(discard=True)
+            raise
+        end()
+        return result
+    return _coalesced
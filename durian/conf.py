@@ -0,0 +1,329 @@
+"""durian.conf"""
+from django.conf import settings
+
+DEFAULT_LISTENER_CACHE_TIMEOUT = 60 * 60 * 24
+DEFAULT_LISTENER_CACHE_SHARED = None
+DEFAULT_MAX_IDLE_CONNECTIONS = 4
+DEFAULT_CONNECTION_IDLE_TIMEOUT = 30
+DEFAULT_DELIVERY_ENGINE = None
+DEFAULT_DELIVERY_CONCURRENCY = None
+DEFAULT_PAYLOAD_ENCODER = "durian.payload.encode_json"
+DEFAULT_PAYLOAD_DECODER = "django.utils.simplejson.loads"
+DEFAULT_PAYLOAD_STORE = None
+DEFAULT_PAYLOAD_STORE_TIMEOUT = 60 * 60 * 24
+DEFAULT_PAYLOAD_STORE_DIR = None
+DEFAULT_PAYLOAD_CACHE_SIZE = 100
+DEFAULT_RETRY_DELAY = 10
+DEFAULT_RETRY_BACKOFF = 2
+DEFAULT_RETRY_MAX_DELAY = 60 * 60
+DEFAULT_CIRCUIT_BREAKER = False
+DEFAULT_CIRCUIT_BACKEND = None
+DEFAULT_CIRCUIT_FAILURE_RATE = 0.5
+DEFAULT_CIRCUIT_MIN_REQUESTS = 10
+DEFAULT_CIRCUIT_WINDOW = 60
+DEFAULT_CIRCUIT_RESET_TIMEOUT = 30
+DEFAULT_RATE_LIMIT_BACKEND = None
+DEFAULT_RATE_LIMIT_DELAY = 1
+DEFAULT_RATE_LIMIT_IN_FLIGHT_TIMEOUT = 60 * 5
+DEFAULT_RATE_LIMIT_MAX_DEFERRALS = 10
+DEFAULT_DEAD_LETTER = False
+DEFAULT_OUTBOX = False
+DEFAULT_OUTBOX_LEASE = 60 * 5
+
+"""
+.. data:: LISTENER_CACHE_TIMEOUT
+
+    How long (in seconds) the shared listener version stamps are kept in
+    the Django cache. When a stamp expires every process reloads the
+    listeners for that hook once.
+
+"""
+LISTENER_CACHE_TIMEOUT = getattr(settings, "DURIAN_LISTENER_CACHE_TIMEOUT",
+                                 DEFAULT_LISTENER_CACHE_TIMEOUT)
+
+"""
+.. data:: LISTENER_CACHE_SHARED
+
+    Set to ``True`` if the Django cache is shared by all the processes
+    sending and delivering events, so the listeners can be cached in
+    each process (see :class:`durian.cache.ListenerCache`). The default
+    is ``True`` unless the cache backend is process local (``locmem://``,
+    which is the Django default, or ``dummy://``). Can also be set to
+    ``True`` if everything runs in a single process.
+
+"""
+LISTENER_CACHE_SHARED = getattr(settings, "DURIAN_LISTENER_CACHE_SHARED",
+                                DEFAULT_LISTENER_CACHE_SHARED)
+
+"""
+.. data:: MAX_IDLE_CONNECTIONS
+
+    Maximum number of idle HTTP connections kept per listener host
+    in each process.
+
+"""
+MAX_IDLE_CONNECTIONS = getattr(settings, "DURIAN_MAX_IDLE_CONNECTIONS",
+                               DEFAULT_MAX_IDLE_CONNECTIONS)
+
+"""
+.. data:: CONNECTION_IDLE_TIMEOUT
+
+    Idle HTTP connections not used for this many seconds are closed.
+
+"""
+CONNECTION_IDLE_TIMEOUT = getattr(settings,
+                                  "DURIAN_CONNECTION_IDLE_TIMEOUT",
+                                  DEFAULT_CONNECTION_IDLE_TIMEOUT)
+
+"""
+.. data:: DELIVERY_ENGINE
+
+    Full class name of the delivery engine used by
+    :class:`durian.tasks.WebhookBatch`, e.g.
+    ``"durian.engine.MultiplexEngine"``. If not set, each URL in a batch
+    is delivered by running the hooks delivery task.
+
+"""
+DELIVERY_ENGINE = getattr(settings, "DURIAN_DELIVERY_ENGINE",
+                          DEFAULT_DELIVERY_ENGINE)
+
+"""
+.. data:: DELIVERY_CONCURRENCY
+
+    Maximum number of requests the delivery engine keeps in flight at
+    the same time. The default depends on the engine.
+
+"""
+DELIVERY_CONCURRENCY = getattr(settings, "DURIAN_DELIVERY_CONCURRENCY",
+                               DEFAULT_DELIVERY_CONCURRENCY)
+
+"""
+.. data:: PAYLOAD_ENCODER
+
+    Full name of the function used to encode payloads, e.g.
+    ``"cjson.encode"`` for a faster C implementation. The default
+    encodes JSON with support for dates and decimals.
+
+"""
+PAYLOAD_ENCODER = getattr(settings, "DURIAN_PAYLOAD_ENCODER",
+                          DEFAULT_PAYLOAD_ENCODER)
+
+"""
+.. data:: PAYLOAD_DECODER
+
+    Full name of the function used to decode payloads
+    encoded with :data:`PAYLOAD_ENCODER`.
+
+"""
+PAYLOAD_DECODER = getattr(settings, "DURIAN_PAYLOAD_DECODER",
+                          DEFAULT_PAYLOAD_DECODER)
+
+"""
+.. data:: PAYLOAD_STORE
+
+    Full class name of the payload store used by hooks that doesn't set
+    :attr:`durian.event.Hook.payload_store`. One of
+    ``"durian.store.CacheStore"``, ``"durian.store.DatabaseStore"`` or
+    ``"durian.store.FileStore"``. By default payloads are not stored, but
+    sent in the task messages.
+
+"""
+PAYLOAD_STORE = getattr(settings, "DURIAN_PAYLOAD_STORE",
+                        DEFAULT_PAYLOAD_STORE)
+
+"""
+.. data:: PAYLOAD_STORE_TIMEOUT
+
+    Number of seconds a payload is kept in the payload store, even if
+    there are deliveries still using it.
+
+"""
+PAYLOAD_STORE_TIMEOUT = getattr(settings, "DURIAN_PAYLOAD_STORE_TIMEOUT",
+                                DEFAULT_PAYLOAD_STORE_TIMEOUT)
+
+"""
+.. data:: PAYLOAD_STORE_DIR
+
+    The directory used by :class:`durian.store.FileStore`.
+
+"""
+PAYLOAD_STORE_DIR = getattr(settings, "DURIAN_PAYLOAD_STORE_DIR",
+                            DEFAULT_PAYLOAD_STORE_DIR)
+
+"""
+.. data:: PAYLOAD_CACHE_SIZE
+
+    Maximum number of payloads fetched from the payload store to keep
+    in memory in each process.
+
+"""
+PAYLOAD_CACHE_SIZE = getattr(settings, "DURIAN_PAYLOAD_CACHE_SIZE",
+                             DEFAULT_PAYLOAD_CACHE_SIZE)
+
+"""
+.. data:: RETRY_DELAY
+
+    Number of seconds to wait before the first retry of a failed
+    delivery, see :func:`durian.tasks.backoff`.
+
+"""
+RETRY_DELAY = getattr(settings, "DURIAN_RETRY_DELAY", DEFAULT_RETRY_DELAY)
+
+"""
+.. data:: RETRY_BACKOFF
+
+    The retry delay is multiplied by this for every retry.
+
+"""
+RETRY_BACKOFF = getattr(settings, "DURIAN_RETRY_BACKOFF",
+                        DEFAULT_RETRY_BACKOFF)
+
+"""
+.. data:: RETRY_MAX_DELAY
+
+    The maximum number of seconds to wait before a retry.
+
+"""
+RETRY_MAX_DELAY = getattr(settings, "DURIAN_RETRY_MAX_DELAY",
+                          DEFAULT_RETRY_MAX_DELAY)
+
+"""
+.. data:: CIRCUIT_BREAKER
+
+    If ``True``, deliveries to a listener host are suspended when most
+    of the recent deliveries to it have failed, see :mod:`durian.breaker`.
+    Can be changed for each hook with
+    :attr:`durian.event.Hook.circuit_breaker`. Default is ``False``.
+
+"""
+CIRCUIT_BREAKER = getattr(settings, "DURIAN_CIRCUIT_BREAKER",
+                          DEFAULT_CIRCUIT_BREAKER)
+
+"""
+.. data:: CIRCUIT_BACKEND
+
+    Full class name of the backend keeping the circuit breaker state,
+    e.g. ``"durian.breaker.LocalBackend"``. By default the Django cache is
+    used, so the state is shared by all processes using the same cache.
+
+"""
+CIRCUIT_BACKEND = getattr(settings, "DURIAN_CIRCUIT_BACKEND",
+                          DEFAULT_CIRCUIT_BACKEND)
+
+"""
+.. data:: CIRCUIT_FAILURE_RATE
+
+    The ratio of failed deliveries to a host that opens the circuit.
+
+"""
+CIRCUIT_FAILURE_RATE = getattr(settings, "DURIAN_CIRCUIT_FAILURE_RATE",
+                               DEFAULT_CIRCUIT_FAILURE_RATE)
+
+"""
+.. data:: CIRCUIT_MIN_REQUESTS
+
+    The minimum number of recent deliveries to a host before the circuit
+    can open.
+
+"""
+CIRCUIT_MIN_REQUESTS = getattr(settings, "DURIAN_CIRCUIT_MIN_REQUESTS",
+                               DEFAULT_CIRCUIT_MIN_REQUESTS)
+
+"""
+.. data:: CIRCUIT_WINDOW
+
+    Deliveries are counted in windows of this many seconds.
+
+"""
+CIRCUIT_WINDOW = getattr(settings, "DURIAN_CIRCUIT_WINDOW",
+                         DEFAULT_CIRCUIT_WINDOW)
+
+"""
+.. data:: CIRCUIT_RESET_TIMEOUT
+
+    Number of seconds an open circuit waits before letting a probe
+    delivery through.
+
+"""
+CIRCUIT_RESET_TIMEOUT = getattr(settings, "DURIAN_CIRCUIT_RESET_TIMEOUT",
+                                DEFAULT_CIRCUIT_RESET_TIMEOUT)
+
+"""
+.. data:: RATE_LIMIT_BACKEND
+
+    Full class name of the backend keeping the per host rate limit
+    buckets and in-flight counters, e.g. ``"durian.breaker.LocalBackend"``.
+    By default the Django cache is used, so the limits are enforced across
+    all processes using the same cache.
+
+"""
+RATE_LIMIT_BACKEND = getattr(settings, "DURIAN_RATE_LIMIT_BACKEND",
+                             DEFAULT_RATE_LIMIT_BACKEND)
+
+"""
+.. data:: RATE_LIMIT_DELAY
+
+    Number of seconds a delivery is delayed when the host already has
+    the maximum number of requests in flight.
+
+"""
+RATE_LIMIT_DELAY = getattr(settings, "DURIAN_RATE_LIMIT_DELAY",
+                           DEFAULT_RATE_LIMIT_DELAY)
+
+"""
+.. data:: RATE_LIMIT_IN_FLIGHT_TIMEOUT
+
+    The in-flight counters expire after this many seconds, in case a
+    worker is killed in the middle of a request.
+
+"""
+RATE_LIMIT_IN_FLIGHT_TIMEOUT = getattr(settings,
+                                       "DURIAN_RATE_LIMIT_IN_FLIGHT_TIMEOUT",
+                                       DEFAULT_RATE_LIMIT_IN_FLIGHT_TIMEOUT)
+
+"""
+.. data:: RATE_LIMIT_MAX_DEFERRALS
+
+    Maximum number of times a rate limited delivery applied locally
+    (i.e. by a hook that isn't :attr:`~durian.event.Hook.async`) waits
+    for the host to get below its limits, before failing with
+    :exc:`durian.ratelimit.RateLimited`. Deliveries sent to the workers
+    are deferred for as long as needed.
+
+"""
+RATE_LIMIT_MAX_DEFERRALS = getattr(settings,
+                                   "DURIAN_RATE_LIMIT_MAX_DEFERRALS",
+                                   DEFAULT_RATE_LIMIT_MAX_DEFERRALS)
+
+"""
+.. data:: DEAD_LETTER
+
+    If ``True``, deliveries that still fail after all the retries are
+    stored in the dead letter table, so they can be replayed later (see
+    :mod:`durian.deadletter`). Only hooks retrying failed deliveries store
+    dead letters. Can be changed for each hook with
+    :attr:`durian.event.Hook.dead_letter`. Default is ``False``.
+
+"""
+DEAD_LETTER = getattr(settings, "DURIAN_DEAD_LETTER", DEFAULT_DEAD_LETTER)
+
+"""
+.. data:: OUTBOX
+
+    If ``True``, :meth:`durian.event.Hook.send` only stores the event in
+    the outbox table, in the current database transaction, and the
+    events are dispatched later by :func:`durian.outbox.drain_outbox`.
+    Default is ``False``.
+
+"""
+OUTBOX = getattr(settings, "DURIAN_OUTBOX", DEFAULT_OUTBOX)
+
+"""
+.. data:: OUTBOX_LEASE
+
+    Number of seconds outbox events claimed by a drainer are reserved
+    for it. If the drainer dies before the events are dispatched, they
+    are claimed by another drainer after this time.
+
+"""
+OUTBOX_LEASE = getattr(settings, "DURIAN_OUTBOX_LEASE", DEFAULT_OUTBOX_LEASE)
@@ -0,0 +1,153 @@
+"""durian.deadletter
+
+Deliveries that still fail after all their retries are stored in the
+:class:`durian.models.DeadLetter` table, together with the encoded
+payload (stored once per unique payload in
+:class:`durian.models.DeadLetterPayload`), the last error and the number
+of attempts made.
+
+When the listener has fixed their endpoint, the dead letters can be
+replayed with :func:`replay_dead_letters`, or the
+``durian_replay_dead_letters`` management command.
+
+"""
+from durian.payload import payload_body, decode_payload
+from durian.registry import hooks
+from durian.store import PayloadMissing
+from datetime import datetime, timedelta
+import hashlib
+import time
+
+"""
+.. data:: PAYLOAD_GRACE
+
+    Number of seconds an unused payload is kept, as it may be about to
+    be used by a dead letter being recorded.
+
+"""
+PAYLOAD_GRACE = 60 * 60
+
+
+def record_dead_letter(hook_name, url, payload, exc, attempts=1):
+    """Store a failed delivery in the dead letter table.
+
+    :param hook_name: Name of the hook the event was sent by.
+    :param url: The listener URL.
+    :param payload: The payload (or :class:`durian.store.PayloadReference`)
+        that couldn't be delivered.
+    :param exc: The last error.
+    :keyword attempts: The number of delivery attempts made.
+
+    :returns: :class:`durian.models.DeadLetter`.
+
+    """
+    from durian.models import Listener, DeadLetter, DeadLetterPayload
+    try:
+        body = payload_body(payload)
+    except PayloadMissing:
+        stored = None
+    else:
+        stored = store_payload(hashlib.sha1(body).hexdigest(), body)
+    listeners = Listener.objects.filter(hook=hook_name or "", url=url)
+    listener = (listeners[:1] or [None])[0]
+    return DeadLetter.objects.create(listener=listener, hook=hook_name or "",
+                                     url=url, payload=stored,
+                                     error=unicode(exc)[:1000],
+                                     attempts=attempts)
+
+
+def store_payload(digest, body):
+    """Get or create the :class:`durian.models.DeadLetterPayload` for a
+    body, and mark it as used now so :func:`delete_unused_payloads`
+    leaves it alone."""
+    from durian.models import DeadLetterPayload
+    while True:
+        stored, created = DeadLetterPayload.objects.get_or_create(
+                                digest=digest, defaults={"body": body})
+        if created or DeadLetterPayload.objects.filter(pk=stored.pk).update(
+                                last_used=datetime.now()):
+            return stored
+        # Deleted as unused in the meantime.
+
+
+def delete_unused_payloads(grace=None):
+    """Delete the payloads no dead letters are using, unless they were
+    used in the last ``grace`` seconds (default is
+    :data:`PAYLOAD_GRACE`)."""
+    from durian.models import DeadLetterPayload
+    grace = PAYLOAD_GRACE if grace is None else grace
+    DeadLetterPayload.objects.filter(dead_letters__isnull=True,
+            last_used__lt=datetime.now() - timedelta(seconds=grace)).delete()
+
+
+def replay_batch(hook_name, urls, payload):
+    """Deliver a payload to a batch of URLs, with the delivery settings
+    of the hook (if it's registered).
+
+    :returns: The result of the :class:`durian.tasks.WebhookBatch` task.
+
+    """
+    from durian.tasks import WebhookBatch
+    hook = hooks.get(hook_name)
+    if hook is None:
+        return WebhookBatch.apply_async(args=[urls, payload])
+    kwargs = dict(hook.task_keywords, delivery_task=hook.task_cls.name)
+    if hook.delivery_engine:
+        kwargs["delivery_engine"] = hook.delivery_engine
+        kwargs["delivery_concurrency"] = hook.delivery_concurrency
+    applier = WebhookBatch.apply_async if hook.async else WebhookBatch.apply
+    return applier(args=[urls, payload], kwargs=kwargs)
+
+
+def replay_dead_letters(dead_letters=None, batch_size=1000, rate=None):
+    """Replay dead letters.
+
+    The dead letters are fetched ``batch_size`` at a time, and the
+    dead letters in a batch with the same hook and payload are sent as a
+    single :class:`durian.tasks.WebhookBatch` task. Replayed dead letters
+    are deleted; if the delivery fails again a new dead letter is stored.
+
+    :keyword dead_letters: A :class:`durian.models.DeadLetter` queryset
+        to replay. Default is to replay all of them.
+    :keyword batch_size: Number of dead letters to fetch at a time.
+    :keyword rate: Maximum number of dead letters to replay per second.
+
+    :returns: The number of dead letters replayed.
+
+    """
+    from durian.models import DeadLetter
+    if dead_letters is None:
+        dead_letters = DeadLetter.objects.all()
+    dead_letters = dead_letters.exclude(payload=None).order_by("pk")
+    # Dead letters stored by the replay itself are left for next time.
+    last_pks = dead_letters.reverse().values_list("pk", flat=True)[:1]
+    if not last_pks:
+        return 0
+    dead_letters = dead_letters.filter(pk__lte=last_pks[0])
+
+    replayed = 0
+    last_pk = 0
+    while True:
+        time_start = time.time()
+        batch = list(dead_letters.filter(pk__gt=last_pk)
+                                 .select_related("payload")[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        groups = {}
+        for dead_letter in batch:
+            key = (dead_letter.hook, dead_letter.payload_id)
+            groups.setdefault(key, []).append(dead_letter)
+        for (hook_name, payload_id), group in groups.items():
+            payload = decode_payload(group[0].payload.body)
+            replay_batch(hook_name, [dead_letter.url
+                                        for dead_letter in group], payload)
+            DeadLetter.objects.filter(pk__in=[dead_letter.pk
+                                        for dead_letter in group]).delete()
+        replayed += len(batch)
+        if rate:
+            remaining = len(batch) / float(rate) - (time.time() - time_start)
+            if remaining > 0:
+                time.sleep(remaining)
+    delete_unused_payloads()
+    return replayed
@@ -0,0 +1,293 @@
+"""durian.engine"""
+from durian import conf
+from durian.connection import connections, url_headers
+from durian.connection import DEFAULT_HEADERS, DEFAULT_PORTS
+from durian.utils import get_cls_by_name
+from collections import deque
+from urlparse import urlsplit
+import urllib2
+import socket
+import select
+import errno
+import time
+import ssl
+
+WANT_READ = "read"
+WANT_WRITE = "write"
+
+
+class BaseEngine(object):
+    """Base class for delivery engines.
+
+    A delivery engine POSTs the same encoded payload to a list of URLs.
+
+    :keyword concurrency: See :attr:`concurrency`.
+
+    .. attribute:: concurrency
+
+        The maximum number of requests in flight at the same time.
+
+    """
+    concurrency = 1
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or self.concurrency
+
+    def deliver(self, urls, body, timeout=None, headers=None):
+        """POST ``body`` to all the URLs.
+
+        :keyword timeout: Timeout in seconds for each request.
+        :keyword headers: Additional HTTP headers.
+
+        :returns: A list with the error for each URL, in the same order
+            as ``urls``. The error is ``None`` if the delivery succeeded,
+            otherwise a :exc:`urllib2.URLError` (or
+            :exc:`urllib2.HTTPError`) instance.
+
+        """
+        raise NotImplementedError("Engines must implement deliver")
+
+
+class SerialEngine(BaseEngine):
+    """Deliver one URL at a time, using the keep-alive connections
+    in :data:`durian.connection.connections`."""
+
+    def deliver(self, urls, body, timeout=None, headers=None):
+        errors = []
+        for url in urls:
+            try:
+                connections.post(url, body, timeout=timeout, headers=headers)
+            except urllib2.URLError, exc:
+                errors.append(exc)
+            else:
+                errors.append(None)
+        return errors
+
+
+def wrap_socket(sock, hostname):
+    """Wrap a connected socket in SSL, verifying the host certificate
+    if the :mod:`ssl` module supports it."""
+    if hasattr(ssl, "create_default_context"):
+        context = ssl.create_default_context()
+        return context.wrap_socket(sock, server_hostname=hostname,
+                                   do_handshake_on_connect=False)
+    return ssl.wrap_socket(sock, do_handshake_on_connect=False)
+
+
+class Request(object):
+    """A single non-blocking HTTP POST request, driven by
+    :class:`MultiplexEngine`."""
+
+    def __init__(self, url, body, headers=None, timeout=None):
+        self.url = url
+        parts = urlsplit(url)
+        if parts.scheme not in DEFAULT_PORTS:
+            raise urllib2.URLError("Unsupported URL scheme: %s" % url)
+        self.secure = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or DEFAULT_PORTS[parts.scheme]
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        request_headers = dict(DEFAULT_HEADERS, Connection="close",
+                               **url_headers(parts))
+        request_headers["Content-Length"] = str(len(body))
+        request_headers.update(headers or {})
+        self.outgoing = "".join(["POST %s HTTP/1.1\r\n" % path] +
+                                ["%s: %s\r\n" % header
+                                    for header in request_headers.items()] +
+                                ["\r\n", body])
+        self.incoming = []
+        self.deadline = timeout is not None and time.time() + timeout
+        self.sock = None
+        self.want = WANT_WRITE
+        self.connected = False
+        self.handshaking = False
+        self.done = False
+        self.error = None
+
+    def start(self):
+        """Start connecting to the host."""
+        family, socktype, proto, _, address = socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, errno.errorcode.get(err, err))
+
+    def step(self):
+        """Make progress when the socket is ready."""
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, errno.errorcode.get(err, err))
+            self.connected = True
+            if self.secure:
+                self.sock = wrap_socket(self.sock, self.host)
+                self.handshaking = True
+        try:
+            if self.secure and self.handshaking:
+                self.sock.do_handshake()
+                self.handshaking = False
+            if self.outgoing:
+                sent = self.sock.send(self.outgoing)
+                self.outgoing = self.outgoing[sent:]
+                self.want = self.outgoing and WANT_WRITE or WANT_READ
+            else:
+                self.receive()
+        except ssl.SSLError, exc:
+            if exc.args[0] == ssl.SSL_ERROR_WANT_READ:
+                self.want = WANT_READ
+            elif exc.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                self.want = WANT_WRITE
+            else:
+                raise
+
+    def receive(self):
+        while True:
+            data = self.sock.recv(8192)
+            if not data:
+                return self.finish()
+            self.incoming.append(data)
+            if self.complete():
+                return self.finish()
+            if not self.secure or not self.sock.pending():
+                return
+
+    def complete(self):
+        """Check if the full response has been received, so we don't have
+        to wait for the server to close the connection."""
+        response = "".join(self.incoming)
+        head, sep, body = response.partition("\r\n\r\n")
+        if not sep:
+            return False
+        for line in head.split("\r\n")[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                return len(body) >= int(value.strip() or 0)
+        return False
+
+    def finish(self):
+        self.done = True
+        status_line = "".join(self.incoming).split("\r\n", 1)[0]
+        try:
+            _, status, reason = (status_line.split(None, 2) + [""])[:3]
+            status = int(status)
+        except ValueError:
+            self.error = urllib2.URLError(
+                    "Bad status line: %r" % status_line)
+            return
+        if status >= 400:
+            self.error = urllib2.HTTPError(self.url, status, reason,
+                                           None, None)
+
+    def fail(self, exc):
+        self.done = True
+        self.error = urllib2.URLError(exc)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+class MultiplexEngine(BaseEngine):
+    """Deliver to many URLs concurrently from a single thread.
+
+    Up to :attr:`concurrency` requests are kept in flight at the same
+    time, multiplexed over non-blocking sockets using :func:`select.select`
+    so a slow listener doesn't hold up the rest of the batch.
+
+    The connections are closed after each request, and host names are
+    resolved synchronously.
+
+    """
+    concurrency = 100
+
+    def deliver(self, urls, body, timeout=None, headers=None):
+        errors = [None] * len(urls)
+        pending = deque(enumerate(urls))
+        active = {}
+
+        while pending or active:
+            while pending and len(active) < self.concurrency:
+                position, url = pending.popleft()
+                request = None
+                try:
+                    request = Request(url, body, headers, timeout)
+                    request.start()
+                except (urllib2.URLError, socket.error), exc:
+                    if request is not None:
+                        request.close()
+                    if not isinstance(exc, urllib2.URLError):
+                        exc = urllib2.URLError(exc)
+                    errors[position] = exc
+                else:
+                    active[request.fileno()] = (position, request)
+            if not active:
+                break
+
+            readers = [fd for fd, (_, request) in active.items()
+                            if request.want == WANT_READ]
+            writers = [fd for fd, (_, request) in active.items()
+                            if request.want == WANT_WRITE]
+            deadlines = [request.deadline for _, request in active.values()
+                            if request.deadline]
+            wait = None
+            if deadlines:
+                wait = max(min(deadlines) - time.time(), 0)
+            try:
+                readable, writable, _ = select.select(readers, writers, [],
+                                                      wait)
+            except select.error, exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd in readable + writable:
+                position, request = active[fd]
+                try:
+                    request.step()
+                except (socket.error, ssl.SSLError), exc:
+                    request.fail(exc)
+
+            now = time.time()
+            for fd, (position, request) in active.items():
+                if not request.done and request.deadline and \
+                        request.deadline <= now:
+                    request.fail(socket.timeout("timed out"))
+                if request.done:
+                    request.close()
+                    errors[position] = request.error
+                    del(active[fd])
+        return errors
+
+
+_engines = {}
+
+
+def get_engine(name=None, concurrency=None):
+    """Get a delivery engine by class name.
+
+    Engines are kept for reuse, so there's only one engine per process
+    for each class name and concurrency limit.
+
+    :keyword name: Full class name of the engine. Defaults to the
+        ``DURIAN_DELIVERY_ENGINE`` setting.
+    :keyword concurrency: The concurrency limit of the engine. Defaults
+        to the ``DURIAN_DELIVERY_CONCURRENCY`` setting.
+
+    :returns: The engine, or ``None`` if no engine is configured.
+
+    """
+    name = name or conf.DELIVERY_ENGINE
+    if not name:
+        return None
+    concurrency = concurrency or conf.DELIVERY_CONCURRENCY
+    key = (name, concurrency)
+    if key not in _engines:
+        _engines[key] = get_cls_by_name(name)(concurrency=concurrency)
+    return _engines[key]
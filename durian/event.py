@@ -1,10 +1,33 @@
 from durian.models import Listener
-from celery.utils import get_full_cls_name, gen_unique_id
-from durian.tasks import WebhookSignal
+from durian.cache import listeners as listener_cache
+from durian.applier import LocalApplier, get_pool
+from durian.payload import encode_payload
+from durian.store import store_payload
+from durian.ratelimit import listener_limits
+from durian.outbox import add_to_outbox
+from durian import coalesce as coalescer
+from durian import conf
+from celery.utils import get_full_cls_name, gen_unique_id, chunks
+from durian.tasks import WebhookSignal, WebhookFanout, WebhookBatch
 from durian.forms import HookConfigForm, create_match_forms
 from durian.match.strategy import deepmatch
+from durian.match.batch import match_matrix, matching_listeners
+from durian.match.stats import MatchStats
 from durian.match import mtuplelist_to_matchdict
+from django.core.signals import request_started
+from django.db import models
+from django.db.models import signals
 from functools import partial as curry
+import operator
+import copy
+
+
+# Lazily connected signal hooks waiting for listeners: hook -> senders.
+_pending_connects = {}
+
+
+def _getattr_or_none(obj, name):
+    return getattr(obj, name, None)
 
 
 class Hook(object):
@@ -17,9 +40,28 @@ class Hook(object):
     :keyword async: See :attr:`async`.
     :keyword retry: See :attr:`retry`.
     :keyword max_retries: See :attr:`max_retries`.
+    :keyword retry_delay: See :attr:`retry_delay`.
+    :keyword retry_backoff: See :attr:`retry_backoff`.
+    :keyword retry_max_delay: See :attr:`retry_max_delay`.
+    :keyword retry_jitter: See :attr:`retry_jitter`.
     :keyword fail_silently: See :attr:`fail_silently`.
     :keyword task_cls: See :attr:`task_cls`.
     :keyword match_forms: See :attr:`match_forms`
+    :keyword fanout: See :attr:`fanout`.
+    :keyword fanout_batch_size: See :attr:`fanout_batch_size`.
+    :keyword delivery_engine: See :attr:`delivery_engine`.
+    :keyword delivery_concurrency: See :attr:`delivery_concurrency`.
+    :keyword local_concurrency: See :attr:`local_concurrency`.
+    :keyword local_wait: See :attr:`local_wait`.
+    :keyword payload_store: See :attr:`payload_store`.
+    :keyword prefilter: See :attr:`prefilter`.
+    :keyword reorder_conditions: See :attr:`reorder_conditions`.
+    :keyword circuit_breaker: See :attr:`circuit_breaker`.
+    :keyword rate_limit: See :attr:`rate_limit`.
+    :keyword rate_limit_burst: See :attr:`rate_limit_burst`.
+    :keyword max_in_flight: See :attr:`max_in_flight`.
+    :keyword dead_letter: See :attr:`dead_letter`.
+    :keyword outbox: See :attr:`outbox`.
 
     .. attribute:: name
 
@@ -59,6 +101,27 @@ class Hook(object):
 
         Maximum number of retries before we give up.
 
+    .. attribute:: retry_delay
+
+        Number of seconds to wait before the first retry. Defaults to
+        the ``DURIAN_RETRY_DELAY`` setting.
+
+    .. attribute:: retry_backoff
+
+        The delay is multiplied by this for every retry. Defaults to the
+        ``DURIAN_RETRY_BACKOFF`` setting.
+
+    .. attribute:: retry_max_delay
+
+        The maximum number of seconds to wait before a retry. Defaults to
+        the ``DURIAN_RETRY_MAX_DELAY`` setting.
+
+    .. attribute:: retry_jitter
+
+        If ``True`` (the default), a random delay between zero and the
+        computed delay is used ("full jitter"), so the retries after an
+        outage are spread out. See :func:`durian.tasks.backoff`.
+
     .. attribute:: fail_silently
 
         Fail silently if the dispatch gives an HTTP error.
@@ -73,6 +136,117 @@ class Hook(object):
         A list of forms to create an event filter. This is automatically
         generated based on the :attr:`provides_args` attribute.
 
+    .. attribute:: fanout
+
+        If ``True``, an event is dispatched as a single
+        :class:`durian.tasks.WebhookFanout` message carrying the payload
+        and the ids of all the matching listeners, instead of one
+        :attr:`task_cls` message per listener. The worker splits the
+        listeners into batches of :attr:`fanout_batch_size`.
+
+    .. attribute:: fanout_batch_size
+
+        The maximum number of listeners delivered to by a single
+        :class:`durian.tasks.WebhookBatch` task.
+
+    .. attribute:: delivery_engine
+
+        Full class name of the engine used to deliver the events, e.g.
+        ``"durian.engine.MultiplexEngine"`` to have hundreds of requests
+        in flight from one worker. Defaults to the
+        ``DURIAN_DELIVERY_ENGINE`` setting.
+
+        If :attr:`fanout` is enabled the engine delivers each batch,
+        otherwise all the listeners of an event are delivered by the
+        engine in a single :class:`durian.tasks.WebhookBatch` task.
+
+    .. attribute:: delivery_concurrency
+
+        Maximum number of requests in flight in the :attr:`delivery_engine`.
+        Defaults to the ``DURIAN_DELIVERY_CONCURRENCY`` setting.
+
+    .. attribute:: local_concurrency
+
+        If :attr:`async` is ``False`` and this is set, the tasks are
+        applied in a pool of this many threads, so the listeners are
+        dispatched to in parallel instead of one after another.
+
+    .. attribute:: local_wait
+
+        If ``True`` (the default), :meth:`send` waits for all the tasks
+        applied in the :attr:`local_concurrency` thread pool to finish, and
+        returns their results. Otherwise it returns at once with a list of
+        :class:`durian.applier.LocalResult` instances.
+
+    .. attribute:: payload_store
+
+        Full class name of a payload store, e.g.
+        ``"durian.store.CacheStore"``. If set, the encoded payload is put
+        in the store, and the task messages only carry a
+        :class:`durian.store.PayloadReference` to it. Defaults to the
+        ``DURIAN_PAYLOAD_STORE`` setting.
+
+    .. attribute:: prefilter
+
+        If ``True``, the candidate listeners for an event are looked up
+        in the database by their exact conditions (see
+        :meth:`durian.models.ListenerManager.candidates`), instead of
+        loading all the listeners of the hook into the process local
+        cache. Useful for hooks with a very large number of listeners.
+
+    .. attribute:: reorder_conditions
+
+        If ``True``, the conditions of the listeners are tested in order
+        of how cheap and selective they have been for this hook, instead
+        of in the order of the match dicts. See :attr:`match_stats`.
+
+    .. attribute:: match_stats
+
+        The :class:`durian.match.stats.MatchStats` kept for the hook
+        when :attr:`reorder_conditions` is enabled. Its
+        :attr:`~durian.match.stats.MatchStats.stats` can be used to see
+        how the conditions perform.
+
+    .. attribute:: circuit_breaker
+
+        If ``True``, deliveries to listener hosts that are down are
+        suspended by the circuit breaker (see :mod:`durian.breaker`).
+        Defaults to the ``DURIAN_CIRCUIT_BREAKER`` setting.
+
+    .. attribute:: rate_limit
+
+        Maximum rate of deliveries to each listener host, shared by all
+        workers. Either a number of requests per second, or a string like
+        ``"100/m"``. Deliveries over the limit are delayed, see
+        :mod:`durian.ratelimit`. A listener can override it with the
+        ``rate_limit`` key in its :attr:`durian.models.Listener.config`.
+
+    .. attribute:: rate_limit_burst
+
+        Number of deliveries to a host that can be made at once, before
+        the :attr:`rate_limit` kicks in. Defaults to one second worth of
+        deliveries. Can be overridden by the listener config.
+
+    .. attribute:: max_in_flight
+
+        Maximum number of deliveries in progress to each listener host,
+        shared by all workers. Can be overridden by the listener config.
+
+    .. attribute:: dead_letter
+
+        If ``True``, deliveries that still fail after all the retries are
+        stored in the dead letter table, so they can be replayed later
+        (see :mod:`durian.deadletter`). Only used if :attr:`retry` is
+        enabled. Defaults to the ``DURIAN_DEAD_LETTER`` setting.
+
+    .. attribute:: outbox
+
+        If ``True``, :meth:`send` only stores the event in the outbox
+        table, as part of the current database transaction, and the event
+        is dispatched later by :func:`durian.outbox.drain_outbox`. The
+        sender of the signal is not available to :meth:`event_filter` for
+        these events. Defaults to the ``DURIAN_OUTBOX`` setting.
+
     """
 
     name = None
@@ -82,15 +256,42 @@ class Hook(object):
     async = True
     retry = False
     max_retries = 3
+    retry_delay = None
+    retry_backoff = None
+    retry_max_delay = None
+    retry_jitter = True
     fail_silently = False
     config_form = HookConfigForm
     provides_args = set()
     match_forms = None
+    fanout = False
+    fanout_batch_size = 100
+    delivery_engine = None
+    delivery_concurrency = None
+    local_concurrency = None
+    local_wait = True
+    payload_store = None
+    prefilter = False
+    reorder_conditions = False
+    circuit_breaker = None
+    rate_limit = None
+    rate_limit_burst = None
+    max_in_flight = None
+    dead_letter = None
+    outbox = None
 
     def __init__(self, name=None, verbose_name=None, task_cls=None,
             timeout=None, async=None, retry=None, max_retries=None,
+            retry_delay=None, retry_backoff=None, retry_max_delay=None,
+            retry_jitter=None,
             fail_silently=False, config_form=None, provides_args=None,
-            match_forms=None, **kwargs):
+            match_forms=None, fanout=None, fanout_batch_size=None,
+            delivery_engine=None, delivery_concurrency=None,
+            local_concurrency=None, local_wait=None, payload_store=None,
+            prefilter=None, reorder_conditions=None,
+            circuit_breaker=None, rate_limit=None,
+            rate_limit_burst=None, max_in_flight=None, dead_letter=None,
+            outbox=None, **kwargs):
         self.name = name or self.name or get_full_cls_name(self.__class__)
         self.verbose_name = verbose_name or self.verbose_name or self.name
         self.task_cls = task_cls or self.task_cls
@@ -102,9 +303,56 @@ class Hook(object):
             self.retry = retry
         if max_retries is not None:
             self.max_retries = max_retries
+        if retry_delay is not None:
+            self.retry_delay = retry_delay
+        if self.retry_delay is None:
+            self.retry_delay = conf.RETRY_DELAY
+        if retry_backoff is not None:
+            self.retry_backoff = retry_backoff
+        if self.retry_backoff is None:
+            self.retry_backoff = conf.RETRY_BACKOFF
+        if retry_max_delay is not None:
+            self.retry_max_delay = retry_max_delay
+        if self.retry_max_delay is None:
+            self.retry_max_delay = conf.RETRY_MAX_DELAY
+        if retry_jitter is not None:
+            self.retry_jitter = retry_jitter
         if fail_silently is not None:
             self.fail_silently = fail_silently
-        self.provides_args = set(provides_args) or self.provides_args
+        if fanout is not None:
+            self.fanout = fanout
+        if fanout_batch_size is not None:
+            self.fanout_batch_size = fanout_batch_size
+        self.delivery_engine = delivery_engine or self.delivery_engine or \
+                                    conf.DELIVERY_ENGINE
+        self.delivery_concurrency = delivery_concurrency or \
+                                        self.delivery_concurrency
+        self.local_concurrency = local_concurrency or self.local_concurrency
+        if local_wait is not None:
+            self.local_wait = local_wait
+        self.payload_store = payload_store or self.payload_store or \
+                                conf.PAYLOAD_STORE
+        if prefilter is not None:
+            self.prefilter = prefilter
+        if reorder_conditions is not None:
+            self.reorder_conditions = reorder_conditions
+        self.match_stats = MatchStats()
+        if circuit_breaker is not None:
+            self.circuit_breaker = circuit_breaker
+        if self.circuit_breaker is None:
+            self.circuit_breaker = conf.CIRCUIT_BREAKER
+        self.rate_limit = rate_limit or self.rate_limit
+        self.rate_limit_burst = rate_limit_burst or self.rate_limit_burst
+        self.max_in_flight = max_in_flight or self.max_in_flight
+        if dead_letter is not None:
+            self.dead_letter = dead_letter
+        if self.dead_letter is None:
+            self.dead_letter = conf.DEAD_LETTER
+        if outbox is not None:
+            self.outbox = outbox
+        if self.outbox is None:
+            self.outbox = conf.OUTBOX
+        self.provides_args = set(provides_args or ()) or self.provides_args
         self.config_form = config_form or self.config_form
         form_name = "%sConfigForm" % self.name.capitalize()
         self.match_forms = match_forms or self.match_forms or \
@@ -120,14 +368,109 @@ class Hook(object):
             described in :attr:`provides_args` and any additional keys you'd
             want to provide.
 
+        :returns: The results of :meth:`dispatch`, or an empty list if
+            the event was stored in the outbox (see :attr:`outbox`).
+
+        Nothing is done, not even preparing the payload, if the hook
+        has no listeners (see :meth:`has_listeners`).
+
         """
+        if not self.has_listeners():
+            return []
         payload = self.prepare_payload(sender, payload)
-        apply_ = curry(self._send_signal, sender, payload)
-        return map(apply_, self.get_listeners(sender, payload))
+        return self.send_prepared(sender, payload)
+
+    def has_listeners(self):
+        """Returns ``True`` if anyone is listening to this hook.
+
+        The number of listeners is cached in the process, and only
+        counted again when the listeners for the hook are changed (see
+        :meth:`durian.cache.ListenerCache.count`). Always ``True`` if
+        the listener cache isn't shared between processes (see
+        :meth:`durian.cache.ListenerCache.has_listeners`).
+
+        """
+        return listener_cache.has_listeners(self.name)
+
+    def send_prepared(self, sender, payload):
+        """Send a payload already prepared by :meth:`prepare_payload`.
+
+        See :meth:`send`.
+
+        """
+        if self.outbox:
+            add_to_outbox(self.name, payload)
+            return []
+        return self.dispatch(sender, payload)
+
+    def dispatch(self, sender, payload):
+        """Dispatch a prepared payload to all the listeners that wants
+        it.
+
+        :param sender: The sender of the signal, or ``None``.
+        :param payload: The payload, as returned by
+            :meth:`prepare_payload`.
+
+        """
+        return self.dispatch_to(sender, payload,
+                                self.get_listeners(sender, payload))
+
+    def dispatch_to(self, sender, payload, targets, fanout=None):
+        """Dispatch a prepared payload to a list of listeners.
+
+        :keyword fanout: Override :attr:`fanout`.
+
+        """
+        if not targets:
+            return []
+        if fanout is None:
+            fanout = self.fanout
+        # Encode once, and use the same body for all the listeners.
+        payload = self.encode_payload(payload)
+        if self.payload_store:
+            # Each listener releases its reference when delivered.
+            payload = store_payload(payload, self.payload_store,
+                                    refs=len(targets))
+        if fanout:
+            results = targets and [self._send_fanout(sender, payload,
+                                                     targets)]
+        elif self.delivery_engine:
+            results = [self._send_batch(sender, payload, targets)]
+        else:
+            apply_ = curry(self._send_signal, sender, payload)
+            results = map(apply_, targets)
+        if self.local_concurrency and not self.async and self.local_wait:
+            return [result.wait() for result in results]
+        return results
 
     def _send_signal(self, sender, payload, target):
         applier = self.get_applier()
-        return applier(args=[target.url, payload], kwargs=self.task_keywords)
+        kwargs = dict(self.task_keywords, **listener_limits(target.config))
+        return applier(args=[target.url, payload], kwargs=kwargs)
+
+    def _send_fanout(self, sender, payload, targets):
+        applier = self.get_applier(task_cls=WebhookFanout)
+        kwargs = dict(self._batch_keywords(targets),
+                      batch_size=self.fanout_batch_size)
+        return applier(args=[[target.pk for target in targets], payload],
+                       kwargs=kwargs)
+
+    def _send_batch(self, sender, payload, targets):
+        applier = self.get_applier(task_cls=WebhookBatch)
+        return applier(args=[[target.url for target in targets], payload],
+                       kwargs=self._batch_keywords(targets))
+
+    def _batch_keywords(self, targets):
+        kwargs = dict(self.task_keywords, delivery_task=self.task_cls.name)
+        if self.delivery_engine:
+            kwargs["delivery_engine"] = self.delivery_engine
+            kwargs["delivery_concurrency"] = self.delivery_concurrency
+        limits = dict((target.url, listener_limits(target.config))
+                        for target in targets
+                            if listener_limits(target.config))
+        if limits:
+            kwargs["listener_limits"] = limits
+        return kwargs
 
     def event_filter(self, sender, payload, match):
         """How we filter events.
@@ -160,16 +503,116 @@ class Hook(object):
         return mtuplelist_to_matchdict(mtuplelist)
 
     def get_listeners(self, sender, payload):
-        """Get a list of all the listeners who wants this signal."""
-        possible_targets = Listener.objects.filter(hook=self.name)
+        """Get a list of all the listeners who wants this signal.
+
+        Unless :meth:`event_filter` is overridden, the listeners are
+        tested with their compiled match predicate (see
+        :meth:`durian.models.Listener.matches`).
+
+        """
+        possible_targets = self.get_possible_targets(payload)
+        if self.has_default_event_filter:
+            stats = self.reorder_conditions and self.match_stats or None
+            return [target for target in possible_targets
+                        if target.matches(payload, stats=stats)]
         return [target for target in possible_targets
                     if self.event_filter(sender, payload, target.match)]
 
-    def get_applier(self, async=None):
-        """Get the current apply method. Asynchronous or synchronous."""
+    @property
+    def has_default_event_filter(self):
+        """``True`` if :meth:`event_filter` is not overridden."""
+        return getattr(self.event_filter, "im_func", None) is \
+                    Hook.event_filter.im_func
+
+    def send_many(self, sender, payloads):
+        """Send many events at once.
+
+        The listeners are fetched once for the whole batch, and matched
+        with all the events together (see :mod:`durian.match.batch`).
+        Every event with listeners is dispatched as a single
+        :class:`durian.tasks.WebhookFanout` task, whatever :attr:`fanout`
+        is set to.
+
+        If :meth:`event_filter` is overridden, the events are dispatched
+        one by one as with :meth:`send`.
+
+        :param sender: The sender of the signal.
+        :param payloads: List of payload dicts.
+
+        :returns: List with the results of each event.
+
+        """
+        if not payloads or not self.has_listeners():
+            return [[] for payload in payloads]
+        return self.send_many_prepared(sender,
+                                       [self.prepare_payload(sender,
+                                                             dict(payload))
+                                            for payload in payloads])
+
+    def send_many_prepared(self, sender, prepared):
+        """Send many payloads already prepared by :meth:`prepare_payload`.
+
+        See :meth:`send_many`.
+
+        """
+        if self.outbox:
+            for payload in prepared:
+                add_to_outbox(self.name, payload)
+            return [[] for payload in prepared]
+        if not self.has_default_event_filter:
+            return [self.dispatch(sender, payload) for payload in prepared]
+        targets = self.get_batch_targets(prepared)
+        rank = self.reorder_conditions and self.match_stats.rank or None
+        matrix = match_matrix(targets, prepared, rank=rank)
+        return [self.dispatch_to(sender, payload,
+                                 matching_listeners(matrix, targets, index),
+                                 fanout=True)
+                    for index, payload in enumerate(prepared)]
+
+    def get_batch_targets(self, payloads):
+        """Get the listeners that can possibly match any of the
+        payloads, see :meth:`get_possible_targets`."""
+        if self.prefilter:
+            # A query per chunk, to keep the IN lists at a size every
+            # database accepts.
+            targets = {}
+            for chunk in chunks(iter(payloads), 100):
+                for target in Listener.objects.candidates_many(self.name,
+                                                               chunk):
+                    targets[target.pk] = target
+            return [targets[pk] for pk in sorted(targets)]
+        return listener_cache.get_index(self.name).all()
+
+    def get_possible_targets(self, payload):
+        """Get the listeners attached to this hook that can possibly
+        match the payload.
+
+        The listeners are kept in the process local
+        :data:`durian.cache.listeners` cache, and routed by a
+        :class:`durian.match.index.MatchIndex`, so only a few of them
+        has to be tested with :meth:`event_filter`.
+
+        If :attr:`prefilter` is enabled the candidates are looked up in
+        the database instead.
+
+        """
+        if self.prefilter:
+            return list(Listener.objects.candidates(self.name, payload))
+        return listener_cache.get_index(self.name).candidates(payload)
+
+    def get_applier(self, async=None, task_cls=None):
+        """Get the current apply method. Asynchronous or synchronous.
+
+        Synchronous tasks are applied in a thread pool if
+        :attr:`local_concurrency` is set.
+
+        """
         async = async or self.async
+        task_cls = task_cls or self.task_cls
+        if not async and self.local_concurrency:
+            return LocalApplier(task_cls, get_pool(self.local_concurrency))
         method = "apply_async" if async else "apply"
-        sender = getattr(self.task_cls, method)
+        sender = getattr(task_cls, method)
         return sender
 
     def prepare_payload(self, sender, payload):
@@ -180,6 +623,17 @@ class Hook(object):
         """
         return payload
 
+    def encode_payload(self, payload):
+        """Encode the prepared payload.
+
+        The encoder used is configured by the ``DURIAN_PAYLOAD_ENCODER``
+        setting.
+
+        :returns: :class:`durian.payload.EncodedPayload`.
+
+        """
+        return encode_payload(payload)
+
     def add_listener_by_form(self, form, match=None):
         """Add listener with an instantiated :attr:`config_form`.
 
@@ -202,8 +656,8 @@ class Hook(object):
         :keyword \*\*config: Hook specific listener configuration.
 
         """
-        return Listener.objects.create(hook=self, url=url, match=match,
-                                       **dict(config))
+        return Listener.objects.create(hook=self.name, url=url, match=match,
+                                       config=config)
 
     def listener(self, form):
         """Create a new listener."""
@@ -212,19 +666,49 @@ class Hook(object):
     @property
     def task_keywords(self):
         """The keyword arguments sent to the celery task."""
-        return {"retry": self.retry,
+        return {"hook_name": self.name,
+                "retry": self.retry,
                 "max_retries": self.max_retries,
+                "retry_delay": self.retry_delay,
+                "retry_backoff": self.retry_backoff,
+                "retry_max_delay": self.retry_max_delay,
+                "retry_jitter": self.retry_jitter,
                 "fail_silently": self.fail_silently,
-                "timeout": self.timeout}
+                "timeout": self.timeout,
+                "circuit_breaker": self.circuit_breaker,
+                "rate_limit": self.rate_limit,
+                "rate_limit_burst": self.rate_limit_burst,
+                "max_in_flight": self.max_in_flight,
+                "dead_letter": self.dead_letter}
 
 
 class SignalHook(Hook):
-    """Hook attached to a Django signal."""
+    """Hook attached to a Django signal.
+
+    :keyword signal: See :attr:`signal`.
+    :keyword lazy_connect: See :attr:`lazy_connect`.
+
+    .. attribute:: signal
+
+        The :class:`django.dispatch.Signal` the hook is connected to.
+
+    .. attribute:: lazy_connect
+
+        If ``True``, :meth:`connect` doesn't connect to the signal until
+        the hook has listeners, so the signal costs nothing for hooks
+        nobody listens to. The pending hooks are connected by
+        :func:`connect_pending_hooks`, which is called when a request
+        starts and when a listener is saved.
+
+    """
     signal = None
+    lazy_connect = False
     _dispatch_uid = None
 
-    def __init__(self, signal=None, **kwargs):
+    def __init__(self, signal=None, lazy_connect=None, **kwargs):
         self.signal = signal
+        if lazy_connect is not None:
+            self.lazy_connect = lazy_connect
 
         # Signal receivers must have a unique id, by default
         # they're generated by the reciver name and the sender,
@@ -236,16 +720,54 @@ class SignalHook(Hook):
         super(SignalHook, self).__init__(**kwargs)
 
     def connect(self, sender):
+        if self.lazy_connect:
+            # Deferred to connect_pending_hooks, as the database may not
+            # be ready to be asked for listeners yet.
+            _pending_connects.setdefault(self, []).append(sender)
+            return
+        self.connect_signal(sender)
+
+    def connect_signal(self, sender):
+        """Connect to the signal now, even if :attr:`lazy_connect` is
+        enabled."""
         self.signal.connect(self.send, sender=sender,
                             dispatch_uid=self.__class__._dispatch_uid)
 
     def disconnect(self, sender):
+        pending = _pending_connects.get(self, [])
+        if sender in pending:
+            pending.remove(sender)
+            if not pending:
+                _pending_connects.pop(self)
         self.signal.disconnect(self.send, sender=sender,
                                dispatch_uid=self.__class__._dispatch_uid)
 
 
-class ModelHook(SignalHook):
+def connect_pending_hooks(**kwargs):
+    """Connect the :attr:`SignalHook.lazy_connect` hooks that have got
+    listeners since they were created.
+
+    Connected to the ``request_started`` signal and the ``post_save``
+    signal of :class:`durian.models.Listener`, but can be called manually
+    by processes not serving requests.
+
     """
+    for hook, senders in _pending_connects.items():
+        # Counted even if the listener cache isn't shared, as the hook
+        # is only connected once.
+        if listener_cache.count(hook.name):
+            _pending_connects.pop(hook, None)
+            for sender in senders:
+                hook.connect_signal(sender)
+request_started.connect(connect_pending_hooks,
+                        dispatch_uid="durian.connect_pending_hooks")
+signals.post_save.connect(connect_pending_hooks, sender=Listener,
+                          dispatch_uid="durian.connect_pending_hooks")
+
+
+class ModelHook(SignalHook):
+    """Hook attached to a model signal.
+
         >>> from django.db import signals
         >>> from django.contrib.auth.models import User
 
@@ -256,29 +778,235 @@ class ModelHook(SignalHook):
         >>> joe.is_admin = True
         >>> joe.save()
 
+    :keyword model: See :attr:`model`.
+    :keyword coalesce: See :attr:`coalesce`.
+    :keyword skip_unchanged: See :attr:`skip_unchanged`.
+    :keyword changes_only: See :attr:`changes_only`.
+    :keyword related_fields: See :attr:`related_fields`.
+
+    .. attribute:: model
+
+        The model class whose signal the hook is attached to.
+
+    .. attribute:: coalesce
+
+        If ``True``, while events are buffered (see
+        :mod:`durian.coalesce`) only the last event for each instance is
+        sent, when the buffering ends. Events for instances without a
+        primary key (e.g. sent by ``pre_save``) are sent at once.
+
+    .. attribute:: provides_args
+
+        The fields of the instance sent in the payload. The values are
+        read directly from the instance attributes, so a foreign key is
+        sent as the id of the related object (the related objects are
+        never fetched). Default is all the fields except the primary key.
+
+    .. attribute:: related_fields
+
+        Values of related objects to include in the payload, as lookup
+        paths like ``"author__username"`` (also used as the key in the
+        payload). Values of related objects already cached on the
+        instance are read from it, the rest are fetched with a single
+        ``values()`` query per event.
+
+    .. attribute:: skip_unchanged
+
+        If ``True``, no event is sent when an existing instance is saved
+        without any of the fields in :attr:`provides_args` having
+        changed. The values are compared with a snapshot taken when the
+        instance is loaded (``post_init``), and after every event sent.
+        Foreign keys are compared by their id, so the related objects are
+        not fetched.
+
+    .. attribute:: changes_only
+
+        If ``True``, the payload sent when an existing instance is saved
+        only contains the fields that changed, and a ``"changes"`` key
+        mapping each changed field to a dict with its ``"old"`` and
+        ``"new"`` values. Listeners matching on fields that didn't change
+        won't get the event. Created instances get the full payload.
+
     """
     model = None
-
-    def __init__(self, model=None, **kwargs):
+    coalesce = False
+    skip_unchanged = False
+    changes_only = False
+    related_fields = ()
+    _field_getters = None
+
+    def __init__(self, model=None, coalesce=None, skip_unchanged=None,
+            changes_only=None, related_fields=None, **kwargs):
         super(ModelHook, self).__init__(**kwargs)
         self.model = model or self.model
+        if coalesce is not None:
+            self.coalesce = coalesce
+        if skip_unchanged is not None:
+            self.skip_unchanged = skip_unchanged
+        if changes_only is not None:
+            self.changes_only = changes_only
+        self.related_fields = related_fields or self.related_fields
         if not self.model:
             raise NotImplementedError("ModelHook requires a model.")
         if self.signal:
             self.connect()
         if not self.provides_args:
             self.provides_args = self.get_model_default_fields()
+        if self.tracks_changes:
+            signals.post_init.connect(self.take_snapshot, sender=self.model,
+                                      weak=False,
+                                      dispatch_uid="durian.snapshot.%s" % (
+                                          self.name))
 
     def get_model_default_fields(self):
         return [field.name
                     for field in self.model._meta.fields
                         if field.name != self.model._meta.pk.name]
 
+    @property
+    def tracks_changes(self):
+        """``True`` if snapshots of the instances are needed."""
+        return self.skip_unchanged or self.changes_only
+
+    def get_field_getters(self):
+        """Get ``(name, getter)`` pairs for the fields in
+        :attr:`provides_args`.
+
+        The getters read the attname of the field (for a foreign key the
+        id attribute), and are only created again if
+        :attr:`provides_args` is changed.
+
+        """
+        key = tuple(self.provides_args)
+        if self._field_getters is None or self._field_getters[0] != key:
+            attnames = dict((field.name, field.attname)
+                                for field in self.model._meta.fields)
+            getters = []
+            for name in key:
+                if name in attnames:
+                    getter = operator.attrgetter(attnames[name])
+                else:
+                    getter = curry(_getattr_or_none, name=name)
+                getters.append((name, getter))
+            self._field_getters = (key, getters)
+        return self._field_getters[1]
+
+    def get_related_values(self, instance, paths):
+        """Get the values of related objects for the lookup paths in
+        :attr:`related_fields`.
+
+        Only the values not found in the related objects cached on the
+        instance are fetched, all with the same query.
+
+        """
+        values = {}
+        missing = []
+        for path in paths:
+            name, _, attr = path.partition("__")
+            try:
+                field = self.model._meta.get_field(name)
+                cached = instance.__dict__[field.get_cache_name()]
+            except (models.FieldDoesNotExist, AttributeError, KeyError):
+                missing.append(path)
+                continue
+            if cached is None:
+                values[path] = None
+            elif "__" not in attr:
+                values[path] = getattr(cached, attr, None)
+            else:
+                missing.append(path)
+        if missing:
+            row = {}
+            if instance.pk is not None:
+                rows = list(self.model._default_manager.filter(
+                                pk=instance.pk).values(*missing)[:1])
+                row = rows and rows[0] or {}
+            values.update((path, row.get(path)) for path in missing)
+        return values
+
+    def get_snapshot(self, instance):
+        """Get the current values of the watched fields."""
+        snapshot = {}
+        for name, getter in self.get_field_getters():
+            value = getter(instance)
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+            snapshot[name] = value
+        return snapshot
+
+    def take_snapshot(self, sender=None, instance=None, **kwargs):
+        """Remember the values of the watched fields of an instance.
+
+        Connected to the ``post_init`` signal of the model if
+        :attr:`skip_unchanged` or :attr:`changes_only` is enabled.
+
+        """
+        snapshots = instance.__dict__.setdefault("_durian_snapshots", {})
+        snapshots[self.name] = self.get_snapshot(instance)
+
+    def get_changes(self, instance):
+        """Get the changed fields of an instance since the last snapshot.
+
+        :returns: dict of ``name: (old, new)``, or ``None`` if there's
+            no snapshot of the instance.
+
+        """
+        snapshot = instance.__dict__.get("_durian_snapshots",
+                                         {}).get(self.name)
+        if snapshot is None:
+            return None
+        current = self.get_snapshot(instance)
+        return dict((name, (snapshot.get(name), value))
+                        for name, value in current.items()
+                            if snapshot.get(name) != value)
+
+    def send(self, sender, **payload):
+        """Send signal and dispatch to all listeners.
+
+        If :attr:`coalesce` is enabled and events are being buffered, the
+        event is buffered instead, replacing any earlier event for the
+        same instance.
+
+        If :attr:`skip_unchanged` is enabled, saves that didn't change
+        any of the watched fields are not sent.
+
+        """
+        if not self.has_listeners():
+            return []
+        instance = payload["instance"]
+        if self.tracks_changes:
+            if self.skip_unchanged and payload.get("created") is False \
+                    and self.get_changes(instance) == {}:
+                return []
+            prepared = self.prepare_payload(sender, payload)
+            self.take_snapshot(instance=instance)
+        else:
+            prepared = self.prepare_payload(sender, payload)
+        # Unsaved instances can't be told apart, so they're not coalesced.
+        if self.coalesce and instance.pk is not None and \
+                coalescer.is_buffering():
+            coalescer.buffer_event(self, instance.pk, sender, prepared)
+            return []
+        return self.send_prepared(sender, prepared)
+
     def prepare_payload(self, sender, payload):
         instance = payload.pop("instance")
         payload.pop("signal", None)
-        model_data = dict((field_name, getattr(instance, field_name, None))
-                                for field_name in self.provides_args)
+        getters = self.get_field_getters()
+        changes = None
+        if self.changes_only and payload.get("created") is False:
+            changes = self.get_changes(instance)
+            if changes is not None:
+                getters = [(name, getter) for name, getter in getters
+                                            if name in changes]
+        model_data = dict((name, getter(instance))
+                                for name, getter in getters)
+        if self.related_fields:
+            model_data.update(self.get_related_values(instance,
+                                                      self.related_fields))
+        if changes is not None:
+            model_data["changes"] = dict((name, {"old": old, "new": new})
+                                    for name, (old, new) in changes.items())
         model_data.update(payload)
         return model_data
 
@@ -0,0 +1,88 @@
+"""durian.fields"""
+from django.db import models
+from celery.fields import dbsafe_encode, dbsafe_decode
+from durian.match import codec
+
+
+class EncodedTreeField(models.Field):
+    """Stores a tree of dicts using the compact JSON encoding in
+    :mod:`durian.match.codec`.
+
+    Values pickled by the old :class:`celery.fields.PickledObjectField`
+    are still read, and are converted when the row is saved (or by the
+    ``durian_convert_listeners`` management command).
+
+    A tree JSON can't represent (dates, decimals, model instances,
+    non-string keys or tuples) is pickled like before instead, so it's
+    read back unchanged.
+
+    The encoding is stable, so the field supports the ``exact``, ``in``
+    and ``isnull`` lookups, and ``contains``/``icontains`` lookups on the
+    encoded text (of the trees that aren't pickled).
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("null", True)
+        kwargs.setdefault("editable", False)
+        super(EncodedTreeField, self).__init__(*args, **kwargs)
+
+    def get_default(self):
+        if self.has_default():
+            if callable(self.default):
+                return self.default()
+            return self.default
+        return super(EncodedTreeField, self).get_default()
+
+    def to_python(self, value):
+        if not isinstance(value, basestring):
+            return value
+        if codec.is_encoded(value):
+            return codec.loads(value)
+        try:
+            return dbsafe_decode(value)
+        except Exception:
+            # Not a pickle either, so it's a plain value.
+            return value
+
+    def get_db_prep_value(self, value):
+        if value is None:
+            return value
+        try:
+            encoded = codec.dumps(value)
+            # JSON turns keys into strings, and tuples into lists.
+            if codec.same_tree(codec.loads(encoded), value):
+                return encoded
+        except (TypeError, ValueError): # Also codec.DecodeError.
+            pass
+        return dbsafe_encode(value)
+
+    def value_to_string(self, obj):
+        return self.get_db_prep_value(self._get_val_from_obj(obj))
+
+    def get_internal_type(self):
+        return "TextField"
+
+    def get_db_prep_lookup(self, lookup_type, value):
+        if lookup_type not in ("exact", "in", "isnull",
+                               "contains", "icontains"):
+            raise TypeError("Lookup type %s is not supported." % lookup_type)
+        return super(EncodedTreeField, self).get_db_prep_lookup(lookup_type,
+                                                          value)
+
+
+class MatchField(EncodedTreeField):
+    """Stores a match tree (the conditions of a listener)."""
+    # Subclasses of a SubfieldBase field can't be subclassed again,
+    # so both fields derive from EncodedTreeField.
+    __metaclass__ = models.SubfieldBase
+
+
+class ConfigField(EncodedTreeField):
+    """Stores the configuration of a listener.
+
+    The configuration comes from the hook's config form, so it often
+    contains values JSON can't represent, which are pickled.
+
+    """
+    __metaclass__ = models.SubfieldBase
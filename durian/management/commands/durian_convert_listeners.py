@@ -0,0 +1,36 @@
+"""
+
+Convert the listeners stored with pickle to the JSON encoding.
+
+"""
+from django.core.management.base import BaseCommand
+from durian.models import Listener
+from durian.match import codec
+
+
+def is_converted(value):
+    return value is None or codec.is_encoded(value)
+
+
+class Command(BaseCommand):
+    """Convert the match trees and configuration of listeners saved
+    by earlier versions to the encoding in :mod:`durian.match.codec`."""
+    option_list = BaseCommand.option_list
+    help = "Convert the match and config of listeners saved by earlier " + \
+            "versions to the JSON encoding."
+
+    def handle(self, *args, **options):
+        """Handle the management command."""
+        verbosity = int(options.get("verbosity", 1))
+        converted = 0
+        field = Listener._meta.get_field("match")
+        rows = Listener.objects.values_list("pk", "match", "config")
+        for pk, match, config in rows.iterator():
+            if is_converted(match) and is_converted(config):
+                continue
+            Listener.objects.filter(pk=pk).update(
+                    match=field.to_python(match),
+                    config=field.to_python(config))
+            converted += 1
+        if verbosity:
+            print("* Converted %d listener(s)." % converted)
@@ -0,0 +1,41 @@
+"""
+
+Dispatch the events stored in the outbox.
+
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from durian.outbox import drain_outbox, drain_forever
+
+
+class Command(BaseCommand):
+    """Dispatch the outbox events of all hooks, or the hooks given as
+    arguments."""
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int",
+                    default=1000,
+                    help="Number of events to claim at a time."),
+        make_option("--lease", dest="lease", type="int", default=None,
+                    help="Number of seconds claimed events are reserved "
+                         "for this drainer."),
+        make_option("--forever", dest="forever", action="store_true",
+                    default=False,
+                    help="Keep draining the outbox as new events arrive."),
+        make_option("--interval", dest="interval", type="float",
+                    default=1,
+                    help="With --forever: seconds to sleep when the "
+                         "outbox is empty."),
+    )
+    help = "Dispatch the events stored in the outbox."
+    args = "[hook_name ...]"
+
+    def handle(self, *hook_names, **options):
+        """Handle the management command."""
+        kwargs = {"batch_size": options["batch_size"],
+                  "lease": options.get("lease"),
+                  "hook_names": hook_names or None}
+        if options.get("forever"):
+            return drain_forever(interval=options["interval"], **kwargs)
+        dispatched = drain_outbox(**kwargs)
+        if int(options.get("verbosity", 1)):
+            print("* Dispatched %d outbox event(s)." % dispatched)
@@ -0,0 +1,22 @@
+"""
+
+Rewrite the condition table used to prefilter listeners.
+
+"""
+from django.core.management.base import BaseCommand
+from durian.models import Listener
+
+
+class Command(BaseCommand):
+    """Rewrite the :class:`durian.models.ListenerCondition` rows of all
+    listeners, or the listeners of the hooks given as arguments."""
+    option_list = BaseCommand.option_list
+    help = "Rewrite the condition table used to prefilter listeners."
+    args = "[hook_name ...]"
+
+    def handle(self, *hook_names, **options):
+        """Handle the management command."""
+        if not hook_names:
+            Listener.objects.reindex()
+        for hook_name in hook_names:
+            Listener.objects.reindex(hook_name)
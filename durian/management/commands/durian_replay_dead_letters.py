@@ -0,0 +1,39 @@
+"""
+
+Replay the deliveries stored as dead letters.
+
+"""
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from durian.models import DeadLetter
+from durian.deadletter import replay_dead_letters
+
+
+class Command(BaseCommand):
+    """Replay the dead letters of all hooks, or the hooks given as
+    arguments."""
+    option_list = BaseCommand.option_list + (
+        make_option("--url", dest="url", default=None,
+                    help="Only replay the dead letters for this URL."),
+        make_option("--batch-size", dest="batch_size", type="int",
+                    default=1000,
+                    help="Number of dead letters to replay at a time."),
+        make_option("--rate", dest="rate", type="float", default=None,
+                    help="Maximum number of dead letters to replay per "
+                         "second."),
+    )
+    help = "Replay the deliveries stored as dead letters."
+    args = "[hook_name ...]"
+
+    def handle(self, *hook_names, **options):
+        """Handle the management command."""
+        dead_letters = DeadLetter.objects.all()
+        if hook_names:
+            dead_letters = dead_letters.filter(hook__in=hook_names)
+        if options.get("url"):
+            dead_letters = dead_letters.filter(url=options["url"])
+        replayed = replay_dead_letters(dead_letters,
+                                       batch_size=options["batch_size"],
+                                       rate=options.get("rate"))
+        if int(options.get("verbosity", 1)):
+            print("* Replayed %d dead letter(s)." % replayed)
@@ -26,7 +26,7 @@ CONST_TO_MATCHABLE = {
 
 
 def const_to_matchable(const_kind, what):
-    return CONST_TO_MATCHABLE[int(const_kind)](what)
+    return CONST_TO_MATCHABLE[int(const_kind)].interned(what)
 
 
 def mtuplelist_to_matchdict(mtuplelist):
@@ -1,5 +1,42 @@
 import re
 import operator
+import weakref
+from durian.utils import LRUCache
+
+REGEX_SPECIAL_CHARS = frozenset("\\.^$*+?{}[]|()")
+
+"""
+.. data:: compiled_patterns
+
+    Cache of the regular expressions compiled by :func:`compile_pattern`.
+
+"""
+compiled_patterns = LRUCache(1000)
+
+
+def compile_pattern(pattern):
+    """Compile a regular expression, or get it from the
+    :data:`compiled_patterns` cache."""
+    compiled = compiled_patterns.get(pattern)
+    if compiled is None:
+        compiled = compiled_patterns[pattern] = re.compile(pattern)
+    return compiled
+
+
+"""
+.. data:: interned
+
+    The shared matchables created by :meth:`Matchable.interned`, by
+    ``(class, type of value, value)``. Matchables no longer used are
+    removed automatically.
+
+"""
+interned = weakref.WeakValueDictionary()
+
+
+def intern_matchable(cls, value):
+    """Same as ``cls.interned(value)``, used to unpickle matchables."""
+    return cls.interned(value)
 
 
 class Matchable(object):
@@ -11,15 +48,49 @@ class Matchable(object):
 
     Subclasses of :class:`Matchable` must implement the :meth:`__eq__` method.
 
+    Matchables have no instance dict (the built-in subclasses define
+    ``__slots__``), and the matchables of loaded listeners are shared
+    (see :meth:`interned`), so they must never be changed.
+
     .. attribute:: value
 
         The value to match against.
 
     """
+    __slots__ = ("value", "__weakref__")
 
     def __init__(self, value):
         self.value = value
 
+    @classmethod
+    def interned(cls, value):
+        """Get the shared matchable of this class for a value.
+
+        Listeners loaded from the database share their matchables, so
+        thousands of listeners with the same condition only keep one
+        copy of it (and :class:`Like` only compiles its expression
+        once). Unhashable values give a new matchable.
+
+        """
+        key = (cls, type(value), value)
+        try:
+            matchable = interned.get(key)
+        except TypeError:
+            return cls(value)
+        if matchable is None:
+            matchable = cls(value)
+            interned[key] = matchable
+        return matchable
+
+    def __reduce__(self):
+        return (intern_matchable, (self.__class__, self.value))
+
+    def __setstate__(self, state):
+        # Matchables pickled by earlier versions had an instance dict.
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **(state[1] or {}))
+        self.value = state["value"]
+
     def __ne__(self, other):
         return not self.__eq__(other)
 
@@ -32,6 +103,7 @@ class Matchable(object):
 
 class Any(Matchable):
     """Matchable always matching anything."""
+    __slots__ = ()
 
     def __init__(self, value):
         value = value or ""
@@ -48,6 +120,7 @@ class Is(Matchable):
     (same as the regular ``==`` operator.)
 
     """
+    __slots__ = ()
 
     def __eq__(self, other):
         return operator.eq(self.value, other)
@@ -59,6 +132,7 @@ class Startswith(Matchable):
     Same as ``other.startswith(value)``.
 
     """
+    __slots__ = ()
 
     def __eq__(self, other):
         return other.startswith(self.value)
@@ -70,6 +144,7 @@ class Endswith(Matchable):
     Same as ``other.endswith(value)``.
 
     """
+    __slots__ = ()
 
     def __eq__(self, other):
         return other.endswith(self.value)
@@ -81,6 +156,7 @@ class Contains(Matchable):
     Same as ``other.find(value)``.
 
     """
+    __slots__ = ()
 
     def __eq__(self, other):
         return other.find(self.value) != -1
@@ -88,11 +164,34 @@ class Contains(Matchable):
 
 class Like(Matchable):
     """Matchable checking if the matched string matches a regular
-    expression."""
+    expression.
+
+    The expression is compiled the first time it's used, and compiled
+    expressions are shared by all :class:`Like` instances with the same
+    pattern (see :func:`compile_pattern`).
+
+    """
+    __slots__ = ("_pattern", )
 
     def __init__(self, value):
         super(Like, self).__init__(value)
-        self.pattern = re.compile(self.value)
+        self._pattern = None
 
     def __eq__(self, other):
         return bool(self.pattern.search(other))
+
+    @property
+    def pattern(self):
+        pattern = getattr(self, "_pattern", None)
+        if pattern is None:
+            pattern = self._pattern = compile_pattern(self.value)
+        return pattern
+
+    @property
+    def literal(self):
+        """The pattern as a plain string if it doesn't contain any special
+        characters (in which case matching it is the same as
+        :class:`Contains`), otherwise ``None``."""
+        if isinstance(self.value, basestring) and \
+                not REGEX_SPECIAL_CHARS.intersection(self.value):
+            return self.value
@@ -0,0 +1,95 @@
+"""durian.match.ahocorasick"""
+from collections import deque
+
+
+class Automaton(object):
+    """Aho-Corasick automaton finding all needles contained in a text
+    with a single pass over the text.
+
+    Each needle maps to a set of items, and :meth:`search` returns the
+    items of all the needles found. The automaton is built lazily, and
+    only rebuilt after needles have been added or removed.
+
+        >>> automaton = Automaton()
+        >>> automaton.add("bug", 1)
+        >>> automaton.add("fix", 2)
+        >>> automaton.add("xyzzy", 3)
+        >>> sorted(automaton.search("fixes bug #42"))
+        [1, 2]
+
+    """
+
+    def __init__(self):
+        self.needles = {}
+        self.builds = 0
+        self._goto = None
+        self._fail = None
+        self._output = None
+
+    def add(self, needle, item):
+        """Add ``item`` to the items found by ``needle``."""
+        self.needles.setdefault(needle, set()).add(item)
+        self._goto = None
+
+    def remove(self, needle, item):
+        """Remove ``item`` from the items found by ``needle``."""
+        items = self.needles.get(needle)
+        if items is None or item not in items:
+            return
+        items.discard(item)
+        if not items:
+            del(self.needles[needle])
+        self._goto = None
+
+    def build(self):
+        """Build the automaton (the trie of needles, its failure links and
+        the outputs of each state)."""
+        goto, fail, output = [{}], [0], [set()]
+        for needle, items in self.needles.items():
+            state = 0
+            for char in needle:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto.append({})
+                    fail.append(0)
+                    output.append(set())
+                    goto[state][char] = next_state
+                state = next_state
+            output[state].update(items)
+
+        # Breadth first, so the failure state of a state is always
+        # complete before we get to it.
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                failure = fail[state]
+                while failure and char not in goto[failure]:
+                    failure = fail[failure]
+                fail[next_state] = goto[failure].get(char, 0)
+                output[next_state].update(output[fail[next_state]])
+
+        self._goto, self._fail, self._output = goto, fail, output
+        self.builds += 1
+
+    def search(self, text):
+        """Get the items of all the needles contained in ``text``."""
+        if self._goto is None:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set(output[0])
+        seen = set([0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if state not in seen:
+                seen.add(state)
+                found.update(output[state])
+        return found
+
+    def __len__(self):
+        return len(self.needles)
@@ -0,0 +1,220 @@
+"""durian.match.batch
+
+Matching many payloads against many listeners at once, used by
+:meth:`durian.event.Hook.send_many`.
+
+Instead of testing every listener with one payload at a time, each
+condition is evaluated column-wise: the values at the condition's path
+are extracted once for the whole batch (and shared by all the listeners
+testing the same path), and tested together. The result is a
+listener by payload boolean match matrix.
+
+If NumPy is installed the string conditions are evaluated with NumPy
+string arrays and the results kept in boolean arrays, otherwise plain
+lists are used. Bytestrings are converted the way Python compares them
+with unicode (as ASCII), the ones that can't be are tested one at a time.
+NumPy string arrays drop trailing NUL characters, so strings containing
+NULs (in the payloads or the conditions) are tested one at a time too.
+
+The results are the same as :func:`durian.match.strategy.deepmatch`,
+except that a condition raising an error for a payload (e.g.
+:class:`durian.match.able.Startswith` with a missing key) is simply
+not a match.
+
+"""
+from durian.match.able import Matchable, Any, Is, Startswith, Endswith
+from durian.match.able import Contains, Like
+from durian.match.index import resolve, has_path, iterconditions, PRESENT
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Value of a path missing in a payload.
+MISSING = object()
+
+STRING_TESTS = {Startswith: "startswith",
+                Endswith: "endswith",
+                Contains: "find"}
+
+
+def as_text(value):
+    """Get a string value as unicode, decoding bytestrings as ASCII like
+    Python does when comparing them with unicode.
+
+    :returns: ``None`` if the value is not a string, or a bytestring
+        that isn't ASCII.
+
+    """
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        try:
+            return value.decode("ascii")
+        except UnicodeDecodeError:
+            pass
+    return None
+
+
+def test_value(value, condition):
+    """Test a single value with a condition, like :func:`deepmatch`
+    does."""
+    if value is MISSING:
+        return False
+    try:
+        return not (value != condition)
+    except Exception:
+        return False
+
+
+class Columns(object):
+    """The values of a batch of payloads, by path.
+
+    :param payloads: The list of payloads.
+    :keyword use_numpy: Use NumPy arrays. Default is to use NumPy if
+        it's installed.
+
+    """
+
+    def __init__(self, payloads, use_numpy=None):
+        self.payloads = payloads
+        self.size = len(payloads)
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self.use_numpy = use_numpy
+        self._values = {}
+        self._strings = {}
+
+    def values(self, path):
+        """Get the values at path in all the payloads, :data:`MISSING`
+        for the payloads where it can't be resolved."""
+        values = self._values.get(path)
+        if values is None:
+            values = []
+            for payload in self.payloads:
+                try:
+                    values.append(resolve(payload, path))
+                except KeyError:
+                    values.append(MISSING)
+            self._values[path] = values
+        return values
+
+    def strings(self, path):
+        """Get the values at path as a NumPy unicode array, the mask of
+        the values that are strings, and the indices of the strings that
+        must be tested one at a time: bytestrings that couldn't be
+        converted (see :func:`as_text`), and strings containing NUL
+        characters."""
+        strings = self._strings.get(path)
+        if strings is None:
+            texts = map(as_text, self.values(path))
+            scalar = [i for i, (text, value) in enumerate(zip(texts,
+                            self.values(path)))
+                                if isinstance(value, basestring) and
+                                    (text is None or u"\x00" in text)]
+            array = numpy.array([text or u"" for text in texts],
+                                dtype=numpy.unicode_)
+            is_string = numpy.array([text is not None for text in texts],
+                                    dtype=bool)
+            strings = self._strings[path] = (array, is_string, scalar)
+        return strings
+
+    def from_iter(self, iterable):
+        if self.use_numpy:
+            return numpy.fromiter(iterable, dtype=bool, count=self.size)
+        return list(iterable)
+
+    def mask(self, path, condition):
+        """Get the mask of payloads matching a condition."""
+        if condition is PRESENT:
+            return self.from_iter(has_path(payload, path)
+                                    for payload in self.payloads)
+        values = self.values(path)
+        kind = type(condition)
+        if kind is Any:
+            return self.from_iter(value is not MISSING for value in values)
+        if self.use_numpy:
+            if kind is Is:
+                exact = condition.value
+            elif not isinstance(condition, Matchable):
+                exact = condition
+            else:
+                exact = None
+            if kind in STRING_TESTS:
+                text = as_text(condition.value)
+            else:
+                text = as_text(exact)
+            if text is not None and u"\x00" not in text:
+                return self._string_mask(path, condition, text,
+                                         exact is not None)
+            if kind is Like:
+                search = condition.pattern.search
+                return self.from_iter(isinstance(value, basestring) and
+                                        search(value) is not None
+                                            for value in values)
+        return self.from_iter(test_value(value, condition)
+                                for value in values)
+
+    def _string_mask(self, path, condition, text, exact=False):
+        array, is_string, scalar = self.strings(path)
+        if exact:
+            result = array == text
+        else:
+            method = STRING_TESTS[type(condition)]
+            result = getattr(numpy.char, method)(array, text)
+            if method == "find":
+                result = result != -1
+        result &= is_string
+        values = self.values(path)
+        for i in scalar:
+            result[i] = test_value(values[i], condition)
+        return result
+
+
+def match_matrix(listeners, payloads, use_numpy=None, rank=None):
+    """Match every listener against every payload.
+
+    :keyword rank: Function taking the path and the condition, returning
+        a sort key for the order the conditions are evaluated in (see
+        :meth:`durian.match.stats.MatchStats.rank`).
+
+    :returns: A listener by payload matrix, ``matrix[i][j]`` is true if
+        ``listeners[i]`` matches ``payloads[j]``. A NumPy boolean array
+        if NumPy is used, otherwise a list of lists.
+
+    """
+    columns = Columns(payloads, use_numpy=use_numpy)
+    rows = []
+    for listener in listeners:
+        mask = None
+        conditions = iterconditions(listener.match or {},
+                                    include_empty=True)
+        if rank is not None:
+            conditions = sorted(conditions,
+                                key=lambda condition: rank(*condition))
+        for path, condition in conditions:
+            condition_mask = columns.mask(path, condition)
+            if mask is None:
+                mask = condition_mask
+            elif columns.use_numpy:
+                mask &= condition_mask
+            else:
+                mask = [a and b for a, b in zip(mask, condition_mask)]
+            if not (mask.any() if columns.use_numpy else any(mask)):
+                break
+        if mask is None:
+            mask = columns.from_iter(True for payload in payloads)
+        rows.append(mask)
+    if columns.use_numpy:
+        if not rows:
+            return numpy.zeros((0, len(payloads)), dtype=bool)
+        return numpy.vstack(rows)
+    return rows
+
+
+def matching_listeners(matrix, listeners, index):
+    """Get the listeners matching the payload at ``index`` in a
+    :func:`match_matrix`."""
+    return [listener for listener, row in zip(listeners, matrix)
+                if row[index]]
@@ -0,0 +1,138 @@
+"""durian.match.codec
+
+Compact, versioned JSON encoding of match trees (and listener
+configuration).
+
+Matchables are encoded as ``{"$": tag, "v": value}`` objects, e.g.
+``Startswith("70")`` is ``{"$": "startswith", "v": "70"}``. Dict keys
+are sorted, so the same tree always has the same encoding, and the
+database can search the encoded trees with plain string lookups.
+
+Dict keys made of ``$`` signs only are escaped with one more ``$``
+(``"$"`` is stored as ``"$$"``), so they're never mistaken for a tag.
+
+"""
+from django.utils import simplejson
+from durian.match.able import Matchable, Any, Is, Startswith, Endswith
+from durian.match.able import Contains, Like
+
+"""
+.. data:: VERSION
+
+    The current version of the encoding.
+
+"""
+VERSION = 1
+
+"""
+.. data:: PREFIX
+
+    Prefix of values using the current encoding.
+
+"""
+PREFIX = "j%d:" % VERSION
+
+TAG_KEY = "$"
+VALUE_KEY = "v"
+
+TAG_TO_MATCHABLE = {
+    "any": Any,
+    "is": Is,
+    "startswith": Startswith,
+    "endswith": Endswith,
+    "contains": Contains,
+    "like": Like,
+}
+MATCHABLE_TO_TAG = dict((cls, tag)
+                            for tag, cls in TAG_TO_MATCHABLE.items())
+
+
+class DecodeError(ValueError):
+    """The value is not a known encoding of a match tree."""
+
+
+def _encode_matchable(obj):
+    if isinstance(obj, Matchable):
+        try:
+            tag = MATCHABLE_TO_TAG[obj.__class__]
+        except KeyError:
+            raise TypeError("Can't encode matchable %r" % (obj, ))
+        return {TAG_KEY: tag, VALUE_KEY: obj.value}
+    raise TypeError("%r is not JSON serializable" % (obj, ))
+
+
+def _is_tag_key(key):
+    return isinstance(key, basestring) and key and \
+            not key.strip(TAG_KEY)
+
+
+def _escape(obj):
+    if isinstance(obj, dict):
+        return dict((_is_tag_key(key) and TAG_KEY + key or key,
+                     _escape(value))
+                        for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return map(_escape, obj)
+    if isinstance(obj, Matchable):
+        encoded = _encode_matchable(obj)
+        encoded[VALUE_KEY] = _escape(encoded[VALUE_KEY])
+        return encoded
+    return obj
+
+
+def _decode_matchable(obj):
+    if TAG_KEY in obj:
+        try:
+            cls = TAG_TO_MATCHABLE[obj[TAG_KEY]]
+        except KeyError:
+            raise DecodeError("Unknown matchable: %r" % (obj[TAG_KEY], ))
+        return cls.interned(obj.get(VALUE_KEY))
+    return dict((_is_tag_key(key) and key[1:] or key, value)
+                    for key, value in obj.items())
+
+_encoder = simplejson.JSONEncoder(separators=(",", ":"), sort_keys=True,
+                                  default=_encode_matchable)
+_decoder = simplejson.JSONDecoder(object_hook=_decode_matchable)
+
+
+def is_encoded(value):
+    """Returns ``True`` if the value uses the current encoding."""
+    return isinstance(value, basestring) and value.startswith(PREFIX)
+
+
+def dumps(tree):
+    """Encode a match tree (a dict with plain values and
+    :class:`durian.match.able.Matchable` instances)."""
+    return PREFIX + _encoder.encode(_escape(tree))
+
+
+def loads(value):
+    """Decode a match tree encoded by :func:`dumps`.
+
+    :raises DecodeError: if the value is not encoded by :func:`dumps`.
+
+    """
+    if not is_encoded(value):
+        raise DecodeError("Unknown match tree encoding: %r" % (
+                            value[:10], ))
+    return _decoder.decode(value[len(PREFIX):])
+
+
+def same_tree(first, second):
+    """Returns ``True`` if two trees are the same, comparing matchables by
+    their class and value instead of matching them, and dict keys and
+    sequences by their type too (e.g. ``1`` is not the same key as
+    ``"1"``)."""
+    if isinstance(first, Matchable) or isinstance(second, Matchable):
+        return first.__class__ is second.__class__ and \
+                same_tree(first.value, second.value)
+    if isinstance(first, dict) and isinstance(second, dict):
+        if sorted(first.keys()) != sorted(second.keys()):
+            return False
+        return all(same_tree(value, second[key])
+                        for key, value in first.items())
+    if isinstance(first, (list, tuple)):
+        return type(first) is type(second) and \
+                len(first) == len(second) and \
+                all(map(same_tree, first, second))
+    return first == second
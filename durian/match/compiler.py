@@ -0,0 +1,143 @@
+"""durian.match.compiler
+
+Compiles match dicts into predicate functions.
+
+:func:`durian.match.strategy.deepmatch` walks the match dict and
+dispatches through :meth:`durian.match.able.Matchable.__eq__` for every
+key, on every event. A listener's conditions rarely change, so
+:func:`compile_match` generates the source of a function doing the same
+tests with the nested key lookups and the built-in matchables inlined,
+and compiles it once.
+
+    >>> from durian.match.able import Startswith
+    >>> matches = compile_match({"name": "Joe",
+    ...                          "address": {"zip": Startswith("70")}})
+    >>> matches({"name": "Joe", "address": {"zip": "7020"}})
+    True
+
+The conditions are tested in the same order as :func:`deepmatch`, so the
+results (and errors, like testing :class:`Startswith` with a missing
+key) are the same.
+
+"""
+from durian.match.able import Any, Is, Startswith, Endswith
+from durian.match.able import Contains, Like
+from durian.match.index import iterconditions, PRESENT
+
+
+def _always(payload):
+    return True
+
+
+def _test_source(value, var, const):
+    """Get the source of the expression that's true when the value in
+    ``var`` doesn't match ``value``."""
+    kind = type(value)
+    if kind is Is:
+        return "not (%s == %s)" % (const(value.value), var)
+    if kind is Startswith:
+        return "not %s.startswith(%s)" % (var, const(value.value))
+    if kind is Endswith:
+        return "not %s.endswith(%s)" % (var, const(value.value))
+    if kind is Contains:
+        return "%s.find(%s) == -1" % (var, const(value.value))
+    if kind is Like:
+        return "not %s(%s)" % (const(value.pattern.search), var)
+    # Plain values, and matchables we don't know how to inline.
+    return "%s != %s" % (var, const(value))
+
+
+def generate_source(match, name="predicate", rank=None):
+    """Generate the source of a predicate function for a match dict.
+
+    :keyword rank: Function taking the path and the condition, returning
+        a sort key. If given, the conditions are tested in that order,
+        otherwise in the same order as :func:`deepmatch`.
+
+    :returns: ``(source, constants)``, where ``constants`` is the
+        namespace the source must be compiled in.
+
+    """
+    constants = {}
+
+    def const(value):
+        const_name = "c%d" % len(constants)
+        constants[const_name] = value
+        return const_name
+
+    lines = ["def %s(d0):" % name]
+    dicts = {(): "d0"}
+
+    def lookup(path):
+        # The variable holding the dict at path, checking that the keys
+        # exist the first time it's needed.
+        for i in range(1, len(path) + 1):
+            if path[:i] not in dicts:
+                var, key_name = dicts[path[:i - 1]], const(path[i - 1])
+                nested = dicts[path[:i]] = "d%d" % len(dicts)
+                lines.append("    if %s not in %s: return False" % (
+                                key_name, var))
+                lines.append("    %s = %s[%s]" % (nested, var, key_name))
+        return dicts[path]
+
+    for path, value in _ordered_conditions(match, rank):
+        if value is PRESENT:
+            lookup(path)
+            continue
+        var, key_name = lookup(path[:-1]), const(path[-1])
+        if type(value) is Any:
+            # Still looked up, as deepmatch would.
+            lines.append("    %s.get(%s)" % (var, key_name))
+        else:
+            lines.append("    v = %s.get(%s)" % (var, key_name))
+            lines.append("    if %s: return False" % (
+                            _test_source(value, "v", const)))
+    lines.append("    return True")
+    return "\n".join(lines) + "\n", constants
+
+
+def _ordered_conditions(match, rank=None):
+    """Flatten the match dict into ``(path, condition)`` pairs in the
+    order they should be tested.
+
+    Without a rank function this is the order :func:`deepmatch` tests
+    them in: a level at a time, the nested dicts of a level after its
+    plain conditions, and the last nested dict first.
+
+    """
+    if rank is not None:
+        return sorted(iterconditions(match, include_empty=True),
+                      key=lambda condition: rank(*condition))
+    conditions = []
+    stream = [(match, ())]
+    while stream:
+        needle, path = stream.pop()
+        for key, value in needle.items():
+            if isinstance(value, dict):
+                conditions.append((path + (key, ), PRESENT))
+                stream.append((value, path + (key, )))
+            else:
+                conditions.append((path + (key, ), value))
+    return conditions
+
+
+def compile_match(match, rank=None):
+    """Compile a match dict into a function taking a payload, returning
+    ``True`` if it matches (the same as :func:`deepmatch`).
+
+    An empty match dict matches anything.
+
+    :keyword rank: Test the conditions in this order, see
+        :func:`generate_source`. Only errors raised by conditions (like
+        testing :class:`Startswith` with a missing key) can differ from
+        :func:`deepmatch` then, as a condition rejecting the payload may
+        be tested before the one raising the error.
+
+    """
+    if not match:
+        return _always
+    source, namespace = generate_source(match, rank=rank)
+    exec compile(source, "<durian match>", "exec") in namespace
+    predicate = namespace["predicate"]
+    predicate.source = source
+    return predicate
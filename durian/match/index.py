@@ -0,0 +1,334 @@
+"""durian.match.index"""
+from durian.match.able import Matchable, Any, Is, Startswith, Endswith
+from durian.match.able import Contains, Like
+from durian.match.trie import Trie, SuffixTrie
+from durian.match.ahocorasick import Automaton
+from django.utils.encoding import smart_unicode
+import threading
+import numbers
+
+ROUTE_WILDCARD = "wildcard"
+ROUTE_SCAN = "scan"
+ROUTE_EXACT = "exact"
+ROUTE_PREFIX = "prefix"
+ROUTE_SUFFIX = "suffix"
+ROUTE_CONTAINS = "contains"
+
+
+# Condition of an empty nested match dict: the key must be present.
+PRESENT = object()
+
+
+def iterconditions(match, path=(), include_empty=False):
+    """Flatten a match dict into ``(path, condition)`` pairs, where path
+    is the tuple of keys leading to the condition.
+
+    :keyword include_empty: Give a :data:`PRESENT` condition for empty
+        nested match dicts, which are otherwise left out.
+
+    """
+    for key, value in match.items():
+        if isinstance(value, dict):
+            if include_empty and not value:
+                yield path + (key, ), PRESENT
+            for condition in iterconditions(value, path + (key, ),
+                                            include_empty):
+                yield condition
+        else:
+            yield path + (key, ), value
+
+
+def has_path(payload, path):
+    """Returns ``True`` if all the keys in path exist in the payload."""
+    for key in path:
+        if not isinstance(payload, dict) or key not in payload:
+            return False
+        payload = payload[key]
+    return True
+
+
+def resolve(payload, path):
+    """Get the value at ``path`` in a payload, or raise :exc:`KeyError`.
+
+    Like :func:`durian.match.strategy.deepmatch`, a missing leaf key is
+    the same as ``None``.
+
+    """
+    for key in path[:-1]:
+        if not isinstance(payload, dict) or key not in payload:
+            raise KeyError(key)
+        payload = payload[key]
+    if not isinstance(payload, dict):
+        raise KeyError(path[-1])
+    return payload.get(path[-1])
+
+
+def exact_value(condition):
+    """Get the value of an exact condition, or raise :exc:`TypeError`
+    if the condition can't be used as a hash key."""
+    if isinstance(condition, Is):
+        condition = condition.value
+    elif isinstance(condition, Matchable):
+        raise TypeError("Not an exact condition: %r" % (condition, ))
+    hash(condition)
+    return condition
+
+
+def route_for(match):
+    """Find out how a listener with this match dict should be indexed.
+
+    Returns a tuple of ``(kind, path, value)``, where kind is one of
+    ``ROUTE_WILDCARD``, ``ROUTE_SCAN``, ``ROUTE_EXACT``, ``ROUTE_PREFIX``,
+    ``ROUTE_SUFFIX`` or ``ROUTE_CONTAINS``. Exact conditions are
+    preferred, as they're the most selective.
+
+    """
+    if not isinstance(match, dict):
+        # Leave anything we don't understand to the event filter.
+        return (ROUTE_SCAN if match else ROUTE_WILDCARD, None, None)
+    conditions = [(path, condition)
+                    for path, condition in iterconditions(match)
+                        if not isinstance(condition, Any)]
+    if not conditions:
+        return (ROUTE_WILDCARD, None, None)
+    conditions.sort()
+    for path, condition in conditions:
+        try:
+            return (ROUTE_EXACT, path, exact_value(condition))
+        except TypeError:
+            pass
+    for path, condition in conditions:
+        if isinstance(getattr(condition, "value", None), basestring):
+            if isinstance(condition, Startswith):
+                return (ROUTE_PREFIX, path, condition.value)
+            if isinstance(condition, Endswith):
+                return (ROUTE_SUFFIX, path, condition.value)
+    for path, condition in conditions:
+        if isinstance(condition, Contains) and \
+                isinstance(condition.value, basestring):
+            return (ROUTE_CONTAINS, path, condition.value)
+        if isinstance(condition, Like) and condition.literal is not None:
+            return (ROUTE_CONTAINS, path, condition.literal)
+    return (ROUTE_SCAN, None, None)
+
+
+def iterleaves(payload, path=()):
+    """Flatten a payload into ``(path, value)`` pairs, where path is the
+    tuple of keys leading to the value. Values in lists are skipped."""
+    for key, value in payload.items():
+        if isinstance(value, dict):
+            for leaf in iterleaves(value, path + (key, )):
+                yield leaf
+        elif not isinstance(value, (list, tuple)):
+            yield path + (key, ), value
+
+
+def condition_row(path, value):
+    """Convert the path and value of an exact condition to the
+    ``(field, value)`` strings stored in the
+    :class:`durian.models.ListenerCondition` table, or ``None`` if the
+    value can't be stored.
+
+    Different values may get the same strings (the strings are truncated
+    to fit the table), but equal values always do, e.g. ``1``, ``1.0``,
+    ``Decimal("1")`` and ``True`` are all stored as ``"n:1"``.
+
+    Bytestrings that are not UTF-8 (in the value or the path) can't be
+    stored, so a listener with such a condition is a wildcard listener.
+
+    """
+    try:
+        field = u".".join(map(smart_unicode, path))
+        if isinstance(value, basestring):
+            value = u"s:" + smart_unicode(value)
+        elif isinstance(value, numbers.Number):
+            value = number_text(value)
+        else:
+            return None
+    except UnicodeDecodeError:
+        return None
+    if value is None:
+        return None
+    return field[:255], value[:255]
+
+
+def number_text(value):
+    """The ``"n:"`` string of a number for :func:`condition_row`,
+    or ``None`` if it has none (e.g. complex numbers)."""
+    try:
+        integral = value == int(value)
+    except (OverflowError, ValueError, TypeError):  # inf, nan, complex
+        integral = False
+    if integral:
+        return u"n:%d" % value
+    try:
+        return u"n:%r" % float(value)
+    except (OverflowError, ValueError, TypeError):
+        return None
+
+
+class MatchIndex(object):
+    """Routes an event to the listeners that can possibly match it.
+
+    Listeners with an exact condition (:class:`durian.match.able.Is` or a
+    plain value) are kept in hash buckets keyed by the field and the
+    value, listeners with a :class:`durian.match.able.Startswith` or
+    :class:`durian.match.able.Endswith` condition are kept in per field
+    tries, listeners with a :class:`durian.match.able.Contains` condition
+    (or a :class:`durian.match.able.Like` condition that is a plain
+    string) are kept in per field Aho-Corasick automatons, listeners
+    without conditions are kept in a wildcard set, and the rest has to be
+    matched one by one.
+
+    The candidates returned by :meth:`candidates` must still be tested
+    with the full match dict, as only one of the conditions is used to
+    route the event. If the value a string condition is routed by is not
+    a string (or its key is missing) all the listeners routed by string
+    conditions at that path are candidates, so they fail the same way as
+    with :func:`durian.match.strategy.deepmatch` (e.g.
+    :class:`durian.match.able.Startswith` raises :exc:`AttributeError`).
+
+    :param listeners: Initial list of listeners.
+
+    """
+
+    def __init__(self, listeners=()):
+        self.listeners = {}
+        self.routes = {}
+        self.buckets = {}
+        self.prefixes = {}
+        self.suffixes = {}
+        self.automatons = {}
+        self.string_routes = {}
+        self.wildcards = set()
+        self.unindexed = set()
+        self.mutex = threading.RLock()
+        self.update(listeners)
+
+    def add(self, listener):
+        """Add a listener to the index, replacing any previous listener
+        with the same primary key."""
+        self.mutex.acquire()
+        try:
+            route = route_for(listener.match)
+            if self.routes.get(listener.pk) != route:
+                self.remove(listener)
+                self._add_route(listener.pk, route)
+                self.routes[listener.pk] = route
+            self.listeners[listener.pk] = listener
+        finally:
+            self.mutex.release()
+
+    def remove(self, listener):
+        """Remove a listener from the index."""
+        self.mutex.acquire()
+        try:
+            self.listeners.pop(listener.pk, None)
+            route = self.routes.pop(listener.pk, None)
+            if route is not None:
+                self._remove_route(listener.pk, route)
+        finally:
+            self.mutex.release()
+
+    def update(self, listeners):
+        """Update the index to contain exactly these listeners.
+
+        Only listeners which have been added, removed or whose conditions
+        have changed are re-indexed.
+
+        """
+        self.mutex.acquire()
+        try:
+            listeners = list(listeners)
+            current = set(listener.pk for listener in listeners)
+            for pk, listener in self.listeners.items():
+                if pk not in current:
+                    self.remove(listener)
+            for listener in listeners:
+                self.add(listener)
+        finally:
+            self.mutex.release()
+
+    def candidates(self, payload):
+        """Get the listeners that can possibly match an event,
+        sorted by primary key."""
+        self.mutex.acquire()
+        try:
+            found = self.wildcards | self.unindexed
+            for path, bucket in self.buckets.items():
+                try:
+                    found.update(bucket.get(resolve(payload, path), ()))
+                except (KeyError, TypeError):
+                    pass
+            strings = {}
+            for path, pks in self.string_routes.items():
+                try:
+                    value = resolve(payload, path)
+                except KeyError:
+                    continue
+                if isinstance(value, basestring):
+                    strings[path] = value
+                else:
+                    found.update(pks)
+            for path, trie in self.prefixes.items():
+                if path in strings:
+                    found.update(trie.prefixes(strings[path]))
+            for path, trie in self.suffixes.items():
+                if path in strings:
+                    found.update(trie.suffixes(strings[path]))
+            for path, automaton in self.automatons.items():
+                if path in strings:
+                    found.update(automaton.search(strings[path]))
+            return [self.listeners[pk] for pk in sorted(found)]
+        finally:
+            self.mutex.release()
+
+    def all(self):
+        """Get all the listeners in the index, sorted by primary key."""
+        return [self.listeners[pk] for pk in sorted(self.listeners)]
+
+    def _add_route(self, pk, route):
+        kind, path, value = route
+        if kind == ROUTE_EXACT:
+            bucket = self.buckets.setdefault(path, {})
+            bucket.setdefault(value, set()).add(pk)
+        elif kind == ROUTE_PREFIX:
+            self.string_routes.setdefault(path, set()).add(pk)
+            self.prefixes.setdefault(path, Trie()).add(value, pk)
+        elif kind == ROUTE_SUFFIX:
+            self.string_routes.setdefault(path, set()).add(pk)
+            self.suffixes.setdefault(path, SuffixTrie()).add(value, pk)
+        elif kind == ROUTE_CONTAINS:
+            self.string_routes.setdefault(path, set()).add(pk)
+            self.automatons.setdefault(path, Automaton()).add(value, pk)
+        elif kind == ROUTE_WILDCARD:
+            self.wildcards.add(pk)
+        else:
+            self.unindexed.add(pk)
+
+    def _remove_route(self, pk, route):
+        kind, path, value = route
+        if kind == ROUTE_EXACT:
+            bucket = self.buckets[path]
+            bucket[value].discard(pk)
+            if not bucket[value]:
+                del(bucket[value])
+            if not bucket:
+                del(self.buckets[path])
+        elif kind in (ROUTE_PREFIX, ROUTE_SUFFIX, ROUTE_CONTAINS):
+            structures = {ROUTE_PREFIX: self.prefixes,
+                          ROUTE_SUFFIX: self.suffixes,
+                          ROUTE_CONTAINS: self.automatons}[kind]
+            structures[path].remove(value, pk)
+            if not structures[path]:
+                del(structures[path])
+            self.string_routes[path].discard(pk)
+            if not self.string_routes[path]:
+                del(self.string_routes[path])
+        elif kind == ROUTE_WILDCARD:
+            self.wildcards.discard(pk)
+        else:
+            self.unindexed.discard(pk)
+
+    def __len__(self):
+        return len(self.listeners)
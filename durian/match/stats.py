@@ -0,0 +1,209 @@
+"""durian.match.stats
+
+Statistics on how selective and how expensive the conditions of a hook
+are, used to test the cheapest and most selective conditions first (see
+:attr:`durian.event.Hook.reorder_conditions`).
+
+Conditions are grouped by path and kind (e.g. ``name`` and ``Like``),
+so the statistics of all the listeners of a hook testing the same field
+the same way are shared. A small sample of the evaluations are measured,
+testing every condition of the listener on its own; every
+``refresh_every`` samples the ranks are recomputed, and the compiled
+predicates of the listeners are recompiled in the new order.
+
+A single condition takes well under a microsecond to test, less than
+the resolution and overhead of the timer, so the samples of a match dict
+are measured in groups of ``group_size``: each condition is timed over
+the whole group with :func:`timeit.default_timer`, and the cost of one
+evaluation is the elapsed time divided by the size of the group.
+
+A condition is ranked by its average cost divided by the share of
+payloads it rejects, which is the order that minimizes the expected
+cost of a conjunction of independent conditions. Conditions that
+haven't been sampled yet are ranked by the static cost of their kind.
+
+"""
+from durian.match.able import Matchable
+from durian.match.index import resolve, has_path, iterconditions, PRESENT
+from timeit import default_timer
+
+"""
+.. data:: STATIC_COSTS
+
+    Rank of the conditions of a kind before they have been sampled.
+
+"""
+STATIC_COSTS = {"Any": 0, "present": 1, "Is": 1, "exact": 1,
+                "Startswith": 2, "Endswith": 2, "Contains": 3, "Like": 10}
+
+# Used instead of a zero rejection rate, so the rank stays finite.
+MIN_REJECT_RATE = 0.001
+
+
+def condition_kind(condition):
+    """Get the name the statistics of a condition are kept under."""
+    if condition is PRESENT:
+        return "present"
+    if isinstance(condition, Matchable):
+        return condition.__class__.__name__
+    return "exact"
+
+
+def test_condition(payload, path, condition):
+    """Test a single condition.
+
+    :returns: ``True`` if the condition accepts the payload. Errors are
+        counted as rejecting it.
+
+    """
+    if condition is PRESENT:
+        return has_path(payload, path)
+    try:
+        return not (resolve(payload, path) != condition)
+    except Exception:
+        return False
+
+
+class MatchStats(object):
+    """Selectivity and cost statistics for the conditions of a hook.
+
+    :keyword sample_every: See :attr:`sample_every`.
+    :keyword refresh_every: See :attr:`refresh_every`.
+    :keyword group_size: See :attr:`group_size`.
+
+    .. attribute:: sample_every
+
+        Measure one of this many evaluations.
+
+    .. attribute:: refresh_every
+
+        Recompute the ranks every this many samples.
+
+    .. attribute:: group_size
+
+        Measure the samples of a match dict when this many of them
+        have been collected, timing each condition over all of them.
+
+    .. attribute:: version
+
+        Incremented every time the ranks are recomputed.
+
+    """
+    sample_every = 100
+    refresh_every = 1000
+    group_size = 10
+
+    def __init__(self, sample_every=None, refresh_every=None,
+            group_size=None):
+        self.sample_every = sample_every or self.sample_every
+        self.refresh_every = refresh_every or self.refresh_every
+        self.group_size = group_size or self.group_size
+        self.conditions = {}
+        self.pending = {}
+        self.ranks = {}
+        self.version = 0
+        self.evaluations = 0
+        self.samples = 0
+
+    def should_sample(self):
+        """Count an evaluation, returns ``True`` if it should be
+        measured with :meth:`measure`."""
+        self.evaluations += 1
+        return not self.evaluations % self.sample_every
+
+    def measure(self, match, payload):
+        """Add a sample for the match dict, the samples are measured
+        with :meth:`measure_group` once there are :attr:`group_size` of
+        them."""
+        # Keyed by id, the match dict is kept alive by the group.
+        group = self.pending.setdefault(id(match), (match, []))
+        group[1].append(payload)
+        if len(group[1]) >= self.group_size:
+            del self.pending[id(match)]
+            self.measure_group(match, group[1])
+
+    def measure_group(self, match, payloads):
+        """Test every condition in the match dict on its own against
+        every payload, and record how many payloads it rejected and how
+        long it took."""
+        for path, condition in iterconditions(match, include_empty=True):
+            time_start = default_timer()
+            accepted = [test_condition(payload, path, condition)
+                            for payload in payloads]
+            seconds = default_timer() - time_start
+            self.record(path, condition, accepted.count(False), seconds,
+                        evaluated=len(payloads))
+        refreshes = self.samples // self.refresh_every
+        self.samples += len(payloads)
+        if self.samples // self.refresh_every > refreshes:
+            self.refresh()
+
+    def record(self, path, condition, rejected, seconds, evaluated=1):
+        """Record evaluations of a condition.
+
+        :param rejected: How many of the payloads it rejected.
+        :param seconds: The time taken by all of the evaluations.
+        :keyword evaluated: How many payloads it was tested against.
+
+        """
+        key = (path, condition_kind(condition))
+        counts = self.conditions.get(key)
+        if counts is None:
+            counts = self.conditions[key] = [0, 0, 0.0]
+        counts[0] += evaluated
+        counts[1] += rejected
+        counts[2] += seconds
+
+    def refresh(self):
+        """Recompute the ranks from the statistics so far."""
+        self.ranks = dict((key, self._rank(counts))
+                            for key, counts in self.conditions.items())
+        self.version += 1
+
+    def rank(self, path, condition):
+        """Get the rank of a condition, the lowest ranked conditions
+        should be tested first."""
+        kind = condition_kind(condition)
+        rank = self.ranks.get((path, kind))
+        if rank is None:
+            # Not sampled yet, tested before the sampled conditions so a
+            # new condition can't hide behind an expensive one.
+            return (0, STATIC_COSTS.get(kind, 5))
+        return (1, rank)
+
+    def _rank(self, counts):
+        evaluated, rejected, seconds = counts
+        reject_rate = max(float(rejected) / evaluated, MIN_REJECT_RATE)
+        return (seconds / evaluated) / reject_rate
+
+    def clear(self):
+        """Forget all the statistics."""
+        self.conditions.clear()
+        self.pending.clear()
+        self.ranks = {}
+        self.version += 1
+        self.evaluations = self.samples = 0
+
+    @property
+    def stats(self):
+        """The statistics of every condition, in the order they're
+        tested (most selective and cheapest first).
+
+        A list of dicts with the keys ``path`` (e.g.
+        ``"address.zip"``), ``kind``, ``evaluated``, ``rejected``,
+        ``reject_rate``, ``avg_cost`` (in seconds) and ``rank``.
+
+        """
+        report = []
+        for (path, kind), counts in self.conditions.items():
+            evaluated, rejected, seconds = counts
+            report.append({"path": ".".join(map(unicode, path)),
+                           "kind": kind,
+                           "evaluated": evaluated,
+                           "rejected": rejected,
+                           "reject_rate": float(rejected) / evaluated,
+                           "avg_cost": seconds / evaluated,
+                           "rank": self.ranks.get((path, kind))})
+        report.sort(key=lambda entry: (entry["rank"] is not None,
+                                       entry["rank"]))
+        return report
@@ -0,0 +1,96 @@
+"""durian.match.trie"""
+
+# Key used to store the items of a node, can't clash with
+# the children as they're all single characters.
+ITEMS = None
+
+
+class Trie(object):
+    """A character trie mapping string keys to sets of items.
+
+    Used to find all the keys that are a prefix of a value with a single
+    walk over the value, instead of testing each key separately.
+
+        >>> trie = Trie()
+        >>> trie.add("refs/heads/", "branches")
+        >>> trie.add("refs/", "refs")
+        >>> sorted(trie.prefixes("refs/heads/master"))
+        ['branches', 'refs']
+
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def add(self, key, item):
+        """Add ``item`` to the set of items stored under ``key``."""
+        node = self.root
+        for char in key:
+            node = node.setdefault(char, {})
+        items = node.setdefault(ITEMS, set())
+        if item not in items:
+            items.add(item)
+            self.size += 1
+
+    def remove(self, key, item):
+        """Remove ``item`` from the set of items stored under ``key``.
+
+        Nodes left without children or items are pruned.
+
+        """
+        trail = [self.root]
+        for char in key:
+            node = trail[-1].get(char)
+            if node is None:
+                return
+            trail.append(node)
+        items = trail[-1].get(ITEMS)
+        if not items or item not in items:
+            return
+        items.discard(item)
+        self.size -= 1
+        if not items:
+            del(trail[-1][ITEMS])
+        for depth in range(len(key), 0, -1):
+            if trail[depth]:
+                break
+            del(trail[depth - 1][key[depth - 1]])
+
+    def prefixes(self, value):
+        """Get all the items stored under a key that is a prefix
+        of ``value``."""
+        found = set()
+        node = self.root
+        if ITEMS in node:
+            found.update(node[ITEMS])
+        for char in value:
+            node = node.get(char)
+            if node is None:
+                break
+            if ITEMS in node:
+                found.update(node[ITEMS])
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class SuffixTrie(Trie):
+    """A :class:`Trie` matching keys that are a suffix of a value.
+
+    The keys are stored reversed, so finding the suffixes is a single walk
+    backwards over the value.
+
+    """
+
+    def add(self, key, item):
+        super(SuffixTrie, self).add(key[::-1], item)
+
+    def remove(self, key, item):
+        super(SuffixTrie, self).remove(key[::-1], item)
+
+    def suffixes(self, value):
+        """Get all the items stored under a key that is a suffix
+        of ``value``."""
+        return self.prefixes(value[::-1])
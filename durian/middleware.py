@@ -0,0 +1,25 @@
+"""durian.middleware"""
+from durian import coalesce
+
+
+class CoalesceMiddleware(object):
+    """Buffer the :class:`durian.event.ModelHook` events sent during a
+    request, so only one event per instance is sent (see
+    :mod:`durian.coalesce`).
+
+    The events are sent when the response is returned, or thrown away if
+    the view raises an exception. Put it before
+    ``django.middleware.transaction.TransactionMiddleware`` so the events
+    are sent after the transaction has been committed.
+
+    """
+
+    def process_request(self, request):
+        coalesce.begin()
+
+    def process_response(self, request, response):
+        coalesce.end()
+        return response
+
+    def process_exception(self, request, exception):
+        coalesce.end(discard=True)
@@ -1,20 +1,79 @@
 from django.db import models
+from django.db.models import signals, Q
 from django.utils.translation import ugettext_lazy as _
-from celery.fields import PickledObjectField
-from celery.serialization import pickle
+from django.utils.encoding import smart_str
+from durian.fields import MatchField, ConfigField
+from durian.cache import listeners
+from durian.match.index import route_for, condition_row, iterleaves
+from durian.match.index import ROUTE_EXACT
+from durian.match.compiler import compile_match
+from datetime import datetime
+import hashlib
+
+
+class ListenerManager(models.Manager):
+
+    def candidates(self, hook_name, payload):
+        """Get the listeners for a hook that can possibly match the
+        payload, sorted by primary key.
+
+        Only the listeners whose exact condition (see
+        :class:`ListenerCondition`) is found in the payload, and the
+        :attr:`Listener.wildcard` listeners, are fetched from the
+        database.
+
+        """
+        return self.candidates_many(hook_name, [payload])
+
+    def candidates_many(self, hook_name, payloads):
+        """Get the listeners for a hook that can possibly match any of
+        the payloads, with a single query. See :meth:`candidates`."""
+        keys = set()
+        for payload in payloads:
+            for path, value in iterleaves(payload):
+                row = condition_row(path, value)
+                if row is not None:
+                    keys.add(condition_key(hook_name, *row))
+        wanted = Q(wildcard=True)
+        if keys:
+            conditions = ListenerCondition.objects.filter(key__in=list(keys))
+            wanted |= Q(pk__in=conditions.values_list("listener", flat=True))
+        return self.filter(hook=hook_name).filter(wanted).order_by("pk")
+
+    def reindex(self, hook_name=None):
+        """Rewrite the :class:`ListenerCondition` rows (and the
+        :attr:`Listener.wildcard` flag) of all listeners, or the
+        listeners of one hook.
+
+        Needed for listeners saved by earlier versions, or changed by
+        bulk updates.
+
+        """
+        listeners = self.all()
+        if hook_name is not None:
+            listeners = listeners.filter(hook=hook_name)
+        for listener in listeners.iterator():
+            index_listener_conditions(listener)
+            self.filter(pk=listener.pk).update(wildcard=listener.wildcard)
 
 
 class Listener(models.Model):
-    hook = models.CharField(_("hook"), max_length=255,
+    hook = models.CharField(_("hook"), max_length=255, db_index=True,
                             help_text=_("Connects to hook"))
     url = models.URLField(verify_exists=False,
                           help_text=_("The URL I'm listening at."))
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    config = PickledObjectField(_("configuration"), default=pickle.dumps({}),
-                                help_text=_("Hook specific configuration."))
-    match = PickledObjectField(_(u"conditions"), default=pickle.dumps({}),
-                                help_text=_("Hook specific event filter"))
+    config = ConfigField(_("configuration"), default=dict,
+                         help_text=_("Hook specific configuration."))
+    match = MatchField(_(u"conditions"), default=dict,
+                       help_text=_("Hook specific event filter"))
+    wildcard = models.BooleanField(_("wildcard"), default=True,
+                    db_index=True, editable=False,
+                    help_text=_("Has no exact condition, so the listener "
+                                "must be tested with every event."))
+
+    objects = ListenerManager()
 
     class Meta:
         verbose_name = _("listener")
@@ -23,3 +82,188 @@ class Listener(models.Model):
     def __unicode__(self):
         return "%s match:%s config:%s" % (
                 self.url, self.match, self.config)
+
+    def __reduce__(self):
+        # The compiled match predicate can't be pickled.
+        unpickle, args, data = super(Listener, self).__reduce__()
+        data = dict(data)
+        data.pop("_match_predicate", None)
+        return (unpickle, args, data)
+
+    def matches(self, payload, stats=None):
+        """Returns ``True`` if the payload matches the conditions in
+        :attr:`match`.
+
+        The match dict is compiled into a predicate the first time (see
+        :func:`durian.match.compiler.compile_match`), and compiled again
+        if :attr:`match` is replaced. Changing the match dict in place
+        is not noticed.
+
+        :keyword stats: A :class:`durian.match.stats.MatchStats`
+            instance. If given, the conditions are tested in the order
+            ranked by it, and a sample of the evaluations are measured.
+
+        """
+        version = None
+        if stats is not None:
+            version = stats.version
+        compiled = self.__dict__.get("_match_predicate")
+        if compiled is None or compiled[0] is not self.match or \
+                compiled[1] != version:
+            rank = stats is not None and stats.rank or None
+            compiled = (self.match, version,
+                        compile_match(self.match, rank=rank))
+            self._match_predicate = compiled
+        if stats is not None and self.match and stats.should_sample():
+            stats.measure(self.match, payload)
+        return compiled[2](payload)
+
+
+class ListenerCondition(models.Model):
+    """The exact condition of a listener, used to find the candidate
+    listeners for an event in the database
+    (:meth:`ListenerManager.candidates`).
+
+    Only one of the conditions is stored (the one the
+    :class:`durian.match.index.MatchIndex` would route by), so the
+    candidates must still be tested with the full match dict. The values
+    are stored as strings, see :func:`durian.match.index.condition_row`.
+
+    The rows are written when the listener is saved. They are looked up
+    by :attr:`key`, a digest of the hook, field and value, as an index
+    on the three columns would be too long for some databases (e.g.
+    MySQL).
+
+    """
+    listener = models.ForeignKey(Listener, related_name="conditions")
+    hook = models.CharField(_("hook"), max_length=255)
+    field = models.CharField(_("field"), max_length=255)
+    value = models.CharField(_("value"), max_length=255)
+    key = models.CharField(_("key"), max_length=40, db_index=True,
+                           editable=False)
+
+    class Meta:
+        verbose_name = _("listener condition")
+        verbose_name_plural = _("listener conditions")
+
+    def __unicode__(self):
+        return "%s=%s" % (self.field, self.value)
+
+
+class Payload(models.Model):
+    """An encoded payload kept by :class:`durian.store.DatabaseStore`."""
+    digest = models.CharField(_("digest"), max_length=40, unique=True)
+    body = models.TextField(_("body"))
+    last_used = models.DateTimeField(_("last used"), default=datetime.now,
+                                     db_index=True)
+    refs = models.IntegerField(_("references"), default=0)
+    expires = models.DateTimeField(_("expires"), db_index=True)
+
+    class Meta:
+        verbose_name = _("payload")
+        verbose_name_plural = _("payloads")
+
+    def __unicode__(self):
+        return self.digest
+
+
+class DeadLetterPayload(models.Model):
+    """The encoded payload of one or more :class:`DeadLetter` entries,
+    stored once per unique payload."""
+    digest = models.CharField(_("digest"), max_length=40, unique=True)
+    body = models.TextField(_("body"))
+    last_used = models.DateTimeField(_("last used"), default=datetime.now,
+                                     db_index=True)
+
+    class Meta:
+        verbose_name = _("dead letter payload")
+        verbose_name_plural = _("dead letter payloads")
+
+    def __unicode__(self):
+        return self.digest
+
+
+class DeadLetter(models.Model):
+    """A delivery that failed after all its retries, see
+    :mod:`durian.deadletter`."""
+    listener = models.ForeignKey(Listener, null=True,
+                                 related_name="dead_letters")
+    hook = models.CharField(_("hook"), max_length=255, db_index=True)
+    url = models.URLField(verify_exists=False)
+    payload = models.ForeignKey(DeadLetterPayload, null=True,
+                                related_name="dead_letters")
+    error = models.TextField(_("last error"), blank=True)
+    attempts = models.PositiveIntegerField(_("attempts"), default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("dead letter")
+        verbose_name_plural = _("dead letters")
+
+    def __unicode__(self):
+        return "%s (%s attempts): %s" % (self.url, self.attempts,
+                                         self.error)
+
+
+class OutboxEvent(models.Model):
+    """An event sent by a hook in outbox mode, waiting to be dispatched
+    by :func:`durian.outbox.drain_outbox`."""
+    hook = models.CharField(_("hook"), max_length=255)
+    body = models.TextField(_("body"))
+    created_at = models.DateTimeField(auto_now_add=True)
+    claim = models.CharField(_("claim"), max_length=36, blank=True,
+                             db_index=True)
+    claimed_until = models.DateTimeField(_("claimed until"), null=True,
+                                         db_index=True)
+
+    class Meta:
+        verbose_name = _("outbox event")
+        verbose_name_plural = _("outbox events")
+
+    def __unicode__(self):
+        return "%s: %s" % (self.hook, self.body)
+
+
+def condition_key(hook_name, field, value):
+    """Get the :attr:`ListenerCondition.key` of a condition."""
+    return hashlib.sha1("\0".join(map(smart_str, (hook_name, field,
+                                                   value)))).hexdigest()
+
+
+def get_condition_row(listener):
+    """Get the ``(field, value)`` of the condition to store for a
+    listener, or ``None`` if it has no storable exact condition."""
+    kind, path, value = route_for(listener.match)
+    if kind == ROUTE_EXACT and value is not None:
+        return condition_row(path, value)
+
+
+def index_listener_conditions(listener):
+    """Rewrite the :class:`ListenerCondition` rows of a listener."""
+    row = get_condition_row(listener)
+    listener.wildcard = row is None
+    listener.conditions.all().delete()
+    if row is not None:
+        ListenerCondition.objects.create(listener=listener,
+                                         hook=listener.hook,
+                                         field=row[0], value=row[1],
+                                         key=condition_key(listener.hook,
+                                                           *row))
+
+
+def set_listener_wildcard(sender, instance, **kwargs):
+    instance.wildcard = get_condition_row(instance) is None
+signals.pre_save.connect(set_listener_wildcard, sender=Listener)
+
+
+def update_listener_conditions(sender, instance, **kwargs):
+    index_listener_conditions(instance)
+signals.post_save.connect(update_listener_conditions, sender=Listener)
+
+
+def invalidate_listener_cache(sender, instance, **kwargs):
+    """Invalidate the cached listeners for the hook of a changed
+    listener."""
+    listeners.invalidate(instance.hook)
+signals.post_save.connect(invalidate_listener_cache, sender=Listener)
+signals.post_delete.connect(invalidate_listener_cache, sender=Listener)
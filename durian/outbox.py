@@ -0,0 +1,129 @@
+"""durian.outbox
+
+Hooks in outbox mode (:attr:`durian.event.Hook.outbox`) don't talk to the
+broker when an event is sent, they only insert the encoded payload into
+the :class:`durian.models.OutboxEvent` table. The row is part of the
+current database transaction, so the event is only dispatched if the
+transaction commits, and the request doesn't wait for the broker.
+
+The events are dispatched by :func:`drain_outbox`, e.g. with the
+``durian_drain_outbox`` management command. Drainers claim a batch of
+events at a time, so several of them can run at the same time without
+dispatching an event twice. An event is deleted when it has been
+dispatched; if the drainer dies before that, the claim expires after
+:data:`durian.conf.OUTBOX_LEASE` seconds and the event is dispatched by
+the next drainer.
+
+"""
+from datetime import datetime, timedelta
+from django.db.models import Q
+from celery.utils import gen_unique_id
+from durian.payload import encode_payload, decode_payload
+from durian.registry import hooks
+from durian import conf
+import logging
+import time
+
+
+def add_to_outbox(hook_name, payload):
+    """Store an event in the outbox.
+
+    :param hook_name: Name of the hook sending the event.
+    :param payload: The prepared payload.
+
+    :returns: :class:`durian.models.OutboxEvent`.
+
+    """
+    from durian.models import OutboxEvent
+    return OutboxEvent.objects.create(hook=hook_name,
+                                      body=encode_payload(payload).body)
+
+
+def claim_events(batch_size=1000, lease=None, hook_names=None):
+    """Claim a batch of events in the outbox, oldest first.
+
+    Events already claimed by another drainer are skipped, unless the
+    claim has expired.
+
+    :keyword batch_size: Maximum number of events to claim.
+    :keyword lease: Number of seconds the events are reserved for us.
+        Default is :data:`durian.conf.OUTBOX_LEASE`.
+    :keyword hook_names: Only claim the events of these hooks.
+
+    :returns: List of :class:`durian.models.OutboxEvent`.
+
+    """
+    from durian.models import OutboxEvent
+    now = datetime.now()
+    claimable = OutboxEvent.objects.filter(Q(claimed_until__isnull=True) |
+                                           Q(claimed_until__lt=now))
+    if hook_names is not None:
+        claimable = claimable.filter(hook__in=list(hook_names))
+    pks = list(claimable.order_by("pk").values_list("pk", flat=True)
+                                                         [:batch_size])
+    if not pks:
+        return []
+    # The claimable filter is applied again by the update, so events
+    # claimed by someone else in the meantime are left alone.
+    claim = gen_unique_id()
+    until = now + timedelta(seconds=lease or conf.OUTBOX_LEASE)
+    claimable.filter(pk__in=pks).update(claim=claim, claimed_until=until)
+    return list(OutboxEvent.objects.filter(claim=claim).order_by("pk"))
+
+
+def dispatch_event(event):
+    """Dispatch an outbox event to the listeners of its hook.
+
+    :returns: The results of :meth:`durian.event.Hook.dispatch`.
+
+    :raises celery.exceptions.NotRegistered: if the hook is not
+        registered in this process.
+
+    """
+    hook = hooks[event.hook]
+    return hook.dispatch(None, decode_payload(event.body))
+
+
+def drain_outbox(batch_size=1000, lease=None, hook_names=None):
+    """Dispatch all the events in the outbox.
+
+    The events are claimed ``batch_size`` at a time (see
+    :func:`claim_events`), and deleted from the outbox in bulk when
+    they have been dispatched. Events that can't be dispatched are left
+    in the outbox, and tried again when their claim has expired.
+
+    :keyword batch_size: Number of events to claim at a time.
+    :keyword lease: See :func:`claim_events`.
+    :keyword hook_names: Only dispatch the events of these hooks.
+
+    :returns: The number of events dispatched.
+
+    """
+    from durian.models import OutboxEvent
+    logger = logging.getLogger("durian.outbox")
+    dispatched = 0
+    while True:
+        events = claim_events(batch_size, lease=lease, hook_names=hook_names)
+        if not events:
+            break
+        done = []
+        for event in events:
+            try:
+                dispatch_event(event)
+            except Exception, exc:
+                logger.error("Couldn't dispatch outbox event %s: %r" % (
+                                event.pk, exc))
+            else:
+                done.append(event.pk)
+        OutboxEvent.objects.filter(pk__in=done).delete()
+        dispatched += len(done)
+    return dispatched
+
+
+def drain_forever(interval=1, **kwargs):
+    """Keep draining the outbox, sleeping ``interval`` seconds whenever
+    it's empty. Takes the same keyword arguments as :func:`drain_outbox`.
+    """
+    while True:
+        if not drain_outbox(**kwargs):
+            time.sleep(interval)
@@ -0,0 +1,97 @@
+"""durian.payload"""
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+from durian import conf
+from durian.utils import get_cls_by_name
+
+
+def encode_json(payload):
+    """The default payload encoder.
+
+    Encodes the payload as JSON, with support for dates, times and
+    decimals.
+
+    """
+    return simplejson.dumps(payload, cls=DjangoJSONEncoder)
+
+
+def get_encoder():
+    """Get the payload encoder (the ``DURIAN_PAYLOAD_ENCODER`` setting)."""
+    return get_cls_by_name(conf.PAYLOAD_ENCODER)
+
+
+def get_decoder():
+    """Get the payload decoder (the ``DURIAN_PAYLOAD_DECODER`` setting)."""
+    return get_cls_by_name(conf.PAYLOAD_DECODER)
+
+
+def immutable(method_name):
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s is immutable" % self.__class__.__name__)
+    _immutable.__name__ = method_name
+    return _immutable
+
+
+class EncodedPayload(dict):
+    """A payload that has already been encoded.
+
+    The payload is encoded once by :meth:`durian.event.Hook.send`, and
+    the same body is used for the POST to every listener. It's still a
+    dict, so tasks can read the payload, but it can't be changed as that
+    would make the body stale.
+
+    When pickled (e.g. into a task message) only the body is included.
+
+    :param payload: The payload dict.
+    :keyword body: The encoded payload. If not provided, the payload is
+        encoded using the ``DURIAN_PAYLOAD_ENCODER`` setting.
+
+    .. attribute:: body
+
+        The encoded payload.
+
+    """
+
+    def __init__(self, payload, body=None):
+        dict.__init__(self, payload)
+        if body is None:
+            body = get_encoder()(payload)
+        self.body = body
+
+    def __reduce__(self):
+        return (decode_payload, (self.body, ))
+
+    __setitem__ = immutable("__setitem__")
+    __delitem__ = immutable("__delitem__")
+    clear = immutable("clear")
+    pop = immutable("pop")
+    popitem = immutable("popitem")
+    setdefault = immutable("setdefault")
+    update = immutable("update")
+
+
+def decode_payload(body):
+    """Create an :class:`EncodedPayload` from its encoded body."""
+    return EncodedPayload(get_decoder()(body), body)
+
+
+def encode_payload(payload):
+    """Encode the payload, if it's not already encoded.
+
+    :returns: :class:`EncodedPayload`.
+
+    """
+    if isinstance(payload, EncodedPayload):
+        return payload
+    return EncodedPayload(payload)
+
+
+def payload_body(payload):
+    """Get the encoded body of a payload, encoding it if necessary.
+
+    A :class:`durian.store.PayloadReference` is resolved first.
+
+    """
+    from durian.store import resolve_payload
+    return encode_payload(resolve_payload(payload)).body
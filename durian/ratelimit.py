@@ -0,0 +1,209 @@
+"""durian.ratelimit"""
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from durian import conf
+from durian.utils import get_cls_by_name
+import hashlib
+import time
+
+RATE_UNITS = {"s": 1, "m": 60, "h": 60 * 60}
+
+"""
+.. data:: LIMIT_KEYS
+
+    The keys in :attr:`durian.models.Listener.config` that override the
+    limits of the hook for a listener.
+
+"""
+LIMIT_KEYS = ("rate_limit", "rate_limit_burst", "max_in_flight")
+
+
+class RateLimited(Exception):
+    """The listener host is over its rate limit or in-flight cap.
+
+    .. attribute:: host
+
+        The host of the listener URL.
+
+    .. attribute:: retry_after
+
+        Number of seconds to wait before trying again.
+
+    """
+
+    def __init__(self, host, retry_after):
+        self.host = host
+        self.retry_after = retry_after
+        super(RateLimited, self).__init__(
+                "%s is over its limits, retry in %.2f seconds." % (
+                    host, retry_after))
+
+
+def parse_rate(rate):
+    """Convert a rate limit to requests per second.
+
+    The rate can be a number (requests per second), or a string like
+    ``"10/s"``, ``"600/m"`` or ``"3600/h"``. Returns ``None`` if there
+    is no rate limit.
+
+    """
+    if not rate:
+        return None
+    if isinstance(rate, basestring):
+        count, _, unit = rate.partition("/")
+        return float(count) / RATE_UNITS[unit.strip() or "s"]
+    return float(rate)
+
+
+def listener_limits(config):
+    """Get the limit overrides from a listener configuration."""
+    if not isinstance(config, dict):
+        return {}
+    return dict((key, config[key]) for key in LIMIT_KEYS if key in config)
+
+
+class HostLimiter(object):
+    """Rate limits and in-flight request caps per listener host,
+    shared by all workers.
+
+    Rate limits are token buckets refilled at the rate limit, holding
+    up to ``burst`` tokens. The buckets and the in-flight counters are
+    kept in :attr:`backend`.
+
+    :keyword backend: See :attr:`backend`.
+
+    .. attribute:: backend
+
+        Object with the Django cache API (``get``, ``set``, ``add``,
+        ``incr``, ``decr`` and ``delete``), e.g.
+        :class:`durian.breaker.LocalBackend`. Defaults to the
+        ``DURIAN_RATE_LIMIT_BACKEND`` setting, or
+        :data:`django.core.cache.cache`.
+
+    .. attribute:: delay
+
+        Number of seconds to wait before trying again when the
+        in-flight cap is reached.
+
+    .. attribute:: in_flight_timeout
+
+        The in-flight counters expire after this many seconds, so
+        counts leaked by killed workers doesn't block the host forever.
+
+    """
+    key_format = "durian.ratelimit.%s.%s"
+    lock_timeout = 5
+    lock_attempts = 10
+
+    def __init__(self, backend=None, delay=None, in_flight_timeout=None):
+        if backend is None:
+            backend = conf.RATE_LIMIT_BACKEND and \
+                        get_cls_by_name(conf.RATE_LIMIT_BACKEND)() or cache
+        self.backend = backend
+        self.delay = delay or conf.RATE_LIMIT_DELAY
+        self.in_flight_timeout = in_flight_timeout or \
+                                    conf.RATE_LIMIT_IN_FLIGHT_TIMEOUT
+
+    def acquire(self, host, rate_limit=None, rate_limit_burst=None,
+            max_in_flight=None):
+        """Try to get a slot for a request to the host.
+
+        :keyword rate_limit: See :func:`parse_rate`.
+        :keyword rate_limit_burst: The size of the token bucket.
+            Defaults to one second worth of requests (at least one).
+        :keyword max_in_flight: Maximum number of requests in flight to
+            the host.
+
+        :returns: ``0`` if the request can be made now, in which case
+            :meth:`release` must be called when it's done. Otherwise the
+            number of seconds to wait before trying again.
+
+        """
+        if max_in_flight:
+            key = self._key(host, "in_flight")
+            self.backend.add(key, 0, self.in_flight_timeout)
+            if self._incr(key) > max_in_flight:
+                self._decr(key)
+                return self.delay
+        rate = parse_rate(rate_limit)
+        if rate:
+            burst = rate_limit_burst or max(rate, 1)
+            wait = self.take_token(host, rate, burst)
+            if wait:
+                if max_in_flight:
+                    self._decr(self._key(host, "in_flight"))
+                return wait
+        return 0
+
+    def check(self, host, **limits):
+        """Like :meth:`acquire`, but raises :exc:`RateLimited` if the
+        request can't be made now."""
+        wait = self.acquire(host, **limits)
+        if wait:
+            raise RateLimited(host, wait)
+
+    def release(self, host, max_in_flight=None, **kwargs):
+        """Release the slot acquired by :meth:`acquire`."""
+        if max_in_flight:
+            self._decr(self._key(host, "in_flight"))
+
+    def take_token(self, host, rate, burst):
+        """Take a token from the bucket of a host.
+
+        :returns: ``0`` if a token was taken, otherwise the number of
+            seconds until there is one.
+
+        """
+        lock_key = self._key(host, "lock")
+        for i in xrange(self.lock_attempts):
+            if self.backend.add(lock_key, 1, self.lock_timeout):
+                break
+            time.sleep(0.01)
+        else:
+            return 1.0 / rate
+        try:
+            key = self._key(host, "bucket")
+            now = time.time()
+            tokens, last = self.backend.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.backend.set(key, (tokens, now),
+                             int(burst / rate) + self.lock_timeout)
+            return wait
+        finally:
+            self.backend.delete(lock_key)
+
+    def _incr(self, key):
+        try:
+            return self.backend.incr(key)
+        except ValueError:
+            # Expired between add and incr.
+            self.backend.add(key, 1, self.in_flight_timeout)
+            return 1
+
+    def _decr(self, key):
+        try:
+            self.backend.decr(key)
+        except ValueError:
+            pass
+
+    def _key(self, host, name):
+        # Hosts can contain characters not allowed in memcached keys.
+        digest = hashlib.md5(smart_str(host)).hexdigest()
+        return self.key_format % (digest, name)
+
+
+_limiter = None
+
+
+def get_limiter():
+    """Get the shared :class:`HostLimiter` configured by the
+    ``DURIAN_RATE_LIMIT_*`` settings."""
+    global _limiter
+    if _limiter is None:
+        _limiter = HostLimiter()
+    return _limiter
@@ -0,0 +1,383 @@
+"""durian.store"""
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F
+from durian import conf
+from durian.payload import decode_payload
+from durian.utils import get_cls_by_name, LRUCache
+from datetime import datetime, timedelta
+import hashlib
+import os
+import errno
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class PayloadMissing(Exception):
+    """The payload has expired or was never stored."""
+
+
+class BaseStore(object):
+    """Base class for payload stores.
+
+    A payload store keeps encoded payloads under the hash of their
+    content, so task messages only have to carry the hash. Each entry has
+    a reference count, which is the number of deliveries still using it.
+    An entry is deleted when the count reaches zero, or when it expires
+    (after :attr:`timeout` seconds).
+
+    .. attribute:: timeout
+
+        Number of seconds to keep an entry, even if it still has
+        references. Defaults to the ``DURIAN_PAYLOAD_STORE_TIMEOUT``
+        setting.
+
+    """
+    timeout = None
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or self.timeout or conf.PAYLOAD_STORE_TIMEOUT
+
+    def put(self, digest, body, refs=1):
+        """Store a body, and add ``refs`` references to it."""
+        raise NotImplementedError("Stores must implement put")
+
+    def get(self, digest):
+        """Get a body by its digest, or ``None`` if it's not stored."""
+        raise NotImplementedError("Stores must implement get")
+
+    def release(self, digest, refs=1):
+        """Remove ``refs`` references to a body, deleting the body
+        if there are no references left."""
+        raise NotImplementedError("Stores must implement release")
+
+
+class CacheStore(BaseStore):
+    """Store payloads in the Django cache.
+
+    The cache must be shared by the web processes and the workers
+    (e.g. memcached).
+
+    The reference count is kept under a separate key, and both keys are
+    only changed while holding a lock (a key created with the atomic
+    ``add``), so a :meth:`release` can't delete a body another process
+    has just added a reference to.
+
+    .. attribute:: lock_timeout
+
+        Number of seconds before a lock expires, in case the process
+        holding it died. Also the longest time to wait for a lock.
+
+    """
+    key_format = "durian.payload.%s"
+    refs_key_format = "durian.payload.refs.%s"
+    lock_key_format = "durian.payload.lock.%s"
+    lock_timeout = 10
+
+    def __init__(self, timeout=None, backend=None):
+        super(CacheStore, self).__init__(timeout=timeout)
+        self.backend = backend or cache
+
+    def put(self, digest, body, refs=1):
+        refs_key = self.refs_key_format % digest
+        self._lock(digest)
+        try:
+            # Not incr, as it doesn't keep the timeout on all backends.
+            self.backend.set(refs_key,
+                             (self.backend.get(refs_key) or 0) + refs,
+                             self.timeout)
+            self.backend.set(self.key_format % digest, body, self.timeout)
+        finally:
+            self._unlock(digest)
+
+    def get(self, digest):
+        return self.backend.get(self.key_format % digest)
+
+    def release(self, digest, refs=1):
+        refs_key = self.refs_key_format % digest
+        self._lock(digest)
+        try:
+            remaining = (self.backend.get(refs_key) or 0) - refs
+            if remaining > 0:
+                self.backend.set(refs_key, remaining, self.timeout)
+            else:
+                self.backend.delete(self.key_format % digest)
+                self.backend.delete(refs_key)
+        finally:
+            self._unlock(digest)
+
+    def _lock(self, digest):
+        lock_key = self.lock_key_format % digest
+        give_up = time.time() + self.lock_timeout
+        while not self.backend.add(lock_key, 1, self.lock_timeout):
+            if time.time() > give_up:
+                # The holder must have died, the lock expires anyway.
+                break
+            time.sleep(0.01)
+
+    def _unlock(self, digest):
+        self.backend.delete(self.lock_key_format % digest)
+
+
+class DatabaseStore(BaseStore):
+    """Store payloads in the database
+    (the :class:`durian.models.Payload` model).
+
+    An entry is only deleted by a conditional ``DELETE`` when it has no
+    references left, and :meth:`put` creates the entry again if it was
+    deleted after it was found, so a payload is never lost to a
+    concurrent :meth:`release`.
+
+    """
+
+    @property
+    def model(self):
+        from durian.models import Payload
+        return Payload
+
+    def put(self, digest, body, refs=1):
+        expires = datetime.now() + timedelta(seconds=self.timeout)
+        while True:
+            entry, created = self.model.objects.get_or_create(
+                    digest=digest,
+                    defaults={"body": body, "refs": refs, "expires": expires})
+            if created or self.model.objects.filter(pk=entry.pk).update(
+                    refs=F("refs") + refs, expires=expires):
+                return
+            # Released and deleted since we found it.
+
+    def get(self, digest):
+        try:
+            entry = self.model.objects.get(digest=digest,
+                                           expires__gt=datetime.now())
+        except self.model.DoesNotExist:
+            return None
+        return entry.body
+
+    def release(self, digest, refs=1):
+        self.model.objects.filter(digest=digest).update(
+                refs=F("refs") - refs)
+        # QuerySet.delete() selects the rows before deleting them, so a
+        # reference added in between would be deleted with the entry.
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM %s WHERE %s = %%s AND %s <= 0" % (
+                            qn(self.model._meta.db_table), qn("digest"),
+                            qn("refs")), [digest])
+        transaction.commit_unless_managed()
+
+    def cleanup(self):
+        """Delete expired entries."""
+        self.model.objects.filter(expires__lte=datetime.now()).delete()
+
+
+class FileStore(BaseStore):
+    """Store payloads as files in a directory shared by the web processes
+    and the workers (the ``DURIAN_PAYLOAD_STORE_DIR`` setting).
+
+    The reference count is kept in a separate file, and the body is
+    only written or removed while holding an exclusive lock on it.
+
+    """
+
+    def __init__(self, timeout=None, directory=None):
+        super(FileStore, self).__init__(timeout=timeout)
+        self.directory = directory or conf.PAYLOAD_STORE_DIR
+
+    def put(self, digest, body, refs=1):
+        path = self.path(digest)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        fh = self._lock_refs(digest)
+        try:
+            self._write_refs(fh, self._read_refs(fh) + refs)
+            if not os.path.exists(path):
+                # Write to a temporary file first, so readers never see
+                # a partial body.
+                tmp_path = "%s.%d.tmp" % (path, os.getpid())
+                body_fh = open(tmp_path, "wb")
+                try:
+                    body_fh.write(body)
+                finally:
+                    body_fh.close()
+                os.rename(tmp_path, path)
+        finally:
+            fh.close()
+
+    def get(self, digest):
+        path = self.path(digest)
+        try:
+            if os.path.getmtime(path) + self.timeout < time.time():
+                return None
+            fh = open(path, "rb")
+        except (OSError, IOError):
+            return None
+        try:
+            return fh.read()
+        finally:
+            fh.close()
+
+    def release(self, digest, refs=1):
+        try:
+            fh = self._lock_refs(digest)
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return # Never stored.
+        try:
+            remaining = self._read_refs(fh) - refs
+            if remaining > 0:
+                self._write_refs(fh, remaining)
+                return
+            # The reference count file is removed last, while we still
+            # hold the lock on it.
+            for path in (self.path(digest), self.path(digest) + ".refs"):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+        finally:
+            fh.close()
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _lock_refs(self, digest):
+        """Open the reference count file with an exclusive lock."""
+        refs_path = self.path(digest) + ".refs"
+        while True:
+            fh = open(refs_path, "a+")
+            if fcntl is None:
+                return fh
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.fstat(fh.fileno()).st_ino == os.stat(refs_path).st_ino:
+                    return fh
+            except OSError:
+                pass
+            # Removed by a release while we were waiting for the lock,
+            # so the count we'd read is gone: open the new file.
+            fh.close()
+
+    def _read_refs(self, fh):
+        fh.seek(0)
+        return int(fh.read() or 0)
+
+    def _write_refs(self, fh, refs):
+        fh.seek(0)
+        fh.truncate()
+        fh.write(str(refs))
+        fh.flush()
+
+
+class PayloadReference(object):
+    """Reference to a payload kept in a payload store.
+
+    This is what's sent in task messages instead of the payload.
+
+    :param digest: See :attr:`digest`.
+    :param store: See :attr:`store`.
+
+    .. attribute:: digest
+
+        The hash of the encoded payload.
+
+    .. attribute:: store
+
+        Full class name of the payload store.
+
+    """
+
+    def __init__(self, digest, store):
+        self.digest = digest
+        self.store = store
+
+    def resolve(self):
+        """Get the payload from the store.
+
+        The payloads are kept in a process local LRU cache, so the store
+        is only asked once for each payload.
+
+        :raises PayloadMissing: if the payload is not in the store.
+
+        :returns: :class:`durian.payload.EncodedPayload`.
+
+        """
+        payload = resolved.get(self.digest)
+        if payload is None:
+            body = get_store(self.store).get(self.digest)
+            if body is None:
+                raise PayloadMissing("Payload %s is not in the store %s" % (
+                                        self.digest, self.store))
+            payload = resolved[self.digest] = decode_payload(body)
+        return payload
+
+    def release(self, refs=1):
+        """Tell the store we're done with the payload."""
+        get_store(self.store).release(self.digest, refs)
+
+    @property
+    def body(self):
+        return self.resolve().body
+
+    def __reduce__(self):
+        return (self.__class__, (self.digest, self.store))
+
+    def __repr__(self):
+        return "<PayloadReference: %s>" % self.digest
+
+
+def store_payload(payload, store, refs=1):
+    """Put an encoded payload into a store.
+
+    :param payload: :class:`durian.payload.EncodedPayload`.
+    :param store: Full class name of the store.
+    :keyword refs: The number of deliveries that will use the payload.
+
+    :returns: :class:`PayloadReference`.
+
+    """
+    digest = hashlib.sha1(payload.body).hexdigest()
+    get_store(store).put(digest, payload.body, refs)
+    return PayloadReference(digest, store)
+
+
+def resolve_payload(payload):
+    """Get the payload a :class:`PayloadReference` refers to. Any other
+    payload is returned as-is."""
+    if isinstance(payload, PayloadReference):
+        return payload.resolve()
+    return payload
+
+
+def release_payload(payload, refs=1):
+    """Release a :class:`PayloadReference`. Any other payload
+    is ignored."""
+    if isinstance(payload, PayloadReference):
+        payload.release(refs)
+
+
+_stores = {}
+
+
+def get_store(name):
+    """Get a payload store instance by its full class name."""
+    if name not in _stores:
+        _stores[name] = get_cls_by_name(name)()
+    return _stores[name]
+
+"""
+.. data:: resolved
+
+    LRU cache of the payloads resolved by this process.
+
+"""
+resolved = LRUCache(conf.PAYLOAD_CACHE_SIZE)
@@ -1,49 +1,481 @@
 from celery.task.base import Task
 from celery.registry import tasks
-from celery.exceptions import MaxRetriesExceededError
-from anyjson import serialize
+from celery.exceptions import RetryTaskError
+from celery.utils import chunks
+from durian.connection import connections
+from durian.payload import payload_body
+from durian.store import release_payload, PayloadMissing
+from durian.engine import get_engine
+from durian.breaker import CircuitOpen, get_breaker, host_for
+from durian.ratelimit import RateLimited, get_limiter, LIMIT_KEYS
+from durian.deadletter import record_dead_letter
+from durian import conf
+import urllib2
+import socket
+import random
+import time
+
+try:
+    from amqplib.client_0_8.exceptions import AMQPException
+except ImportError:
+    AMQPException = None
+
+# Keyword arguments celery passes on to tasks, which shouldn't be
+# forwarded to the tasks we apply ourselves.
+CELERY_TASK_KEYWORDS = ("task_name", "task_id", "task_retries",
+                        "logfile", "loglevel")
+
+# Errors sending a retry to the broker.
+BROKER_ERRORS = (socket.error, IOError)
+if AMQPException is not None:
+    BROKER_ERRORS += (AMQPException, )
+
+
+def backoff(retries, delay=None, multiplier=None, max_delay=None,
+        jitter=True):
+    """Exponential backoff with full jitter.
+
+    The delay before retry number ``retries + 1`` is
+    ``min(max_delay, delay * multiplier ** retries)`` seconds. With
+    jitter a random delay between zero and that is used instead, so the
+    retries after an outage are spread out instead of all arriving at
+    the listener at the same time.
+
+    The arguments not given default to the ``DURIAN_RETRY_DELAY``,
+    ``DURIAN_RETRY_BACKOFF`` and ``DURIAN_RETRY_MAX_DELAY`` settings.
+
+    """
+    if delay is None:
+        delay = conf.RETRY_DELAY
+    if multiplier is None:
+        multiplier = conf.RETRY_BACKOFF
+    if max_delay is None:
+        max_delay = conf.RETRY_MAX_DELAY
+    countdown = min(max_delay, delay * multiplier ** retries)
+    if jitter:
+        countdown = random.uniform(0, countdown)
+    return countdown
 
 
 class WebhookSignal(Task):
     """The default web hook action. Simply sends the payload to the
     listener URL as POST data.
 
+    The connections to the listener hosts are kept alive in the
+    :data:`durian.connection.connections` pool.
+
+    If the ``circuit_breaker`` keyword argument is set, deliveries go
+    through the circuit breaker (:mod:`durian.breaker`). While
+    the circuit for the listener host is open, the task is retried when
+    the circuit is due to be half open (if retries are enabled),
+    otherwise it fails at once with :exc:`durian.breaker.CircuitOpen`.
+
+    If the ``retry`` keyword argument is set, failed deliveries are
+    retried up to ``max_retries`` times, with exponential backoff and
+    jitter (see :meth:`retry_countdown`). The retries are sent as new
+    messages with a countdown, so no worker is blocked waiting for them.
+
+    If the ``dead_letter`` keyword argument is set too, deliveries that
+    still fail after all the retries are stored as dead letters (see
+    :mod:`durian.deadletter`).
+
+    A payload that is not in the payload store (yet) is retried like a
+    failed delivery, e.g. a :class:`durian.store.DatabaseStore` payload
+    stored in a transaction that was not committed when the task started.
+
+    If the ``rate_limit`` or ``max_in_flight`` keyword arguments are set,
+    deliveries to the listener host are limited by
+    :class:`durian.ratelimit.HostLimiter`. A delivery over the limits is
+    sent again later (see :meth:`defer`), which doesn't count as a retry.
+
     Task arguments
 
         * url
             The listener destination URL to send payload to.
 
         * payload
-            The payload to send to the listener.
+            The payload to send to the listener. This can be a
+            :class:`durian.store.PayloadReference`, which is released
+            when the task is done with it (i.e. unless it's retried).
 
     """
     name = "durian.tasks.WebhookSignal"
     ignore_result = True
 
     def run(self, url, payload, **kwargs):
-        import urllib2
-        import socket
-
-        orig_timeout = socket.getdefaulttimeout()
         retry = kwargs.get("retry", False)
         fail_silently = kwargs.get("fail_silently", False)
         self.max_retries = kwargs.get("max_retries", self.max_retries)
-        timeout = kwargs.get("timeout", orig_timeout)
+        timeout = kwargs.get("timeout")
+        breaker = self.get_breaker(kwargs)
+        limits = self.get_limits(kwargs)
 
-        socket.setdefaulttimeout(timeout)
+        handed_off = False
         try:
-            urllib2.urlopen(url, serialize(payload))
-        except urllib2.URLError, exc:
-            if self.retry:
-                try:
-                    self.retry(args=[url, payload], kwargs=kwargs, exc=exc)
-                except MaxRetriesExceededError:
-                    if self.fail_silently:
-                        return
-                    raise
-            else:
+            try:
+                self.deliver_to_host(url, payload_body(payload),
+                                     timeout=timeout, breaker=breaker,
+                                     limits=limits)
+            except (RateLimited, CircuitOpen, urllib2.URLError,
+                    PayloadMissing), exc:
+                # A retry or deferral applied locally runs in this process
+                # and releases the payload itself, even if it fails.
+                # Otherwise it takes over the payload reference only once
+                # it has been sent.
+                handed_off = kwargs.get("task_is_eager", False)
+                if isinstance(exc, RateLimited) and self.can_defer(kwargs):
+                    result = self.defer(url, payload, kwargs,
+                                        exc.retry_after)
+                    handed_off = True
+                    return result
+                if retry and self.can_retry(kwargs):
+                    try:
+                        return self.retry(args=[url, payload],
+                                kwargs=kwargs, exc=exc,
+                                countdown=self.retry_countdown(kwargs,
+                                                               exc))
+                    except RetryTaskError:
+                        handed_off = True
+                        raise
+                handed_off = False
+                self.dead_letter(url, payload, exc, kwargs)
                 if fail_silently:
                     return
                 raise
         finally:
-            socket.setdefaulttimeout(orig_timeout)
+            if not handed_off:
+                release_payload(payload)
+
+    def can_retry(self, kwargs):
+        """Returns ``True`` if the task has retries left."""
+        return kwargs.get("task_retries", 0) < self.max_retries
+
+    def can_defer(self, kwargs):
+        """Returns ``True`` if a rate limited delivery can be deferred.
+
+        A task applied locally waits for the deferral in the caller, so
+        it's only deferred :data:`durian.conf.RATE_LIMIT_MAX_DEFERRALS`
+        times, after that the delivery fails (and is retried, if retries
+        are enabled).
+
+        """
+        if not kwargs.get("task_is_eager"):
+            return True
+        return kwargs.get("task_deferrals", 0) < \
+                    conf.RATE_LIMIT_MAX_DEFERRALS
+
+    def retry_countdown(self, kwargs, exc=None):
+        """Number of seconds to wait before the next retry.
+
+        Uses the backoff policy in the ``retry_delay``, ``retry_backoff``,
+        ``retry_max_delay`` and ``retry_jitter`` keyword arguments (see
+        :func:`backoff`). If the circuit for the host is open, the retry
+        is not made before the circuit is half open, and a rate limited
+        delivery is not retried before the host is below its limits.
+
+        """
+        countdown = backoff(kwargs.get("task_retries", 0),
+                            delay=kwargs.get("retry_delay"),
+                            multiplier=kwargs.get("retry_backoff"),
+                            max_delay=kwargs.get("retry_max_delay"),
+                            jitter=kwargs.get("retry_jitter", True))
+        if isinstance(exc, (CircuitOpen, RateLimited)):
+            countdown = max(countdown, exc.retry_after)
+        return countdown
+
+    def dead_letter(self, url, payload, exc, kwargs, exhausted=None):
+        """Store a delivery that has used up all its retries as a dead
+        letter. Failures of deliveries that are not retried are not
+        stored.
+
+        :keyword exhausted: Set if no more retries can be made, even if
+            there are retries left (e.g. the retry couldn't be sent).
+
+        """
+        if exhausted is None:
+            exhausted = not self.can_retry(kwargs)
+        if not kwargs.get("retry", False) or not exhausted:
+            return
+        if kwargs.get("dead_letter", conf.DEAD_LETTER):
+            return record_dead_letter(kwargs.get("hook_name"), url, payload,
+                                      exc, kwargs.get("task_retries", 0) + 1)
+
+    def get_breaker(self, kwargs):
+        """Get the circuit breaker to use, or ``None`` if disabled."""
+        if kwargs.get("circuit_breaker", conf.CIRCUIT_BREAKER):
+            return get_breaker()
+
+    def get_limits(self, kwargs):
+        """Get the per host limits to apply, see
+        :meth:`durian.ratelimit.HostLimiter.acquire`."""
+        if kwargs.get("rate_limit") or kwargs.get("max_in_flight"):
+            return dict((key, kwargs.get(key)) for key in LIMIT_KEYS)
+        return {}
+
+    def deliver_to_host(self, url, body, timeout=None, breaker=None,
+            limits=None):
+        """:meth:`deliver` the payload if the rate limits and the circuit
+        breaker allows it, and record the outcome.
+
+        :raises durian.ratelimit.RateLimited: if the listener host is
+            over its limits.
+        :raises durian.breaker.CircuitOpen: if the circuit for the
+            listener host is open.
+
+        """
+        if breaker is None and not limits:
+            return self.deliver(url, body, timeout=timeout)
+        host = host_for(url)
+        if limits:
+            get_limiter().check(host, **limits)
+        try:
+            if breaker is None:
+                return self.deliver(url, body, timeout=timeout)
+            breaker.check(host)
+            try:
+                response = self.deliver(url, body, timeout=timeout)
+            except urllib2.URLError, exc:
+                breaker.record(host, exc)
+                raise
+            breaker.record(host)
+            return response
+        finally:
+            if limits:
+                get_limiter().release(host, **limits)
+
+    def defer(self, url, payload, kwargs, countdown):
+        """Send the delivery again in ``countdown`` seconds, without
+        using up a retry.
+
+        If the task was applied locally, it waits and tries again in
+        this process instead (see :meth:`can_defer`).
+
+        """
+        if kwargs.get("task_is_eager"):
+            time.sleep(countdown)
+            return self.run(url, payload, **dict(kwargs,
+                    task_deferrals=kwargs.get("task_deferrals", 0) + 1))
+        return self.apply_async(args=[url, payload],
+                                kwargs=forward_keywords(kwargs),
+                                countdown=countdown,
+                                retries=kwargs.get("task_retries", 0))
+
+    def deliver(self, url, body, timeout=None):
+        """POST the encoded payload to the listener URL."""
+        return connections.post(url, body, timeout=timeout)
+tasks.register(WebhookSignal)
+
+
+def forward_keywords(kwargs):
+    """Remove the keyword arguments added by celery."""
+    return dict((key, value) for key, value in kwargs.items()
+                    if key not in CELERY_TASK_KEYWORDS)
+
+
+class WebhookFanout(Task):
+    """Fan out an event to many listeners with a single message.
+
+    The listeners are split into batches of ``batch_size`` listeners,
+    each batch delivered by a :class:`WebhookBatch` task.
+
+    Task arguments
+
+        * targets
+            List of primary keys of the :class:`durian.models.Listener`
+            instances to deliver the payload to.
+
+        * payload
+            The payload to send to the listeners.
+
+    Task keyword arguments
+
+        * delivery_task
+            Name of the task delivering to a single listener.
+            Default is :class:`WebhookSignal`.
+
+        * batch_size
+            The maximum number of listeners in a batch.
+
+        * listener_limits
+            Mapping of listener URL to the rate limits configured for
+            that listener (see :data:`durian.ratelimit.LIMIT_KEYS`).
+
+    Any other keyword arguments are passed on to the delivery task.
+
+    """
+    name = "durian.tasks.WebhookFanout"
+    ignore_result = True
+    batch_size = 100
+
+    def run(self, targets, payload, **kwargs):
+        from durian.models import Listener
+        kwargs = forward_keywords(kwargs)
+        batch_size = kwargs.pop("batch_size", self.batch_size)
+        listener_limits = kwargs.pop("listener_limits", None) or {}
+        urls = list(Listener.objects.filter(pk__in=targets).values_list(
+                        "url", flat=True))
+        # Listeners deleted since the event was sent won't release
+        # their reference to the payload.
+        if len(urls) < len(targets):
+            release_payload(payload, len(targets) - len(urls))
+        # If we were applied locally, the batches are applied locally too.
+        applier = WebhookBatch.apply if kwargs.get("task_is_eager") else \
+                    WebhookBatch.apply_async
+        results = []
+        for batch in chunks(iter(urls), batch_size):
+            if not batch:
+                continue
+            batch_kwargs = dict(kwargs)
+            batch_limits = dict((url, listener_limits[url])
+                                    for url in batch
+                                        if url in listener_limits)
+            if batch_limits:
+                batch_kwargs["listener_limits"] = batch_limits
+            results.append(applier(args=[batch, payload],
+                                   kwargs=batch_kwargs))
+        return results
+tasks.register(WebhookFanout)
+
+
+class WebhookBatch(Task):
+    """Deliver a payload to a batch of listener URLs.
+
+    By default each URL is delivered by running the delivery task
+    (``delivery_task`` keyword argument, default is :class:`WebhookSignal`)
+    in this worker. If a delivery engine is configured (the
+    ``delivery_engine`` keyword argument, or the ``DURIAN_DELIVERY_ENGINE``
+    setting), the URLs are delivered by the engine instead, see
+    :mod:`durian.engine`.
+
+    A failing URL doesn't stop the rest of the batch, retries are sent
+    as separate delivery task messages.
+
+    Task arguments
+
+        * urls
+            The listener destination URLs to send the payload to.
+
+        * payload
+            The payload to send to the listeners.
+
+    """
+    name = "durian.tasks.WebhookBatch"
+    ignore_result = True
+
+    def run(self, urls, payload, **kwargs):
+        kwargs = forward_keywords(kwargs)
+        task = tasks[kwargs.pop("delivery_task", WebhookSignal.name)]
+        engine = get_engine(kwargs.pop("delivery_engine", None),
+                            kwargs.pop("delivery_concurrency", None))
+        listener_limits = kwargs.pop("listener_limits", None) or {}
+        if engine is not None:
+            errors = self.deliver_with_engine(engine, task, urls, payload,
+                                              listener_limits, **kwargs)
+        else:
+            errors = []
+            for url in urls:
+                try:
+                    task.run(url, payload,
+                             **dict(kwargs, **listener_limits.get(url, {})))
+                except RetryTaskError:
+                    pass
+                except Exception, exc:
+                    errors.append(exc)
+        if errors:
+            raise errors[0]
+
+    def deliver_with_engine(self, engine, task, urls, payload,
+            listener_limits=None, **kwargs):
+        """Deliver to all the URLs with a delivery engine.
+
+        Failed deliveries are retried with the delivery task, using the
+        same retry, rate limit, circuit breaker and ``fail_silently``
+        semantics as :class:`WebhookSignal`.
+
+        """
+        fail_silently = kwargs.get("fail_silently", False)
+        breaker = task.get_breaker(kwargs)
+        limiter = get_limiter()
+        listener_limits = listener_limits or {}
+        results = [None] * len(urls)
+        allowed = []
+        acquired = []
+        for i, url in enumerate(urls):
+            host = host_for(url)
+            limits = task.get_limits(dict(kwargs,
+                                          **listener_limits.get(url, {})))
+            try:
+                if limits:
+                    limiter.check(host, **limits)
+                    acquired.append((host, limits))
+                if breaker is not None:
+                    breaker.check(host)
+            except (RateLimited, CircuitOpen), exc:
+                results[i] = exc
+                continue
+            allowed.append(i)
+        try:
+            try:
+                delivered = engine.deliver([urls[i] for i in allowed],
+                                           payload_body(payload),
+                                           timeout=kwargs.get("timeout"))
+            except PayloadMissing, exc:
+                # Not the fault of the hosts, but retried all the same.
+                delivered = [exc] * len(allowed)
+        finally:
+            for host, limits in acquired:
+                limiter.release(host, **limits)
+        for i, exc in zip(allowed, delivered):
+            results[i] = exc
+            if breaker is not None and not isinstance(exc, PayloadMissing):
+                breaker.record(host_for(urls[i]), exc)
+
+        errors = []
+        done = 0
+        for url, exc in zip(urls, results):
+            if exc is None:
+                done += 1
+                continue
+            if isinstance(exc, RateLimited):
+                try:
+                    task.defer(url, payload,
+                               dict(kwargs, **listener_limits.get(url, {})),
+                               exc.retry_after)
+                except Exception, exc:
+                    # Unless it was applied locally, the deferral wasn't
+                    # sent and doesn't hold a reference to the payload.
+                    if not kwargs.get("task_is_eager", False):
+                        done += 1
+                    if not fail_silently:
+                        errors.append(exc)
+                continue
+            exhausted = None
+            if kwargs.get("retry", False):
+                task.max_retries = kwargs.get("max_retries", task.max_retries)
+                if task.can_retry(kwargs):
+                    try:
+                        task.retry(args=[url, payload], kwargs=dict(kwargs),
+                                   exc=exc, throw=False,
+                                   countdown=task.retry_countdown(kwargs,
+                                                                  exc))
+                        continue
+                    except Exception, retry_exc:
+                        if kwargs.get("task_is_eager", False):
+                            # The eager retry has failed for good, and has
+                            # already stored the dead letter and released
+                            # the payload.
+                            if not fail_silently:
+                                errors.append(retry_exc)
+                            continue
+                        if not isinstance(retry_exc, BROKER_ERRORS):
+                            raise
+                        # The retry couldn't be sent to the broker, so
+                        # the original error is recorded.
+                        exhausted = True
+            done += 1
+            task.dead_letter(url, payload, exc, kwargs, exhausted=exhausted)
+            if not fail_silently:
+                errors.append(exc)
+        release_payload(payload, done)
+        return errors
+tasks.register(WebhookBatch)
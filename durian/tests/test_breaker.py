@@ -0,0 +1,139 @@
+import unittest
+import urllib2
+import time
+from celery.registry import tasks
+from durian import breaker as breaker_module
+from durian.breaker import CircuitBreaker, CircuitOpen, LocalBackend
+from durian.breaker import STATE_CLOSED, STATE_OPEN, STATE_HALF_OPEN
+from durian.tasks import WebhookSignal
+
+HOST = "where.joe:8080"
+
+changes = []
+
+
+def record_change(sender, host, state, **kwargs):
+    changes.append((host, state))
+breaker_module.state_changed.connect(record_change)
+
+
+class CountingBackend(LocalBackend):
+
+    def __init__(self):
+        super(CountingBackend, self).__init__()
+        self.calls = []
+
+    def get(self, key, default=None):
+        self.calls.append("get")
+        return super(CountingBackend, self).get(key, default)
+
+    def add(self, key, value, timeout=None):
+        self.calls.append("add")
+        return super(CountingBackend, self).add(key, value, timeout)
+
+    def incr(self, key, delta=1):
+        self.calls.append("incr")
+        return super(CountingBackend, self).incr(key, delta)
+
+
+def create_breaker():
+    return CircuitBreaker(backend=LocalBackend(), failure_rate=0.5,
+                          min_requests=4, window=60, reset_timeout=30)
+
+
+class FailingWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.FailingWebhookSignal"
+    breaker = create_breaker()
+    attempts = []
+
+    def get_breaker(self, kwargs):
+        return self.breaker
+
+    def deliver(self, url, body, timeout=None):
+        self.attempts.append(url)
+        raise urllib2.URLError("Connection refused")
+tasks.register(FailingWebhookSignal)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = create_breaker()
+        changes[:] = []
+
+    def expire(self, breaker):
+        # Pretend the circuit opened a long time ago.
+        breaker.backend.set(breaker._key(HOST, "opened"), time.time() - 100)
+
+    def test_opens_on_failure_rate(self):
+        breaker = self.breaker
+        breaker.record(HOST)
+        breaker.record(HOST, urllib2.URLError("timed out"))
+        breaker.record(HOST, urllib2.HTTPError("http://x", 404, "Not Found",
+                                               {}, None))
+        self.assertEquals(breaker.state(HOST), STATE_CLOSED)
+        breaker.record(HOST, urllib2.URLError("timed out"))
+        self.assertEquals(breaker.state(HOST), STATE_OPEN)
+        self.assertFalse(breaker.allow(HOST))
+        self.assertTrue(breaker.allow("other.host"))
+        self.assertTrue(25 < breaker.retry_after(HOST) <= 30)
+        self.assertRaises(CircuitOpen, breaker.check, HOST)
+        self.assertEquals(breaker.stats["rejected"], 2)
+        self.assertEquals(changes, [(HOST, STATE_OPEN)])
+
+    def test_half_open(self):
+        breaker = self.breaker
+        for i in range(4):
+            breaker.failure(HOST)
+        self.assertEquals(breaker.state(HOST), STATE_OPEN)
+
+        self.expire(breaker)
+        self.assertTrue(breaker.allow(HOST))
+        self.assertEquals(breaker.state(HOST), STATE_HALF_OPEN)
+        # Only one probe is let through.
+        self.assertFalse(breaker.allow(HOST))
+        breaker.failure(HOST)
+        self.assertEquals(breaker.state(HOST), STATE_OPEN)
+
+        self.expire(breaker)
+        self.assertTrue(breaker.allow(HOST))
+        breaker.success(HOST)
+        self.assertEquals(breaker.state(HOST), STATE_CLOSED)
+        # The counters are reset when the circuit closes.
+        breaker.failure(HOST)
+        self.assertEquals(breaker.state(HOST), STATE_CLOSED)
+
+        self.assertEquals([state for host, state in changes],
+                          [STATE_OPEN, STATE_HALF_OPEN, STATE_OPEN,
+                           STATE_HALF_OPEN, STATE_CLOSED])
+        self.assertEquals(breaker.stats["opened"], 2)
+        self.assertEquals(breaker.stats["closed"], 1)
+
+    def test_success_round_trips(self):
+        breaker = CircuitBreaker(backend=CountingBackend(), min_requests=4)
+        breaker.success(HOST)
+        breaker.backend.calls[:] = []
+        self.assertTrue(breaker.allow(HOST))
+        breaker.success(HOST)
+        # The opened state, the total and the probe.
+        self.assertEquals(breaker.backend.calls, ["get", "incr", "get"])
+        for i in range(2):
+            breaker.failure(HOST)
+        self.assertEquals(breaker.state(HOST), STATE_OPEN)
+
+
+class TestWebhookSignalBreaker(unittest.TestCase):
+
+    def test_fails_fast(self):
+        url = "http://dead.joe/listens"
+        for i in range(4):
+            self.assertRaises(urllib2.URLError, FailingWebhookSignal.apply(
+                    args=[url, {"name": "Joe"}],
+                    kwargs={"max_retries": 0}).get)
+        self.assertEquals(len(FailingWebhookSignal.attempts), 4)
+        result = FailingWebhookSignal.apply(args=[url, {"name": "Joe"}])
+        self.assertRaises(CircuitOpen, result.get)
+        self.assertEquals(len(FailingWebhookSignal.attempts), 4)
+        FailingWebhookSignal.apply(args=[url, {"name": "Joe"}],
+                                   kwargs={"fail_silently": True}).get()
+        self.assertEquals(len(FailingWebhookSignal.attempts), 4)
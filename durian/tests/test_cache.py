@@ -0,0 +1,97 @@
+import unittest
+import warnings
+from django.conf import settings
+from django.core.cache.backends.locmem import CacheClass
+from django.db import connection
+from durian.cache import ListenerCache, is_shared_backend
+from durian.event import Hook
+from durian.models import Listener
+from durian import event
+
+
+class TestListenerCache(unittest.TestCase):
+
+    def test_hits_and_misses(self):
+        hook = "__durian__.unittest.cachehook"
+        cache = ListenerCache()
+        self.assertEquals(cache.get(hook), [])
+        self.assertEquals(cache.stats["misses"], 1)
+        self.assertEquals(cache.get(hook), [])
+        self.assertEquals(cache.stats["hits"], 1)
+
+        cache.clear()
+        self.assertEquals(cache.stats, {"hits": 0, "misses": 0, "hooks": 0})
+
+    def test_invalidated_by_other_process(self):
+        hook = "__durian__.unittest.cachehook2"
+        cache = ListenerCache()
+        self.assertFalse(cache.get(hook))
+
+        # Saving the listener replaces the shared version stamp, so
+        # other caches will notice too.
+        listener = Listener.objects.create(hook=hook,
+                                           url="http://where.joe/cache")
+        self.assertEquals([l.pk for l in cache.get(hook)], [listener.pk])
+        self.assertEquals(cache.stats["misses"], 2)
+        cache.get(hook)
+        self.assertEquals(cache.stats["hits"], 1)
+
+        listener.delete()
+        self.assertFalse(cache.get(hook))
+        self.assertEquals(cache.stats["misses"], 3)
+
+    def test_not_shared(self):
+        hook = "__durian__.unittest.cachehook4"
+        self.assertFalse(is_shared_backend(CacheClass(None, {})))
+        cache = ListenerCache(backend=CacheClass(None, {}), shared=False)
+        warnings.filterwarnings("ignore", category=RuntimeWarning,
+                                module="durian.cache")
+        try:
+            self.assertFalse(cache.get(hook))
+            # Not counted, the listeners are loaded right after.
+            self.assertTrue(cache.has_listeners(hook))
+            # A listener saved by another process (not touching our
+            # backend) is seen at once.
+            listener = Listener.objects.create(hook=hook,
+                                               url="http://where.joe/ns")
+            self.assertEquals([l.pk for l in cache.get(hook)],
+                              [listener.pk])
+            self.assertEquals(cache.count(hook), 1)
+            self.assertEquals(cache.stats["hits"], 0)
+            listener.delete()
+        finally:
+            warnings.resetwarnings()
+
+    def test_not_shared_send(self):
+        hook = Hook(name="__durian__.unittest.cachehook5",
+                    provides_args=["name"], async=False)
+        listener = hook.add_listener("http://where.joe/ns2",
+                                     match={"name": "George"})
+        cache = ListenerCache(backend=CacheClass(None, {}), shared=False)
+        cache._warned = True
+        previous, event.listener_cache = event.listener_cache, cache
+        debug, settings.DEBUG = settings.DEBUG, True
+        try:
+            connection.queries = []
+            self.assertEquals(hook.send(sender=self, name="Joe"), [])
+            # Only the query loading the listeners, not counting them.
+            self.assertEquals(len(connection.queries), 1)
+        finally:
+            event.listener_cache = previous
+            settings.DEBUG = debug
+            listener.delete()
+
+    def test_count(self):
+        hook = "__durian__.unittest.cachehook3"
+        cache = ListenerCache()
+        self.assertFalse(cache.has_listeners(hook))
+        self.assertFalse(cache.has_listeners(hook))
+        self.assertEquals(cache.stats["misses"], 1)
+        listener = Listener.objects.create(hook=hook,
+                                           url="http://where.joe/count")
+        self.assertEquals(cache.count(hook), 1)
+        cache.get(hook)
+        self.assertTrue(cache.has_listeners(hook))
+        self.assertEquals(cache.stats["misses"], 3)
+        listener.delete()
+        self.assertFalse(cache.has_listeners(hook))
@@ -0,0 +1,118 @@
+import unittest
+from django.contrib.auth.models import User
+from django.dispatch import Signal
+from durian import coalesce
+from durian.event import ModelHook
+from durian.middleware import CoalesceMiddleware
+from durian.tests.test_hooks import TestWebhookSignal
+
+saved = Signal(providing_args=["instance", "created"])
+
+testchook = ModelHook(model=User, signal=saved,
+                      name="__durian__.unittest.testchook",
+                      provides_args=["username"],
+                      task_cls=TestWebhookSignal,
+                      coalesce=True,
+                      async=False)
+
+
+class TestCoalesce(unittest.TestCase):
+    url = "http://where.joe/clistens"
+
+    def setUp(self):
+        self.listener = testchook.add_listener(self.url)
+        self.sent = []
+        self.batches = []
+        testchook.send_prepared = self.send_prepared
+        testchook.send_many_prepared = self.send_many_prepared
+
+    def tearDown(self):
+        del(testchook.send_prepared)
+        del(testchook.send_many_prepared)
+        self.listener.delete()
+
+    def send_prepared(self, sender, payload):
+        self.sent.append(payload)
+        return ModelHook.send_prepared(testchook, sender, payload)
+
+    def send_many_prepared(self, sender, payloads):
+        self.sent.extend(payloads)
+        self.batches.append(len(payloads))
+        return ModelHook.send_many_prepared(testchook, sender, payloads)
+
+    def save(self, user, created=False):
+        saved.send(sender=User, instance=user, created=created)
+
+    def test_not_buffering(self):
+        joe = User(pk=1, username="joe")
+        self.save(joe, created=True)
+        self.save(joe)
+        self.assertEquals(len(self.sent), 2)
+
+    def test_coalesce_events(self):
+        joe = User(pk=1, username="joe")
+        jane = User(pk=2, username="jane")
+
+        @coalesce.coalesce_events
+        def view():
+            self.save(joe, created=True)
+            joe.username = "joseph"
+            self.save(joe)
+            self.save(jane)
+            self.assertEquals(self.sent, [])
+
+        view()
+        self.assertEquals(self.sent, [{"username": "joseph", "created": True},
+                                      {"username": "jane", "created": False}])
+        # Sent together.
+        self.assertEquals(self.batches, [2])
+        self.assertEquals(TestWebhookSignal.scratchpad.pop(self.url),
+                          {"username": "jane", "created": False})
+
+    def test_unsaved(self):
+
+        @coalesce.coalesce_events
+        def view():
+            self.save(User(username="joe"))
+            self.save(User(username="jane"))
+
+        view()
+        self.assertEquals([payload["username"] for payload in self.sent],
+                          ["joe", "jane"])
+
+    def test_discard_on_exception(self):
+
+        @coalesce.coalesce_events
+        def view():
+            self.save(User(pk=1, username="joe"))
+            raise KeyError("x")
+
+        self.assertRaises(KeyError, view)
+        self.assertEquals(self.sent, [])
+        self.assertFalse(coalesce.is_buffering())
+
+    def test_middleware(self):
+        middleware = CoalesceMiddleware()
+        middleware.process_request(None)
+        coalesce.begin()
+        self.save(User(pk=1, username="joe"))
+        coalesce.end()
+        self.save(User(pk=1, username="joe"))
+        self.assertEquals(self.sent, [])
+        middleware.process_response(None, None)
+        self.assertEquals(len(self.sent), 1)
+
+    def test_merge_payloads(self):
+        first = {"email": "a", "created": False,
+                 "changes": {"email": {"old": "x", "new": "a"}}}
+        second = {"email": "b", "username": "joe", "created": False,
+                  "changes": {"email": {"old": "a", "new": "b"},
+                              "username": {"old": "j", "new": "joe"}}}
+        self.assertEquals(coalesce.merge_payloads(first, second),
+                          {"email": "b", "username": "joe", "created": False,
+                           "changes": {"email": {"old": "x", "new": "b"},
+                                       "username": {"old": "j",
+                                                    "new": "joe"}}})
+        full = {"email": "a", "username": "j", "created": True}
+        self.assertEquals(coalesce.merge_payloads(full, second),
+                          {"email": "b", "username": "joe", "created": True})
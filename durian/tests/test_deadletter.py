@@ -0,0 +1,111 @@
+import unittest
+import urllib2
+from django.core.management import call_command
+from celery.registry import tasks
+from datetime import datetime, timedelta
+from durian.deadletter import replay_dead_letters, delete_unused_payloads
+from durian.deadletter import PAYLOAD_GRACE
+from durian.event import Hook
+from durian.models import DeadLetter, DeadLetterPayload
+from durian.registry import hooks
+from durian.tasks import WebhookSignal
+
+
+class FlakyWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.FlakyWebhookSignal"
+    down = True
+    delivered = []
+
+    def deliver(self, url, body, timeout=None):
+        if self.down:
+            raise urllib2.URLError("Connection refused")
+        self.delivered.append((url, body))
+tasks.register(FlakyWebhookSignal)
+
+testdhook = Hook(name="__durian__.unittest.testdhook",
+                 provides_args=["name"],
+                 task_cls=FlakyWebhookSignal,
+                 retry=True,
+                 max_retries=1,
+                 fail_silently=True,
+                 circuit_breaker=False,
+                 dead_letter=True,
+                 async=False)
+hooks.register(testdhook)
+
+
+class TestDeadLetter(unittest.TestCase):
+
+    def test_record_and_replay(self):
+        urls = ["http://where.joe/dlistens/%d" % i for i in range(3)]
+        for url in urls:
+            testdhook.add_listener(url)
+        FlakyWebhookSignal.down = True
+        testdhook.send(sender=self, name="Joe")
+        testdhook.send(sender=self, name="George")
+
+        dead_letters = DeadLetter.objects.filter(hook=testdhook.name)
+        self.assertEquals(dead_letters.count(), 6)
+        self.assertEquals(DeadLetterPayload.objects.filter(
+                            dead_letters__hook=testdhook.name).distinct()
+                                                              .count(), 2)
+        dead_letter = dead_letters.filter(url=urls[0])[0]
+        self.assertEquals(dead_letter.attempts, 2)
+        self.assertEquals(dead_letter.listener.url, urls[0])
+        self.assertTrue("Connection refused" in dead_letter.error)
+
+        # Still down, so they're stored again.
+        self.assertEquals(replay_dead_letters(dead_letters.filter(
+                                url=urls[0])), 2)
+        self.assertEquals(dead_letters.count(), 6)
+
+        FlakyWebhookSignal.down = False
+        call_command("durian_replay_dead_letters", testdhook.name,
+                     batch_size=4, verbosity=0)
+        self.assertEquals(dead_letters.count(), 0)
+        self.assertFalse(DeadLetterPayload.objects.filter(
+                            dead_letters__hook=testdhook.name))
+        self.assertEquals(sorted(FlakyWebhookSignal.delivered),
+                          sorted([(url, '{"name": "%s"}' % name)
+                                    for url in urls
+                                        for name in ("Joe", "George")]))
+
+    def test_disabled(self):
+        hook = Hook(name="__durian__.unittest.testd2hook",
+                    provides_args=["name"],
+                    task_cls=FlakyWebhookSignal,
+                    fail_silently=True,
+                    circuit_breaker=False,
+                    dead_letter=False,
+                    async=False)
+        hook.add_listener("http://where.joe/d2listens")
+        FlakyWebhookSignal.down = True
+        hook.send(sender=self, name="Joe")
+        self.assertFalse(DeadLetter.objects.filter(hook=hook.name))
+
+    def test_not_retried(self):
+        # Only deliveries that have used up their retries are stored.
+        hook = Hook(name="__durian__.unittest.testd3hook",
+                    provides_args=["name"],
+                    task_cls=FlakyWebhookSignal,
+                    fail_silently=True,
+                    circuit_breaker=False,
+                    dead_letter=True,
+                    async=False)
+        hook.add_listener("http://where.joe/d3listens")
+        FlakyWebhookSignal.down = True
+        hook.send(sender=self, name="Joe")
+        self.assertFalse(DeadLetter.objects.filter(hook=hook.name))
+
+    def test_unused_payloads(self):
+        old = datetime.now() - timedelta(seconds=PAYLOAD_GRACE + 1)
+        unused = DeadLetterPayload.objects.create(digest="0" * 40, body="{}")
+        recent = DeadLetterPayload.objects.create(digest="1" * 40,
+                                                  body="{}")
+        DeadLetterPayload.objects.filter(pk=unused.pk).update(last_used=old)
+        delete_unused_payloads()
+        pks = DeadLetterPayload.objects.values_list("pk", flat=True)
+        self.assertFalse(unused.pk in pks)
+        # Might be used by a dead letter being recorded right now.
+        self.assertTrue(recent.pk in pks)
+        recent.delete()
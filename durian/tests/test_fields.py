@@ -0,0 +1,134 @@
+import unittest
+import pickle
+from datetime import date
+from decimal import Decimal
+from django.core.management import call_command
+from django.db import connection
+from celery.fields import dbsafe_encode
+from durian.models import Listener
+from durian.match import codec
+from durian.match.able import Is, Startswith, Like, compiled_patterns
+
+MATCH = {"name": Startswith("George"),
+         "address": {"city": Is("New York"), "zip": Like(r"^\d+$")},
+         "phone": "555"}
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        encoded = codec.dumps(MATCH)
+        self.assertTrue(codec.is_encoded(encoded))
+        self.assertTrue('{"$":"startswith","v":"George"}' in encoded)
+        self.assertEquals(codec.dumps(dict(MATCH)), encoded)
+        decoded = codec.loads(encoded)
+        self.assertTrue(isinstance(decoded["name"], Startswith))
+        self.assertEquals(decoded["name"].value, "George")
+        self.assertTrue(isinstance(decoded["address"]["zip"], Like))
+        self.assertEquals(decoded["phone"], "555")
+
+    def test_like_compiled_once(self):
+        compiled_patterns.clear()
+        first = codec.loads(codec.dumps({"zip": Like(r"^7\d+$")}))["zip"]
+        second = codec.loads(codec.dumps({"zip": Like(r"^7\d+$")}))["zip"]
+        self.assertEquals(first, "7000")
+        self.assertEquals(second, "7000")
+        self.assertTrue(first.pattern is second.pattern)
+        self.assertEquals(len(compiled_patterns), 1)
+
+    def test_errors(self):
+        self.assertRaises(codec.DecodeError, codec.loads, "not encoded")
+        self.assertRaises(codec.DecodeError, codec.loads,
+                          codec.PREFIX + '{"$":"unknown","v":1}')
+        self.assertRaises(TypeError, codec.dumps, {"x": object()})
+
+    def test_tag_keys(self):
+        tree = {"$": "foo", "$$": {"$": Is("x")}, "$x": 1}
+        encoded = codec.dumps(tree)
+        self.assertTrue('"$$":"foo"' in encoded)
+        decoded = codec.loads(encoded)
+        self.assertTrue(codec.same_tree(decoded, tree))
+        self.assertTrue(isinstance(decoded["$$"]["$"], Is))
+
+    def test_same_tree(self):
+        self.assertTrue(codec.same_tree(MATCH, codec.loads(
+                                                codec.dumps(MATCH))))
+        self.assertFalse(codec.same_tree({"x": Like("^a")},
+                                         {"x": Startswith("^a")}))
+        self.assertFalse(codec.same_tree({1: "a"}, {u"1": u"a"}))
+        self.assertFalse(codec.same_tree({"x": (1, 2)}, {"x": [1, 2]}))
+
+
+class TestMatchField(unittest.TestCase):
+
+    def test_save_and_lookup(self):
+        listener = Listener.objects.create(hook="__durian__.fields",
+                                           url="http://x.com/f",
+                                           match=MATCH,
+                                           config={"format": "json"})
+        listener = Listener.objects.get(pk=listener.pk)
+        self.assertEquals(listener.config, {"format": "json"})
+        self.assertTrue(isinstance(listener.match["name"], Startswith))
+        self.assertEquals(Listener.objects.get(match=MATCH).pk, listener.pk)
+        self.assertTrue(Listener.objects.filter(
+                            match__contains='"v":"New York"'))
+
+    def test_config_not_json(self):
+        config = {"since": date(2009, 10, 1), "limit": Decimal("1.5"),
+                  "codes": {404: "ignore"}}
+        listener = Listener.objects.create(hook="__durian__.fields",
+                                           url="http://x.com/c",
+                                           config=config)
+        stored = Listener.objects.filter(pk=listener.pk).values_list(
+                        "config", flat=True)[0]
+        self.assertFalse(codec.is_encoded(stored))
+        self.assertEquals(Listener.objects.get(pk=listener.pk).config,
+                          config)
+        listener.delete()
+
+    def test_match_not_json(self):
+        for match in ({1: "a"}, {"since": date(2009, 10, 1)},
+                      {"$": "foo"}, {"zip": Is((7000, 7001))}):
+            listener = Listener.objects.create(hook="__durian__.fields",
+                                               url="http://x.com/n",
+                                               match=match)
+            listener = Listener.objects.get(pk=listener.pk)
+            self.assertTrue(codec.same_tree(listener.match, match))
+            listener.delete()
+        listener = Listener(hook="__durian__.fields", url="http://x.com/n",
+                            match={1: "a"})
+        self.assertTrue(listener.matches({1: "a"}))
+
+    def test_matches(self):
+        listener = Listener(hook="__durian__.fields", url="http://x.com/m",
+                            match=MATCH)
+        payload = {"name": "George Constanza", "phone": "555",
+                   "address": {"city": "New York", "zip": "10001"}}
+        self.assertTrue(listener.matches(payload))
+        listener.match = {"name": "Elaine"}
+        self.assertFalse(listener.matches(payload))
+        # The compiled predicate is not pickled.
+        listener = pickle.loads(pickle.dumps(listener))
+        self.assertFalse("_match_predicate" in listener.__dict__)
+        self.assertFalse(listener.matches(payload))
+
+    def test_convert_pickled(self):
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO durian_listener "
+                       "(hook, url, created_at, updated_at, config, match, "
+                       "wildcard) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                       ["__durian__.fields.pickled", "http://x.com/p",
+                        "2009-10-01 12:00:00", "2009-10-01 12:00:00",
+                        dbsafe_encode({"format": "json"}),
+                        dbsafe_encode({"name": Is("Joe")}), True])
+        listener = Listener.objects.get(hook="__durian__.fields.pickled")
+        self.assertEquals(listener.match["name"].value, "Joe")
+
+        call_command("durian_convert_listeners", verbosity=0)
+        match, config = Listener.objects.filter(pk=listener.pk).values_list(
+                            "match", "config")[0]
+        self.assertTrue(codec.is_encoded(match))
+        self.assertTrue(codec.is_encoded(config))
+        listener = Listener.objects.get(pk=listener.pk)
+        self.assertEquals(listener.match["name"].value, "Joe")
+        self.assertEquals(listener.config, {"format": "json"})
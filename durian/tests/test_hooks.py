@@ -1,14 +1,20 @@
 import unittest
+import threading
+import time
+from decimal import Decimal
 from durian.event import Hook, ModelHook, IntermediateListener
 from durian.registry import hooks
 from durian.forms import BaseMatchForm
-from durian.models import Listener
+from durian.models import Listener, condition_key
 from celery.registry import tasks
 from durian.tasks import WebhookSignal
 from durian import match
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, Message
+from django.conf import settings
+from django.db import connection
 from django.db.models import signals
 from django.dispatch import Signal
+from django.core.signals import request_started
 
 
 class TestWebhookSignal(WebhookSignal):
@@ -18,6 +24,17 @@ class TestWebhookSignal(WebhookSignal):
 
     def run(self, url, payload, **kwargs):
         self.__class__.scratchpad[url] = payload
+tasks.register(TestWebhookSignal)
+
+
+class SlowWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.SlowWebhookSignal"
+    ignore_result = True
+    scratchpad = {}
+
+    def run(self, url, payload, **kwargs):
+        time.sleep(0.2)
+        self.__class__.scratchpad[url] = threading.currentThread()
 
 
 testhook = Hook(name="__durian__.unittest.testhook",
@@ -34,6 +51,14 @@ testmhook = ModelHook(model=User, signal=signals.post_save,
                 async=False)
 hooks.register(testmhook)
 
+testfhook = Hook(name="__durian__.unittest.testfhook",
+                 provides_args=["name"],
+                 task_cls=TestWebhookSignal,
+                 fanout=True,
+                 fanout_batch_size=2,
+                 async=False)
+hooks.register(testfhook)
+
 
 class TestHook(unittest.TestCase):
 
@@ -96,6 +121,174 @@ class TestHook(unittest.TestCase):
         self.assertFalse(TestWebhookSignal.scratchpad.get(url))
 
 
+class TestFanoutHook(unittest.TestCase):
+
+    def test_trigger_event(self):
+        urls = ["http://where.joe/flistens/%d" % i for i in range(5)]
+        for url in urls:
+            testfhook.add_listener(url, match={"name": "Joe"})
+        testfhook.add_listener("http://where.joe/flistens/george",
+                               match={"name": "George"})
+
+        results = testfhook.send(sender=self, name="Joe")
+        self.assertEquals(len(results), 1)
+        batches = results[0].get()
+        self.assertEquals(len(batches), 3)
+        for url in urls:
+            self.assertEquals(TestWebhookSignal.scratchpad.pop(url),
+                              {"name": "Joe"})
+        self.assertFalse(TestWebhookSignal.scratchpad.get(
+                            "http://where.joe/flistens/george"))
+
+        self.assertEquals(testfhook.send(sender=self, name="Elaine"), [])
+
+
+class TestReorderConditions(unittest.TestCase):
+
+    def test_trigger_event(self):
+        hook = Hook(name="__durian__.unittest.testreorderhook",
+                    provides_args=["name", "zip"],
+                    task_cls=TestWebhookSignal,
+                    reorder_conditions=True,
+                    async=False)
+        hook.match_stats.sample_every = 1
+        hook.match_stats.refresh_every = 5
+        hook.match_stats.group_size = 5
+        url = "http://where.joe/reorderlistens"
+        # Not routable by the index, so every event is tested.
+        hook.add_listener(url, match={"name": match.Like("^Jo"),
+                                      "zip": match.Like("^7020$")})
+        for i in range(10):
+            hook.send(sender=self, name="Joe", zip=str(7011 + i))
+        self.assertEquals(TestWebhookSignal.scratchpad.pop(url),
+                          {"name": "Joe", "zip": "7020"})
+        self.assertEquals(hook.match_stats.version, 2)
+        self.assertEquals(hook.match_stats.stats[0]["path"], "zip")
+
+
+class TestSendMany(unittest.TestCase):
+
+    def test_send_many(self):
+        for prefilter in (False, True):
+            hook = Hook(name="__durian__.unittest.testmanyhook%d" % (
+                                prefilter),
+                        provides_args=["name"],
+                        task_cls=TestWebhookSignal,
+                        prefilter=prefilter,
+                        async=False)
+            base = "http://where.joe/manylistens/%d/" % prefilter
+            hook.add_listener(base + "joe", match={"name": "Joe"})
+            hook.add_listener(base + "j", match={
+                                    "name": match.Startswith("J")})
+            hook.add_listener(base + "george", match={"name": "George"})
+            results = hook.send_many(self, [{"name": "Joe"},
+                                            {"name": "Elaine"},
+                                            {"name": "George"}])
+            self.assertEquals([len(result) for result in results],
+                              [1, 0, 1])
+            self.assertEquals(TestWebhookSignal.scratchpad.pop(base + "j"),
+                              {"name": "Joe"})
+            self.assertEquals(TestWebhookSignal.scratchpad.pop(base + "joe"),
+                              {"name": "Joe"})
+            self.assertEquals(TestWebhookSignal.scratchpad.pop(
+                                base + "george"), {"name": "George"})
+
+
+class TestPrefilter(unittest.TestCase):
+
+    def test_candidates(self):
+        hook_name = "__durian__.unittest.testphook"
+        joe = testhook.add_listener("http://where.joe/plistens/joe",
+                                    match={"name": match.Is("Joe"),
+                                           "address": {"zip": 7000}})
+        george = testhook.add_listener("http://where.joe/plistens/george",
+                                       match={"name": "George"})
+        anyone = testhook.add_listener("http://where.joe/plistens/any")
+        starts = testhook.add_listener("http://where.joe/plistens/s",
+                                match={"name": match.Startswith("J")})
+        for listener in (joe, george, anyone, starts):
+            listener.hook = hook_name
+            listener.save()
+        self.assertFalse(joe.wildcard)
+        self.assertTrue(starts.wildcard)
+        self.assertEquals(joe.conditions.get().field, "address.zip")
+        condition = joe.conditions.get()
+        self.assertEquals(condition.key, condition_key(hook_name,
+                                                       condition.field,
+                                                       condition.value))
+
+        def candidates(payload):
+            return [listener.pk for listener in
+                        Listener.objects.candidates(hook_name, payload)]
+
+        self.assertEquals(candidates({"name": "Joe",
+                                      "address": {"zip": 7000.0}}),
+                          [joe.pk, anyone.pk, starts.pk])
+        self.assertEquals(candidates({"name": "George"}),
+                          [george.pk, anyone.pk, starts.pk])
+        self.assertEquals(candidates({}), [anyone.pk, starts.pk])
+        self.assertEquals(candidates({"name": "\xff",
+                                      "address": {"zip": Decimal(7000)}}),
+                          [joe.pk, anyone.pk, starts.pk])
+
+        george.match = {"name": match.Contains("orge")}
+        george.save()
+        self.assertTrue(Listener.objects.get(pk=george.pk).wildcard)
+        self.assertFalse(george.conditions.all())
+
+        Listener.objects.filter(pk=joe.pk).update(wildcard=True)
+        joe.conditions.all().delete()
+        Listener.objects.reindex(hook_name)
+        self.assertFalse(Listener.objects.get(pk=joe.pk).wildcard)
+        self.assertEquals(candidates({"address": {"zip": 7000}}),
+                          [joe.pk, george.pk, anyone.pk, starts.pk])
+
+    def test_trigger_event(self):
+        hook = Hook(name="__durian__.unittest.testp2hook",
+                    provides_args=["name"],
+                    task_cls=TestWebhookSignal,
+                    prefilter=True,
+                    async=False)
+        hook.add_listener("http://where.joe/p2listens/joe",
+                          match={"name": "Joe"})
+        hook.add_listener("http://where.joe/p2listens/george",
+                          match={"name": "George"})
+        hook.send(sender=self, name="Joe")
+        self.assertTrue(TestWebhookSignal.scratchpad.pop(
+                            "http://where.joe/p2listens/joe"))
+        self.assertFalse(TestWebhookSignal.scratchpad.get(
+                            "http://where.joe/p2listens/george"))
+
+
+class TestLocalConcurrency(unittest.TestCase):
+
+    def test_trigger_event(self):
+        hook = Hook(name="__durian__.unittest.testlhook",
+                    provides_args=["name"],
+                    task_cls=SlowWebhookSignal,
+                    local_concurrency=5,
+                    async=False)
+        urls = ["http://where.joe/llistens/%d" % i for i in range(5)]
+        for url in urls:
+            hook.add_listener(url, match={"name": "Joe"})
+
+        time_start = time.time()
+        results = hook.send(sender=self, name="Joe")
+        self.assertTrue(time.time() - time_start < 0.8)
+        self.assertEquals([result.status for result in results],
+                          ["DONE"] * 5)
+        threads = set(SlowWebhookSignal.scratchpad.pop(url) for url in urls)
+        self.assertEquals(len(threads), 5)
+        self.assertFalse(threading.currentThread() in threads)
+
+        hook.local_wait = False
+        results = hook.send(sender=self, name="Joe")
+        self.assertFalse(SlowWebhookSignal.scratchpad)
+        self.assertEquals([result.wait().status for result in results],
+                          ["DONE"] * 5)
+        self.assertEquals(len(SlowWebhookSignal.scratchpad), 5)
+
+
 class TestModelHook(unittest.TestCase):
 
     def test_trigger_event(self):
@@ -135,3 +328,144 @@ class TestModelHook(unittest.TestCase):
             self.assertEquals(scratch["last_name"], "Example")
             self.assertFalse(scratch.get("password"))
             del(TestWebhookSignal.scratchpad[url])
+
+
+saved = Signal(providing_args=["instance", "created"])
+
+testshook = ModelHook(model=User, signal=saved,
+                      name="__durian__.unittest.testshook",
+                      provides_args=["username", "email"],
+                      task_cls=TestWebhookSignal,
+                      skip_unchanged=True,
+                      changes_only=True,
+                      async=False)
+
+
+class TestModelHookChanges(unittest.TestCase):
+    url = "http://where.joe/slistens"
+
+    def setUp(self):
+        self.listener = testshook.add_listener(self.url)
+
+    def tearDown(self):
+        self.listener.delete()
+
+    def save(self, user, created=False):
+        saved.send(sender=User, instance=user, created=created)
+        return TestWebhookSignal.scratchpad.pop(self.url, None)
+
+    def test_changes(self):
+        User.objects.create(username="snap", email="snap@example.com")
+        snap = User.objects.get(username="snap")
+        self.assertEquals(testshook.get_changes(snap), {})
+        self.assertEquals(self.save(snap), None)
+
+        snap.first_name = "Not watched"
+        self.assertEquals(self.save(snap), None)
+
+        snap.email = "snap@example.org"
+        self.assertEquals(self.save(snap),
+                          {"email": "snap@example.org", "created": False,
+                           "changes": {"email": {
+                                        "old": "snap@example.com",
+                                        "new": "snap@example.org"}}})
+        self.assertEquals(self.save(snap), None)
+
+    def test_created(self):
+        user = User(username="snap2", email="snap2@example.com")
+        self.assertEquals(self.save(user, created=True),
+                          {"username": "snap2", "email": "snap2@example.com",
+                           "created": True})
+
+    def test_no_snapshot(self):
+        user = User(username="snap3")
+        del(user._durian_snapshots)
+        self.assertEquals(self.save(user)["username"], "snap3")
+
+
+testrhook = ModelHook(model=Message, signal=saved,
+                      name="__durian__.unittest.testrhook",
+                      related_fields=["user__username", "user__email"],
+                      task_cls=TestWebhookSignal,
+                      async=False)
+
+
+class TestModelHookRelated(unittest.TestCase):
+    url = "http://where.joe/rlistens"
+
+    def setUp(self):
+        self.listener = testrhook.add_listener(self.url)
+        self.user = User.objects.create(username="rel",
+                                        email="rel@example.com")
+        self.debug = settings.DEBUG
+        settings.DEBUG = True
+
+    def tearDown(self):
+        settings.DEBUG = self.debug
+        self.listener.delete()
+        self.user.delete()
+
+    def save(self, message):
+        connection.queries = []
+        testrhook.send(sender=Message, instance=message, created=False)
+        return TestWebhookSignal.scratchpad.pop(self.url)
+
+    def assertQueries(self, count):
+        self.assertEquals(len([query for query in connection.queries
+                                if "auth_message" in query["sql"]]), count)
+
+    def test_related_values(self):
+        message = Message.objects.create(user=self.user, message="Hi")
+        expected = {"user": self.user.pk, "message": "Hi",
+                    "user__username": "rel",
+                    "user__email": "rel@example.com",
+                    "created": False}
+        # The related user is cached on the instance.
+        self.assertEquals(self.save(message), expected)
+        self.assertQueries(0)
+
+        message = Message.objects.get(pk=message.pk)
+        self.assertEquals(self.save(message), expected)
+        self.assertQueries(1)
+
+
+class TestNoListeners(unittest.TestCase):
+
+    def test_send_without_listeners(self):
+        prepared = []
+
+        class PreparingHook(Hook):
+
+            def prepare_payload(self, sender, payload):
+                prepared.append(payload)
+                return payload
+
+        hook = PreparingHook(name="__durian__.unittest.testnhook",
+                             provides_args=["name"],
+                             task_cls=TestWebhookSignal,
+                             async=False)
+        self.assertEquals(hook.send(sender=self, name="Joe"), [])
+        self.assertEquals(prepared, [])
+        listener = hook.add_listener("http://where.joe/nlistens")
+        hook.send(sender=self, name="Joe")
+        self.assertEquals(prepared, [{"name": "Joe"}])
+        listener.delete()
+
+    def test_lazy_connect(self):
+        lazy_signal = Signal(providing_args=["instance", "created"])
+        hook = ModelHook(model=User, signal=lazy_signal,
+                         name="__durian__.unittest.testlazyhook",
+                         provides_args=["username"],
+                         task_cls=TestWebhookSignal,
+                         lazy_connect=True,
+                         async=False)
+        self.assertFalse(lazy_signal.receivers)
+        request_started.send(sender=self)
+        self.assertFalse(lazy_signal.receivers)
+
+        # Saving a listener connects the hook.
+        listener = hook.add_listener("http://where.joe/lazylistens")
+        self.assertTrue(lazy_signal.receivers)
+        hook.disconnect()
+        self.assertFalse(lazy_signal.receivers)
+        listener.delete()
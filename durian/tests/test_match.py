@@ -1,8 +1,17 @@
 from durian.match.strategy import deepmatch
-from durian.match.able import Is, Like, Startswith, Endswith, Contains
+from durian.match.able import Is, Like, Startswith, Endswith, Contains, Any
+from durian.match.index import MatchIndex, condition_row, iterleaves
+from durian.match.trie import Trie, SuffixTrie
+from durian.match.ahocorasick import Automaton
+from durian.match.compiler import compile_match
+from durian.match.batch import match_matrix, matching_listeners
+from durian.match import batch
+from durian.match.stats import MatchStats
 from durian.match import mtuplelist_to_matchdict
 from durian import match
 import unittest
+import pickle
+from decimal import Decimal
 
 
 class TestMtuplelist(unittest.TestCase):
@@ -38,6 +47,38 @@ class TestMtuplelist(unittest.TestCase):
         self.assertFalse(deepmatch(notmatches, matchdict))
 
 
+class TestMatchable(unittest.TestCase):
+
+    def test_slots(self):
+        for matchable in (Is(1), Like("x"), Startswith("x"), Any("")):
+            self.assertFalse(hasattr(matchable, "__dict__"))
+
+    def test_interned(self):
+        self.assertTrue(Like.interned("^a") is Like.interned("^a"))
+        self.assertTrue(Is.interned(1) is not Is.interned(1.0))
+        self.assertTrue(Is.interned(1) is not Startswith.interned(1))
+        unhashable = Is.interned(["a"])
+        self.assertEquals(unhashable.value, ["a"])
+        self.assertTrue(unhashable is not Is.interned(["a"]))
+
+    def test_pickle(self):
+        matchable = Like.interned(r"^\d+$")
+        self.assertTrue(matchable.pattern)
+        self.assertTrue(pickle.loads(pickle.dumps(matchable)) is matchable)
+        self.assertTrue(pickle.loads(pickle.dumps(matchable, 2))
+                            is matchable)
+        self.assertEquals(pickle.loads(pickle.dumps(Is(3))), 3)
+
+    def test_legacy_state(self):
+        # Matchables pickled before __slots__ kept their value in a dict.
+        matchable = Like.__new__(Like)
+        matchable.__setstate__({"value": "^x", "_pattern": None})
+        self.assertEquals(matchable, "xyz")
+        matchable = Is.__new__(Is)
+        matchable.__setstate__((None, {"value": 3}))
+        self.assertEquals(matchable, 3)
+
+
 class TestStrategy(unittest.TestCase):
 
     def test_deepmatch(self):
@@ -81,3 +122,328 @@ class TestStrategy(unittest.TestCase):
         self.assertFalse(deepmatch({"foo": 1}, {"foo": "1"}))
         self.assertFalse(deepmatch({"foo": "bar", "baz": {"x": "x"}},
                                    {"foo": "bar"}))
+
+
+class TestCompiler(unittest.TestCase):
+    matches = [
+        {},
+        {"name": "George Constanza"},
+        {"name": Is("George Constanza"), "zip": Any("")},
+        {"name": Startswith("George"), "zip": 7020},
+        {"name": Endswith("Benes")},
+        {"name": Contains("Const")},
+        {"name": Like("^Geo.*za$")},
+        {"name": {"first_name": Startswith("El"),
+                  "last_name": Endswith("es")}},
+        {"name": {}},
+        {"mooze": {"a": "b", "c": {"d": "e"}}, "foo": "xuzzy"},
+    ]
+    payloads = [
+        {"name": "George Constanza", "zip": 7020},
+        {"name": "George Constanza", "zip": "7020"},
+        {"name": "Elaine Benes"},
+        {"name": {"first_name": "Elaine", "last_name": "Benes"}},
+        {"mooze": {"a": "b", "c": {"d": "e"}}, "foo": "xuzzy"},
+        {"mooze": {"a": "b", "c": {"x": "y"}}, "foo": "xuzzy"},
+    ]
+
+    def outcome(self, fun, *args):
+        try:
+            return fun(*args)
+        except Exception, exc:
+            return exc.__class__
+
+    def test_same_as_deepmatch(self):
+        for match in self.matches:
+            predicate = compile_match(match)
+            for payload in self.payloads:
+                self.assertEquals(self.outcome(predicate, payload),
+                                  self.outcome(deepmatch, match, payload),
+                                  "%r %r" % (match, payload))
+
+    def test_inlined(self):
+        predicate = compile_match({"name": Startswith("George")})
+        self.assertTrue(".startswith(" in predicate.source)
+        self.assertFalse("Startswith" in predicate.source)
+
+
+class TestMatchStats(unittest.TestCase):
+
+    def test_reorder(self):
+        stats = MatchStats(sample_every=1, refresh_every=20)
+        match = {"name": Like("^(Geo|Ela).*(za|es)$"), "zip": Is("7020")}
+        for i in range(20):
+            payload = {"name": "George Constanza", "zip": str(7001 + i)}
+            stats.should_sample() and stats.measure(match, payload)
+        self.assertEquals(stats.version, 1)
+        report = dict((entry["kind"], entry) for entry in stats.stats)
+        self.assertEquals(report["Is"]["evaluated"], 20)
+        self.assertEquals(report["Is"]["rejected"], 19)
+        self.assertEquals(report["Like"]["reject_rate"], 0.0)
+        self.assertEquals(stats.stats[0]["kind"], "Is")
+
+        source = compile_match(match, rank=stats.rank).source
+        self.assertTrue(source.index("==") < source.index("(v)"))
+        predicate = compile_match(match, rank=stats.rank)
+        for payload in TestCompiler.payloads:
+            if isinstance(payload.get("name"), basestring):
+                self.assertEquals(predicate(payload),
+                                  deepmatch(match, payload))
+
+        stats.clear()
+        self.assertEquals(stats.stats, [])
+
+    def test_groups(self):
+        stats = MatchStats(sample_every=1, refresh_every=4, group_size=3)
+        match = {"zip": Is("7020")}
+        for i in range(5):
+            stats.measure(match, {"zip": str(7019 + i)})
+        # The last two samples are waiting for the rest of their group.
+        self.assertEquals(stats.samples, 3)
+        self.assertEquals(stats.version, 0)
+        self.assertEquals(stats.stats[0]["evaluated"], 3)
+        self.assertEquals(stats.stats[0]["rejected"], 2)
+        stats.measure(match, {"zip": "7020"})
+        self.assertEquals(stats.version, 1)
+        self.assertEquals(stats.stats[0]["evaluated"], 6)
+        self.assertEquals(stats.stats[0]["rejected"], 4)
+        self.assertTrue(stats.stats[0]["avg_cost"] > 0)
+
+
+class MockListener(object):
+
+    def __init__(self, pk, match):
+        self.pk = pk
+        self.match = match
+
+
+class TestBatch(unittest.TestCase):
+
+    def expected(self, match, payload):
+        try:
+            return deepmatch(match, payload)
+        except Exception:
+            return False
+
+    def assertSameAsDeepmatch(self, use_numpy):
+        matches = TestCompiler.matches + [{"zip": 7020},
+                                          {"zip": Is("7020")},
+                                          {"zip": Contains("02")},
+                                          {"missing": None}]
+        listeners = [MockListener(i, match)
+                        for i, match in enumerate(matches)]
+        payloads = TestCompiler.payloads
+        matrix = match_matrix(listeners, payloads, use_numpy=use_numpy)
+        for i, listener in enumerate(listeners):
+            for j, payload in enumerate(payloads):
+                self.assertEquals(bool(matrix[i][j]),
+                                  self.expected(listener.match, payload),
+                                  "%r %r" % (listener.match, payload))
+        self.assertEquals([l.pk for l in matching_listeners(matrix,
+                                                            listeners, 2)],
+                          [0, 4, 8, 13])
+
+    def test_python(self):
+        self.assertSameAsDeepmatch(use_numpy=False)
+
+    def test_bytestrings(self):
+        matches = [{"name": u"caf\xe9"}, {"name": "caf\xc3\xa9"},
+                   {"name": "cafe"}, {"name": u"cafe"},
+                   {"name": Is(u"caf\xe9")}, {"name": Startswith("caf")},
+                   {"name": Startswith(u"caf\xe9")},
+                   {"name": Endswith("\xa9")}, {"name": Contains(u"af")},
+                   {"name": Startswith(70)}]
+        listeners = [MockListener(i, match)
+                        for i, match in enumerate(matches)]
+        payloads = [{"name": name} for name in ("\xe9", "caf\xc3\xa9",
+                                                u"caf\xe9", "cafe", u"cafe",
+                                                "7020", 7020)]
+        for use_numpy in (False, batch.numpy is not None):
+            matrix = match_matrix(listeners, payloads, use_numpy=use_numpy)
+            for i, listener in enumerate(listeners):
+                for j, payload in enumerate(payloads):
+                    self.assertEquals(bool(matrix[i][j]),
+                                      self.expected(listener.match, payload),
+                                      "%d %d" % (i, j))
+
+    def test_nul_characters(self):
+        matches = [{"name": u"a"}, {"name": u"a\x00"},
+                   {"name": Endswith(u"a")}, {"name": Contains(u"\x00")},
+                   {"name": Startswith(u"a\x00")}, {"name": Is("a\x00")}]
+        listeners = [MockListener(i, match)
+                        for i, match in enumerate(matches)]
+        payloads = [{"name": name} for name in (u"a", u"a\x00", u"b",
+                                                "a\x00b", "a\x00")]
+        for use_numpy in (False, batch.numpy is not None):
+            matrix = match_matrix(listeners, payloads, use_numpy=use_numpy)
+            for i, listener in enumerate(listeners):
+                for j, payload in enumerate(payloads):
+                    self.assertEquals(bool(matrix[i][j]),
+                                      self.expected(listener.match, payload),
+                                      "%d %d" % (i, j))
+
+    def test_numpy(self):
+        if batch.numpy is None:
+            return
+        self.assertSameAsDeepmatch(use_numpy=True)
+
+
+class TestMatchIndex(unittest.TestCase):
+
+    def test_candidates(self):
+        joe = MockListener(1, {"name": "Joe"})
+        george = MockListener(2, {"name": Is("George"),
+                                  "address": Endswith("York")})
+        anyone = MockListener(3, {"name": Any("")})
+        nested = MockListener(4, {"author": {"email": "x@example.com"}})
+        scan = MockListener(5, {"name": Like("^G.*e$")})
+        index = MatchIndex([joe, george, anyone, nested, scan])
+        self.assertEquals(index.wildcards, set([3]))
+        self.assertEquals(index.unindexed, set([5]))
+
+        def candidates(payload):
+            return [listener.pk for listener in index.candidates(payload)]
+
+        self.assertEquals(candidates({"name": "Joe"}), [1, 3, 5])
+        self.assertEquals(candidates({"name": "George"}), [2, 3, 5])
+        self.assertEquals(candidates({"name": ["unhashable"]}), [3, 5])
+        self.assertEquals(candidates({"author": {"email": "x@example.com"}}),
+                          [3, 4, 5])
+        self.assertEquals(candidates({"author": "x@example.com"}), [3, 5])
+
+    def test_update(self):
+        joe = MockListener(1, {"name": "Joe"})
+        george = MockListener(2, {"name": "George"})
+        index = MatchIndex([joe, george])
+        self.assertEquals(len(index), 2)
+
+        joe2 = MockListener(1, {"name": "Joseph"})
+        index.update([joe2])
+        self.assertEquals(len(index), 1)
+        self.assertFalse(index.candidates({"name": "Joe"}))
+        self.assertFalse(index.candidates({"name": "George"}))
+        self.assertTrue(index.candidates({"name": "Joseph"})[0] is joe2)
+        self.assertEquals(index.buckets, {("name", ): {"Joseph": set([1])}})
+
+    def test_prefixes_and_suffixes(self):
+        heads = MockListener(1, {"ref": Startswith("refs/heads/")})
+        master = MockListener(2, {"ref": Endswith("/master")})
+        tags = MockListener(3, {"ref": Startswith("refs/tags/")})
+        index = MatchIndex([heads, master, tags])
+        self.assertFalse(index.unindexed)
+
+        def candidates(payload):
+            return [listener.pk for listener in index.candidates(payload)]
+
+        self.assertEquals(candidates({"ref": "refs/heads/master"}), [1, 2])
+        self.assertEquals(candidates({"ref": "refs/tags/v1.0"}), [3])
+        self.assertEquals(candidates({"ref": "refs/remotes/origin/master"}),
+                          [2])
+        # Not strings, so they raise an error like with deepmatch.
+        self.assertEquals(candidates({"ref": 10}), [1, 2, 3])
+        self.assertEquals(candidates({}), [1, 2, 3])
+        self.assertRaises(AttributeError, deepmatch, heads.match, {})
+
+        index.remove(tags)
+        self.assertEquals(candidates({"ref": "refs/tags/v1.0"}), [])
+        index.remove(heads)
+        index.remove(master)
+        self.assertEquals(index.string_routes, {})
+
+    def test_missing_parent(self):
+        index = MatchIndex([MockListener(1, {"commit": {"ref": Contains(
+                                                            "master")}})])
+        self.assertEquals(index.candidates({}), [])
+        self.assertEquals(deepmatch({"commit": {"ref": Contains("master")}},
+                                    {}), False)
+        self.assertEquals(len(index.candidates({"commit": {}})), 1)
+
+
+class TestConditionRow(unittest.TestCase):
+
+    def test_condition_row(self):
+        self.assertEquals(condition_row(("name", ), "Joe"),
+                          (u"name", u"s:Joe"))
+        self.assertEquals(condition_row(("a", "zip"), 7000),
+                          condition_row(("a", "zip"), 7000.0))
+        self.assertEquals(condition_row(("x", ), True), (u"x", u"n:1"))
+        self.assertEquals(condition_row(("x", ), 1.5), (u"x", u"n:1.5"))
+        self.assertEquals(condition_row(("x", ), float("inf"))[1],
+                          u"n:inf")
+        self.assertNotEquals(condition_row(("x", ), "1"),
+                             condition_row(("x", ), 1))
+        self.assertEquals(condition_row(("x", ), None), None)
+        self.assertEquals(len(condition_row(("x", ), "y" * 300)[1]), 255)
+        self.assertEquals(condition_row(("x", ), Decimal("7000")),
+                          condition_row(("x", ), 7000))
+        self.assertEquals(condition_row(("x", ), Decimal("1.5")),
+                          condition_row(("x", ), 1.5))
+        self.assertEquals(condition_row(("x", ), 1j), None)
+        self.assertEquals(condition_row(("x", ), "\xff"), None)
+        self.assertEquals(condition_row(("\xff", ), "x"), None)
+
+    def test_iterleaves(self):
+        self.assertEquals(sorted(iterleaves({"a": {"b": 1, "c": [1]},
+                                             "d": "x"})),
+                          [(("a", "b"), 1), (("d", ), "x")])
+
+
+class TestTrie(unittest.TestCase):
+
+    def test_prefixes(self):
+        trie = Trie()
+        trie.add("refs/heads/", "branches")
+        trie.add("refs/", "refs")
+        trie.add("", "everything")
+        self.assertEquals(len(trie), 3)
+        self.assertEquals(trie.prefixes("refs/heads/master"),
+                          set(["branches", "refs", "everything"]))
+        self.assertEquals(trie.prefixes("refs"), set(["everything"]))
+
+        trie.remove("refs/heads/", "branches")
+        trie.remove("refs/heads/", "missing")
+        trie.remove("refs/tags/", "missing")
+        self.assertEquals(len(trie), 2)
+        self.assertEquals(trie.prefixes("refs/heads/master"),
+                          set(["refs", "everything"]))
+        trie.remove("refs/", "refs")
+        trie.remove("", "everything")
+        self.assertEquals(trie.root, {})
+
+    def test_suffixes(self):
+        trie = SuffixTrie()
+        trie.add("/master", "master")
+        trie.add("er", "er")
+        self.assertEquals(trie.suffixes("refs/heads/master"),
+                          set(["master", "er"]))
+        self.assertEquals(trie.suffixes("master/x"), set())
+
+
+class TestAutomaton(unittest.TestCase):
+
+    def test_search(self):
+        automaton = Automaton()
+        for needle, item in (("he", 1), ("she", 2), ("his", 3),
+                             ("hers", 4), ("", 5), ("xyzzy", 6)):
+            automaton.add(needle, item)
+        self.assertEquals(automaton.search("ushers"), set([1, 2, 4, 5]))
+        self.assertEquals(automaton.search("ahis"), set([3, 5]))
+        self.assertEquals(automaton.search(""), set([5]))
+        self.assertEquals(automaton.builds, 1)
+
+        automaton.remove("", 5)
+        automaton.remove("he", 1)
+        automaton.add("us", 7)
+        self.assertEquals(automaton.search("ushers"), set([2, 4, 7]))
+        self.assertEquals(automaton.builds, 2)
+
+    def test_index_contains(self):
+        bug = MockListener(1, {"message": Contains("bug")})
+        fix = MockListener(2, {"message": Like("fix")})
+        regex = MockListener(3, {"message": Like("^fix")})
+        index = MatchIndex([bug, fix, regex])
+        self.assertEquals(index.unindexed, set([3]))
+        self.assertEquals([listener.pk for listener in index.candidates(
+                            {"message": "fixes bug #42"})], [1, 2, 3])
+        self.assertEquals([listener.pk for listener in index.candidates(
+                            {"message": "fixes typo"})], [2, 3])
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+import unittest
+from django.core.management import call_command
+from durian.event import Hook
+from durian.models import OutboxEvent
+from durian.outbox import claim_events, drain_outbox
+from durian.registry import hooks
+from durian.tests.test_hooks import TestWebhookSignal
+
+testohook = Hook(name="__durian__.unittest.testohook",
+                 provides_args=["name"],
+                 task_cls=TestWebhookSignal,
+                 outbox=True,
+                 async=False)
+hooks.register(testohook)
+
+
+class TestOutbox(unittest.TestCase):
+
+    def setUp(self):
+        OutboxEvent.objects.all().delete()
+        TestWebhookSignal.scratchpad.pop("http://where.joe/olistens", None)
+        self.listener = testohook.add_listener("http://where.joe/olistens",
+                                               match={"name": "Joe"})
+
+    def tearDown(self):
+        self.listener.delete()
+
+    def test_send_and_drain(self):
+        url = "http://where.joe/olistens"
+        self.assertEquals(testohook.send(sender=self, name="Joe"), [])
+        testohook.send(sender=self, name="George")
+        self.assertFalse(url in TestWebhookSignal.scratchpad)
+        self.assertEquals(OutboxEvent.objects.count(), 2)
+
+        call_command("durian_drain_outbox", batch_size=1, verbosity=0)
+        self.assertEquals(OutboxEvent.objects.count(), 0)
+        self.assertEquals(TestWebhookSignal.scratchpad.pop(url),
+                          {"name": "Joe"})
+
+    def test_claim(self):
+        for name in ("Joe", "George", "Jane"):
+            testohook.send(sender=self, name=name)
+        first = claim_events(batch_size=2)
+        self.assertEquals(len(first), 2)
+        second = claim_events(batch_size=2)
+        self.assertEquals(len(second), 1)
+        self.assertFalse(set(e.pk for e in first) & set(e.pk for e in second))
+        self.assertEquals(claim_events(), [])
+        # Expired claims can be taken over.
+        OutboxEvent.objects.update(claimed_until=datetime.now() -
+                                                  timedelta(seconds=1))
+        self.assertEquals(drain_outbox(hook_names=["other.hook"]), 0)
+        self.assertEquals(drain_outbox(), 3)
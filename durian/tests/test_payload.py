@@ -0,0 +1,61 @@
+import unittest
+import pickle
+from datetime import datetime
+from durian import conf
+from durian.payload import EncodedPayload, encode_payload, payload_body
+from durian.event import Hook
+from durian.tests.test_hooks import TestWebhookSignal
+
+encoded = []
+
+
+def counting_encoder(payload):
+    encoded.append(payload)
+    return "encoded:%s" % payload["name"]
+
+
+class TestEncodedPayload(unittest.TestCase):
+
+    def test_encode(self):
+        payload = encode_payload({"name": "Joe",
+                                  "joined": datetime(2009, 10, 1, 12, 30)})
+        self.assertEquals(payload["name"], "Joe")
+        self.assertTrue('"joined": "2009-10-01 12:30:00"' in payload.body)
+        self.assertTrue(encode_payload(payload) is payload)
+        self.assertEquals(payload_body(payload), payload.body)
+        self.assertEquals(payload_body({"name": "Joe"}), '{"name": "Joe"}')
+
+    def test_immutable(self):
+        payload = EncodedPayload({"name": "Joe"})
+        self.assertRaises(TypeError, payload.__setitem__, "name", "George")
+        self.assertRaises(TypeError, payload.update, {"name": "George"})
+        self.assertRaises(TypeError, payload.pop, "name")
+
+    def test_pickle(self):
+        payload = EncodedPayload({"name": "Joe"}, body='{"name": "Joe"}')
+        pickled = pickle.dumps(payload, protocol=2)
+        self.assertEquals(pickled.count("Joe"), 1)
+        unpickled = pickle.loads(pickled)
+        self.assertTrue(isinstance(unpickled, EncodedPayload))
+        self.assertEquals(unpickled, {"name": "Joe"})
+        self.assertEquals(unpickled.body, payload.body)
+
+    def test_encoded_once(self):
+        hook = Hook(name="__durian__.unittest.testpayloadhook",
+                    provides_args=["name"],
+                    task_cls=TestWebhookSignal,
+                    async=False)
+        urls = ["http://where.joe/plistens/%d" % i for i in range(3)]
+        for url in urls:
+            hook.add_listener(url)
+
+        prev_encoder = conf.PAYLOAD_ENCODER
+        conf.PAYLOAD_ENCODER = "durian.tests.test_payload.counting_encoder"
+        try:
+            hook.send(sender=self, name="Joe")
+        finally:
+            conf.PAYLOAD_ENCODER = prev_encoder
+        self.assertEquals(len(encoded), 1)
+        for url in urls:
+            payload = TestWebhookSignal.scratchpad.pop(url)
+            self.assertEquals(payload.body, "encoded:Joe")
@@ -0,0 +1,103 @@
+import unittest
+import time
+from celery.registry import tasks
+from durian.breaker import LocalBackend
+from durian.event import Hook
+from durian.ratelimit import HostLimiter, RateLimited, parse_rate
+from durian.ratelimit import listener_limits
+from durian.tasks import WebhookSignal
+from durian import conf
+
+HOST = "where.joe:8080"
+
+
+class TimedWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.TimedWebhookSignal"
+    delivered = []
+
+    def deliver(self, url, body, timeout=None):
+        self.delivered.append((url, time.time()))
+tasks.register(TimedWebhookSignal)
+
+
+class BusyWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.BusyWebhookSignal"
+    attempts = []
+
+    def deliver_to_host(self, url, body, **kwargs):
+        self.attempts.append(url)
+        raise RateLimited(HOST, 0.001)
+tasks.register(BusyWebhookSignal)
+
+
+class TestHostLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = HostLimiter(backend=LocalBackend(), delay=2)
+
+    def test_parse_rate(self):
+        self.assertEquals(parse_rate(None), None)
+        self.assertEquals(parse_rate(5), 5.0)
+        self.assertEquals(parse_rate("10/s"), 10.0)
+        self.assertEquals(parse_rate("120/m"), 2.0)
+        self.assertEquals(parse_rate("3600/h"), 1.0)
+        self.assertEquals(parse_rate("7"), 7.0)
+
+    def test_listener_limits(self):
+        self.assertEquals(listener_limits({"rate_limit": "1/s", "x": 1}),
+                          {"rate_limit": "1/s"})
+        self.assertEquals(listener_limits(None), {})
+
+    def test_token_bucket(self):
+        limiter = self.limiter
+        self.assertEquals(limiter.acquire(HOST, rate_limit="10/s",
+                                          rate_limit_burst=2), 0)
+        self.assertEquals(limiter.acquire(HOST, rate_limit="10/s",
+                                          rate_limit_burst=2), 0)
+        wait = limiter.acquire(HOST, rate_limit="10/s", rate_limit_burst=2)
+        self.assertTrue(0 < wait <= 0.1)
+        self.assertEquals(limiter.acquire("other.host", rate_limit="10/s",
+                                          rate_limit_burst=2), 0)
+        time.sleep(wait)
+        self.assertEquals(limiter.acquire(HOST, rate_limit="10/s",
+                                          rate_limit_burst=2), 0)
+
+    def test_in_flight(self):
+        limiter = self.limiter
+        self.assertEquals(limiter.acquire(HOST, max_in_flight=2), 0)
+        self.assertEquals(limiter.acquire(HOST, max_in_flight=2), 0)
+        self.assertEquals(limiter.acquire(HOST, max_in_flight=2), 2)
+        self.assertRaises(RateLimited, limiter.check, HOST, max_in_flight=2)
+        limiter.release(HOST, max_in_flight=2)
+        self.assertEquals(limiter.acquire(HOST, max_in_flight=2), 0)
+
+
+class TestRateLimitedHook(unittest.TestCase):
+
+    def test_max_deferrals(self):
+        # Applied locally, so the caller would wait forever.
+        result = BusyWebhookSignal.apply(args=["http://busy.joe/", {}])
+        self.assertRaises(RateLimited, result.get)
+        self.assertEquals(len(BusyWebhookSignal.attempts),
+                          conf.RATE_LIMIT_MAX_DEFERRALS + 1)
+
+    def test_deferred(self):
+        hook = Hook(name="__durian__.unittest.testratehook",
+                    provides_args=["name"],
+                    task_cls=TimedWebhookSignal,
+                    rate_limit="20/s",
+                    rate_limit_burst=1,
+                    async=False)
+        urls = ["http://rate.joe/listens/%d" % i for i in range(3)]
+        for url in urls:
+            hook.add_listener(url)
+        hook.add_listener("http://unlimited.joe/listens",
+                          rate_limit="1000/s", rate_limit_burst=10)
+        time_start = time.time()
+        hook.send(sender=self, name="Joe")
+        self.assertEquals(sorted(url for url, _ in
+                                    TimedWebhookSignal.delivered),
+                          sorted(urls + ["http://unlimited.joe/listens"]))
+        # The second and the third delivery to the host waits for a token.
+        self.assertTrue(time.time() - time_start >= 0.09)
+        TimedWebhookSignal.delivered[:] = []
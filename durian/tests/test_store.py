@@ -0,0 +1,211 @@
+import unittest
+import hashlib
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import os
+from durian.event import Hook
+from durian.payload import encode_payload, payload_body
+from durian.store import CacheStore, DatabaseStore, FileStore, get_store
+from durian.store import PayloadReference, PayloadMissing, store_payload
+from durian.store import resolved
+from durian.tasks import WebhookSignal
+from django.core.cache import cache
+from celery.registry import tasks
+
+CACHE_STORE = "durian.store.CacheStore"
+
+
+class RecordingWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.RecordingWebhookSignal"
+    delivered = {}
+
+    def deliver(self, url, body, timeout=None):
+        self.__class__.delivered[url] = body
+tasks.register(RecordingWebhookSignal)
+
+
+class StoreCase(object):
+
+    def create_store(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def test_put_get_release(self):
+        store = self.store
+        self.assertTrue(store.get("0123abcd") is None)
+        store.put("0123abcd", '{"name": "Joe"}', refs=2)
+        self.assertEquals(store.get("0123abcd"), '{"name": "Joe"}')
+        store.put("0123abcd", '{"name": "Joe"}')
+        store.release("0123abcd", 2)
+        self.assertEquals(store.get("0123abcd"), '{"name": "Joe"}')
+        store.release("0123abcd")
+        self.assertTrue(store.get("0123abcd") is None)
+
+
+class RecordingCache(object):
+
+    def __init__(self):
+        self.timeouts = []
+
+    def set(self, key, value, timeout=None):
+        self.timeouts.append(timeout)
+        return cache.set(key, value, timeout)
+
+    def __getattr__(self, name):
+        return getattr(cache, name)
+
+
+def run_in_thread(fun, *args):
+    thread = threading.Thread(target=fun, args=args)
+    thread.start()
+    time.sleep(0.1)
+    return thread
+
+
+class TestCacheStore(StoreCase, unittest.TestCase):
+
+    def create_store(self):
+        return CacheStore()
+
+    def test_timeouts(self):
+        store = CacheStore(timeout=1234, backend=RecordingCache())
+        store.put("2345bcde", "{}", refs=2)
+        store.release("2345bcde")
+        self.assertEquals(store.backend.timeouts, [1234, 1234, 1234])
+        store.release("2345bcde")
+
+    def test_put_while_released(self):
+        store = self.store
+        store.put("3456cdef", "{}")
+        # Another process is releasing the last reference.
+        store._lock("3456cdef")
+        thread = run_in_thread(store.put, "3456cdef", "{}")
+        self.assertTrue(thread.isAlive())
+        store.backend.delete(store.key_format % "3456cdef")
+        store.backend.delete(store.refs_key_format % "3456cdef")
+        store._unlock("3456cdef")
+        thread.join()
+        self.assertEquals(store.get("3456cdef"), "{}")
+        store.release("3456cdef")
+        self.assertTrue(store.get("3456cdef") is None)
+
+
+class TestDatabaseStore(StoreCase, unittest.TestCase):
+
+    def create_store(self):
+        return DatabaseStore()
+
+    def test_put_while_released(self):
+        store = self.store
+        store.put("89abcdef", "{}")
+        manager = store.model.objects
+        get_or_create = manager.get_or_create
+
+        def racing_get_or_create(**kwargs):
+            # The last reference is released right after we found it.
+            result = get_or_create(**kwargs)
+            del(manager.get_or_create)
+            store.release("89abcdef")
+            return result
+        manager.get_or_create = racing_get_or_create
+        try:
+            store.put("89abcdef", "{}")
+        finally:
+            manager.__dict__.pop("get_or_create", None)
+        self.assertEquals(store.get("89abcdef"), "{}")
+        self.assertEquals(manager.get(digest="89abcdef").refs, 1)
+        store.release("89abcdef")
+        self.assertTrue(store.get("89abcdef") is None)
+
+    def test_cleanup(self):
+        store = DatabaseStore(timeout=-1)
+        store.put("4567cdef", "{}")
+        self.assertTrue(store.get("4567cdef") is None)
+        store.cleanup()
+        self.assertFalse(store.model.objects.filter(digest="4567cdef"))
+
+
+class TestFileStore(StoreCase, unittest.TestCase):
+
+    def create_store(self):
+        self.directory = tempfile.mkdtemp()
+        return FileStore(directory=self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_while_released(self):
+        store = self.store
+        store.put("5678efab", "{}")
+        # Another process is releasing the last reference.
+        fh = store._lock_refs("5678efab")
+        thread = run_in_thread(store.put, "5678efab", "{}")
+        self.assertTrue(thread.isAlive())
+        os.unlink(store.path("5678efab"))
+        os.unlink(store.path("5678efab") + ".refs")
+        fh.close()
+        thread.join()
+        self.assertEquals(store.get("5678efab"), "{}")
+        self.assertEquals(open(store.path("5678efab") + ".refs").read(), "1")
+        store.release("5678efab")
+        self.assertTrue(store.get("5678efab") is None)
+
+
+class TestPayloadReference(unittest.TestCase):
+
+    def test_reference(self):
+        payload = encode_payload({"name": "Joe" * 1000})
+        ref = store_payload(payload, CACHE_STORE)
+        self.assertTrue(isinstance(ref, PayloadReference))
+        self.assertEquals(ref.digest, hashlib.sha1(payload.body).hexdigest())
+
+        pickled = pickle.dumps(ref, protocol=2)
+        self.assertFalse("Joe" in pickled)
+        unpickled = pickle.loads(pickled)
+        resolved.clear()
+        self.assertEquals(unpickled.resolve(), payload)
+        self.assertEquals(payload_body(unpickled), payload.body)
+        self.assertTrue(ref.digest in resolved)
+
+        unpickled.release()
+        resolved.clear()
+        self.assertRaises(PayloadMissing, ref.resolve)
+
+
+class TestHookPayloadStore(unittest.TestCase):
+
+    def assertDelivered(self, hook, name):
+        urls = ["http://where.joe/slistens/%d" % i for i in range(3)]
+        for url in urls:
+            hook.add_listener(url)
+        refs = hook.send(sender=self, name=name)
+        self.assertTrue(refs)
+        for url in urls:
+            body = RecordingWebhookSignal.delivered.pop(url)
+            self.assertTrue(name in body)
+        digest = hashlib.sha1(payload_body({"name": name})).hexdigest()
+        # All the listeners have released the payload.
+        self.assertTrue(get_store(CACHE_STORE).get(digest) is None)
+
+    def test_send(self):
+        hook = Hook(name="__durian__.unittest.teststorehook",
+                    provides_args=["name"],
+                    task_cls=RecordingWebhookSignal,
+                    payload_store=CACHE_STORE,
+                    async=False)
+        self.assertDelivered(hook, "Joe")
+
+    def test_send_fanout(self):
+        hook = Hook(name="__durian__.unittest.teststorefhook",
+                    provides_args=["name"],
+                    task_cls=RecordingWebhookSignal,
+                    payload_store=CACHE_STORE,
+                    fanout=True,
+                    fanout_batch_size=2,
+                    async=False)
+        self.assertDelivered(hook, "George")
@@ -0,0 +1,133 @@
+import unittest
+import urllib2
+import socket
+from celery.registry import tasks
+from durian.breaker import CircuitOpen
+from durian.models import DeadLetter
+from durian.payload import encode_payload
+from durian.store import PayloadMissing, store_payload, get_store, resolved
+from durian.tasks import WebhookSignal, backoff
+from durian import conf
+
+CACHE_STORE = "durian.store.CacheStore"
+
+
+class RefusedWebhookSignal(WebhookSignal):
+    name = "__durian__.unittest.RefusedWebhookSignal"
+    attempts = []
+
+    def deliver(self, url, body, timeout=None):
+        self.attempts.append(url)
+        raise urllib2.URLError("Connection refused")
+tasks.register(RefusedWebhookSignal)
+
+
+class LateWebhookSignal(WebhookSignal):
+    """The payload is stored by the time the delivery is retried."""
+    name = "__durian__.unittest.LateWebhookSignal"
+    delivered = []
+
+    def deliver(self, url, body, timeout=None):
+        self.delivered.append((url, body))
+
+    def retry(self, args, kwargs, **options):
+        store_payload(encode_payload({"name": "Joe"}), CACHE_STORE)
+        return super(LateWebhookSignal, self).retry(args, kwargs, **options)
+tasks.register(LateWebhookSignal)
+
+
+class UnsentWebhookSignal(RefusedWebhookSignal):
+    name = "__durian__.unittest.UnsentWebhookSignal"
+
+    def apply_async(self, *args, **kwargs):
+        raise socket.error("Connection refused")
+tasks.register(UnsentWebhookSignal)
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_backoff(self):
+        self.assertEquals([backoff(i, delay=10, multiplier=2, max_delay=60,
+                                   jitter=False) for i in range(5)],
+                          [10, 20, 40, 60, 60])
+        for i in range(100):
+            self.assertTrue(0 <= backoff(2, delay=10, multiplier=3) <= 90)
+        # Zero is a valid delay.
+        self.assertEquals(backoff(3, delay=0, jitter=False), 0)
+        self.assertEquals(backoff(3, max_delay=0, jitter=False), 0)
+        self.assertEquals(backoff(0, jitter=False), conf.RETRY_DELAY)
+
+    def test_retry_countdown(self):
+        task = RefusedWebhookSignal()
+        kwargs = {"task_retries": 1, "retry_delay": 5, "retry_backoff": 3,
+                  "retry_jitter": False}
+        self.assertEquals(task.retry_countdown(kwargs), 15)
+        self.assertEquals(task.retry_countdown(kwargs,
+                                CircuitOpen("where.joe", 30)), 30)
+
+
+class TestWebhookSignalRetry(unittest.TestCase):
+
+    def setUp(self):
+        RefusedWebhookSignal.attempts[:] = []
+
+    def apply(self, **kwargs):
+        kwargs.setdefault("circuit_breaker", False)
+        return RefusedWebhookSignal.apply(args=["http://dead.joe/",
+                                                {"name": "Joe"}],
+                                          kwargs=kwargs)
+
+    def test_no_retry(self):
+        self.assertRaises(urllib2.URLError, self.apply().get)
+        self.assertEquals(len(RefusedWebhookSignal.attempts), 1)
+        self.apply(fail_silently=True).get()
+        self.assertEquals(len(RefusedWebhookSignal.attempts), 2)
+
+    def test_retry(self):
+        self.assertRaises(urllib2.URLError,
+                          self.apply(retry=True, max_retries=2).get)
+        self.assertEquals(len(RefusedWebhookSignal.attempts), 3)
+        self.apply(retry=True, max_retries=2, fail_silently=True).get()
+        self.assertEquals(len(RefusedWebhookSignal.attempts), 6)
+
+    def test_retry_not_sent(self):
+        ref = store_payload(encode_payload({"name": "George"}), CACHE_STORE)
+        self.assertRaises(socket.error, UnsentWebhookSignal().run,
+                          "http://dead.joe/", ref, retry=True,
+                          circuit_breaker=False)
+        # Released, as no retry holds the reference.
+        self.assertTrue(get_store(CACHE_STORE).get(ref.digest) is None)
+
+
+class TestPayloadMissing(unittest.TestCase):
+
+    def setUp(self):
+        self.ref = store_payload(encode_payload({"name": "Joe"}),
+                                 CACHE_STORE)
+        # Not stored (or not committed) yet.
+        self.ref.release()
+        resolved.clear()
+
+    def test_retried(self):
+        result = LateWebhookSignal.apply(args=["http://late.joe/", self.ref],
+                                         kwargs={"retry": True,
+                                                 "retry_delay": 0,
+                                                 "circuit_breaker": False})
+        result.get()
+        self.assertEquals(LateWebhookSignal.delivered.pop(),
+                          ("http://late.joe/", '{"name": "Joe"}'))
+        self.assertTrue(get_store(CACHE_STORE).get(self.ref.digest) is None)
+
+    def test_dead_letter(self):
+        result = RefusedWebhookSignal.apply(args=["http://late.joe/dl",
+                                                  self.ref],
+                                            kwargs={"retry": True,
+                                                    "max_retries": 1,
+                                                    "retry_delay": 0,
+                                                    "dead_letter": True,
+                                                    "circuit_breaker": False})
+        self.assertRaises(PayloadMissing, result.get)
+        dead_letter = DeadLetter.objects.get(url="http://late.joe/dl")
+        self.assertEquals(dead_letter.attempts, 2)
+        self.assertTrue(dead_letter.payload is None)
+        dead_letter.delete()
@@ -0,0 +1,111 @@
+"""durian.utils"""
+from django.utils.importlib import import_module
+import threading
+
+
+def get_cls_by_name(name):
+    """Get a class (or any other module attribute) by its full dotted
+    name, e.g. ``"durian.engine.MultiplexEngine"``.
+
+    If ``name`` isn't a string, it's returned as-is.
+
+    """
+    if not isinstance(name, basestring):
+        return name
+    module_name, _, attr = name.rpartition(".")
+    return getattr(import_module(module_name), attr)
+
+
+class LRUCache(object):
+    """A bounded mapping discarding the least recently used items.
+
+    :param limit: The maximum number of items to keep.
+
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = {}
+        self.mutex = threading.Lock()
+        # Circular doubly linked list of [prev, next, key, value],
+        # the most recently used item is right after the root.
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        self.mutex.acquire()
+        try:
+            link = self.data.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._link_first(link)
+            return link[3]
+        finally:
+            self.mutex.release()
+
+    def __setitem__(self, key, value):
+        self.mutex.acquire()
+        try:
+            link = self.data.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = self.data[key] = [None, None, key, value]
+                if len(self.data) > self.limit:
+                    oldest = self.root[0]
+                    self._unlink(oldest)
+                    del(self.data[oldest[2]])
+            self._link_first(link)
+        finally:
+            self.mutex.release()
+
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
+        if value is KeyError:
+            raise KeyError(key)
+        return value
+
+    def pop(self, key, default=None):
+        self.mutex.acquire()
+        try:
+            link = self.data.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+        finally:
+            self.mutex.release()
+
+    def clear(self):
+        self.mutex.acquire()
+        try:
+            self.data.clear()
+            self.root[:] = [self.root, self.root, None, None]
+        finally:
+            self.mutex.release()
+
+    def keys(self):
+        """The keys, most recently used first."""
+        keys, link = [], self.root[1]
+        while link is not self.root:
+            keys.append(link[2])
+            link = link[1]
+        return keys
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1], next[0] = next, prev
+
+    def _link_first(self, link):
+        root = self.root
+        first = root[1]
+        link[0], link[1] = root, first
+        root[1] = first[0] = link
@@ -34,6 +34,9 @@ CELERY_AMQP_EXCHANGE = "testdurian"
 CELERY_AMQP_ROUTING_KEY = "testdurian"
 CELERY_AMQP_CONSUMER_QUEUE = "testdurian"
 
+# The tests run in a single process, so the process local cache is shared.
+DURIAN_LISTENER_CACHE_SHARED = True
+
 MANAGERS = ADMINS
 
 DATABASE_ENGINE = 'sqlite3'